@@ -0,0 +1,79 @@
+"""
+Per input HTTP overhead of the rollup server calls, with one requests.post per
+call against the keep-alive RollupClient, on a local stub server.
+
+    python benchmark/rollup_client.py [inputs]
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from dapp.rollup import RollupClient
+
+
+class StubRollupServer(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written apart, Nagle would hold the body back
+    disable_nagle_algorithm = True
+    connections = 0
+
+    def setup(self):
+        super().setup()
+        StubRollupServer.connections += 1
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers["Content-Length"]))
+        body = json.dumps({"index": 0}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def run_inputs(post, inputs):
+    """Time per input of a report and a voucher, the calls of a withdraw."""
+    report = {"payload": "0x00" + "00" * 40}
+    voucher = {"destination": "0x" + "12" * 20, "payload": "0x" + "ab" * 68}
+    StubRollupServer.connections = 0
+    start = time.perf_counter()
+    for _ in range(inputs):
+        post("/report", report)
+        post("/voucher", voucher)
+    return (time.perf_counter() - start) / inputs, StubRollupServer.connections
+
+
+def main(inputs):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubRollupServer)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}"
+
+    client = RollupClient(url)
+    results = {
+        "requests.post": run_inputs(
+            lambda endpoint, body: requests.post(url + endpoint, json=body), inputs
+        ),
+        "RollupClient": run_inputs(client.post, inputs),
+    }
+    server.shutdown()
+
+    for name, (seconds, connections) in results.items():
+        print(
+            f"{name:>14}: {seconds * 1e6:8.1f} us per input, {connections} connections"
+        )
+    saved = results["requests.post"][0] - results["RollupClient"][0]
+    print(f"{'saved':>14}: {saved * 1e6:8.1f} us per input")
+
+
+if __name__ == "__main__":
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000)
@@ -1,4 +1,5 @@
-from dapp.db import create_pair_if_not_exists, create_swap
+from dapp.db import create_pair_if_not_exists, create_swap, set_swap_streams
+from dapp.hook import advance_pair, open_order
 from dapp.streamabletoken import StreamableToken
 from dapp.util import (
     MINIMUM_LIQUIDITY,
@@ -16,13 +17,22 @@ import math
 class AMM:
     def __init__(self, connection):
         self.connection = connection
+        # Pair objects of this connection by unordered token pair
+        self.pairs = {}
+
+    def get_pair(self, token_a, token_b) -> Pair:
+        key = frozenset((token_a, token_b))
+        pair = self.pairs.get(key)
+        if pair is None:
+            pair = self.pairs[key] = Pair(self.connection, token_a, token_b)
+        return pair
 
     def get_reserves(self, token_a, token_b, at_timestamp):
-        pair = Pair(self.connection, token_a, token_b)
+        pair = self.get_pair(token_a, token_b)
         (reserve_0, reserve_1) = pair.get_reserves(at_timestamp)
         return (
             (reserve_0, reserve_1)
-            if token_a == pair.get_tokens()[0]
+            if token_a == pair.token0.get_address()
             else (reserve_1, reserve_0)
         )
 
@@ -68,8 +78,14 @@ class AMM:
         msg_sender,
         current_timestamp,
     ):
-        pair = Pair(self.connection, token_a, token_b)
+        pair = self.get_pair(token_a, token_b)
         pair_address = pair.get_address()
+        create_pair_if_not_exists(
+            self.connection,
+            pair_address,
+            pair.token0.get_address(),
+            pair.token1.get_address(),
+        )
         (reserve_a, reserve_b) = self.get_reserves(token_a, token_b, current_timestamp)
 
         (amount_a, amount_b) = self._add_liquidity(
@@ -107,12 +123,6 @@ class AMM:
             pair.mint(
                 MINIMUM_LIQUIDITY, ZERO_ADDRESS
             )  # permanently lock the first MINIMUM_LIQUIDITY tokens
-            create_pair_if_not_exists(
-                self.connection,
-                pair_address,
-                pair.token0.get_address(),
-                pair.token1.get_address(),
-            )
         else:
             liquidity = min(
                 amount_a * total_supply // reserve_a,
@@ -122,6 +132,13 @@ class AMM:
         assert liquidity > 0, "AMM: INSUFFICIENT_LIQUIDITY_MINTED"
 
         pair.mint(liquidity, to)
+        pair.update_reserves(
+            *(
+                (amount_a, amount_b)
+                if token_a == pair.token0.get_address()
+                else (amount_b, amount_a)
+            )
+        )
 
         return liquidity
 
@@ -136,7 +153,7 @@ class AMM:
         msg_sender,
         current_timestamp,
     ):
-        pair = Pair(self.connection, token_a, token_b)
+        pair = self.get_pair(token_a, token_b)
         pair_address = pair.get_address()
         pair.transfer(
             receiver=pair_address,
@@ -180,8 +197,12 @@ class AMM:
             current_timestamp=current_timestamp,
         )
 
+        pair.update_reserves(-amount_0, -amount_1)
+
         (amount_a, amount_b) = (
-            (amount_0, amount_1) if token_0 == token_a else (amount_1, amount_0)
+            (amount_0, amount_1)
+            if token_0.get_address() == token_a
+            else (amount_1, amount_0)
         )
 
         assert amount_a >= amount_a_min, "AMM: INSUFFICIENT_A_AMOUNT"
@@ -208,7 +229,7 @@ class AMM:
             start = current_timestamp
         assert start >= current_timestamp, "AMM: INVALID_START_TIME"
 
-        pair = Pair(self.connection, path[0], path[1])
+        pair = self.get_pair(path[0], path[1])
 
         (token_0, token_1) = (
             StreamableToken(self.connection, path[0]),
@@ -218,9 +239,15 @@ class AMM:
         swap_id = create_swap(
             self.connection,
             pair.get_address(),
+            pair.token0.get_address(),
+            pair.token1.get_address(),
+            to,
+            start,
+            start + duration,
             token_0.get_address(),
-            token_1.get_address(),
+            amount_in // duration if duration > 0 else 0,
         )
+        advance_pair(self.connection, pair.get_address(), current_timestamp)
 
         if duration == 0:
             (reserve_in, reserve_out) = self.get_reserves(path[0], path[1], start)
@@ -229,7 +256,7 @@ class AMM:
             k_before = reserve_in * reserve_out
             k_after = (reserve_in + amount_in) * (reserve_out - amount_out)
             assert k_after >= k_before, "AMM: K"
-            token_0.transfer(
+            to_pair_stream_id = token_0.transfer(
                 receiver=pair.get_address(),
                 amount=amount_in,
                 duration=0,
@@ -238,7 +265,7 @@ class AMM:
                 current_timestamp=current_timestamp,
                 swap_id=swap_id,
             )
-            token_1.transfer(
+            from_pair_stream_id = token_1.transfer(
                 receiver=to,
                 amount=amount_out,
                 duration=0,
@@ -247,8 +274,18 @@ class AMM:
                 current_timestamp=current_timestamp,
                 swap_id=swap_id,
             )
+            set_swap_streams(
+                self.connection, swap_id, to_pair_stream_id, from_pair_stream_id
+            )
+            pair.update_reserves(
+                *(
+                    (amount_in, -amount_out)
+                    if token_0.get_address() == pair.token0.get_address()
+                    else (-amount_out, amount_in)
+                )
+            )
         else:
-            token_0.transfer(
+            to_pair_stream_id = token_0.transfer(
                 receiver=pair.get_address(),
                 amount=amount_in,
                 duration=duration,
@@ -257,7 +294,7 @@ class AMM:
                 current_timestamp=current_timestamp,
                 swap_id=swap_id,
             )
-            token_1.transfer(
+            from_pair_stream_id = token_1.transfer(
                 receiver=to,
                 amount=0,
                 duration=0,
@@ -266,3 +303,9 @@ class AMM:
                 current_timestamp=current_timestamp,
                 swap_id=swap_id,
             )
+            set_swap_streams(
+                self.connection, swap_id, to_pair_stream_id, from_pair_stream_id
+            )
+            open_order(self.connection, swap_id)
+
+        return swap_id
@@ -2,39 +2,29 @@ import json
 import traceback
 from os import environ
 
-import requests
 from dapp.amm import AMM
 from eth_abi.abi import encode
+from eth_abi.decoding import ContextFramesBytesIO, TupleDecoder
+from eth_abi.packed import encode_packed
+from eth_utils import function_signature_to_4byte_selector
 
-from dapp.db import get_connection, stream_test
+from dapp.db import get_write_connection, read_connection, stream_test
+from dapp.rollup import rollup_client
 from dapp.streamabletoken import StreamableToken
 from dapp.util import (
     decode_packed,
     get_portal_address,
     hex_to_str,
     logger,
-    rollup_server,
+    registry_packed,
     str_to_hex,
+    verbose_reports,
 )
 
 
 def send_post_request(endpoint, payload):
-    url = rollup_server + endpoint
-    json_payload = {"payload": str_to_hex(json.dumps(payload))}
-
-    logger.info(f"Sending POST request to {url} with payload {json_payload}")
-    response = requests.post(url, json=json_payload)
-
-    if response.status_code not in (200, 202):
-        logger.error(
-            f"Failed POST request to {url}. Status: {response.status_code}. Response: {response.text}"
-        )
-    else:
-        logger.info(
-            f"Successful POST request to {url}. Status: {response.status_code}. Response: {response.text}"
-        )
-
-    return response
+    logger.debug("Sending %s payload %s", endpoint, payload)
+    return rollup_client.post(endpoint, {"payload": str_to_hex(json.dumps(payload))})
 
 
 def report_error(msg, payload):
@@ -48,18 +38,52 @@ def report_error(msg, payload):
     return "reject"
 
 
-def report_success(msg, payload):
+def report_success(msg, payload, result=None):
     success_log = {
         "error": False,
         "message": msg,
         "payload": payload,
     }
+    if result is not None:
+        success_log["result"] = result
     """Function to report successful operations."""
     send_post_request("/report", success_log)
     return "accept"
 
 
-def handle_deposit(data, connection):
+def report_accepted(input_index, method, result):
+    """Compact report of a successful advance: the status byte, the uint64 index
+    of the input and the ABI encoded result of the method, if it has one."""
+    payload = SUCCESS_REPORT_STATUS + input_index.to_bytes(8, "big")
+    if result is not None:
+        payload += encode(RESULT_TYPES[method], result)
+    rollup_client.report("0x" + payload.hex())
+    return "accept"
+
+
+def is_success_report(payload):
+    """Whether the hex payload of a report is the one of a successful advance,
+    compact or verbose."""
+    binary = bytes.fromhex(payload[2:])
+    if binary[:1] == SUCCESS_REPORT_STATUS:
+        return True
+    report = json.loads(binary.decode("utf-8"))
+    return not report["error"] and report["message"] == "Success"
+
+
+class ExecutionContext:
+    """
+    What an input runs with: the connection its changes are made on and the
+    sink of the vouchers, notices and reports it outputs. The listener sends
+    them to the rollup server, replays drop or record them.
+    """
+
+    def __init__(self, connection, outputs=rollup_client):
+        self.connection = connection
+        self.outputs = outputs
+
+
+def handle_deposit(data, context):
     binary = bytes.fromhex(data["payload"][2:])
 
     decoded = decode_packed(["bool", "address", "address", "uint256"], binary)
@@ -68,110 +92,317 @@ def handle_deposit(data, connection):
     depositor = decoded[2]
     amount = decoded[3]
 
-    StreamableToken(connection, erc20).mint(amount, depositor)
+    StreamableToken(context.connection, erc20).mint(amount, depositor)
+
+
+def handle_stream(
+    context, sender, timestamp, token, receiver, amount, duration, start
+):
+    stream_id = StreamableToken(context.connection, token).transfer(
+        receiver=receiver,
+        amount=amount,
+        duration=duration,
+        start_timestamp=start,
+        sender=sender,
+        current_timestamp=timestamp,
+    )
+    return (stream_id,)
+
+
+def handle_stream_test(context, sender, timestamp, **args):
+    stream_test({"args": args}, sender, timestamp, context.connection)
+
+
+def handle_withdraw(context, sender, timestamp, token, amount):
+    StreamableToken(context.connection, token).burn(
+        amount=amount,
+        sender=sender,
+        current_timestamp=timestamp,
+    )
+    # Encode a transfer function call that returns the amount back to the depositor
+    TRANSFER_FUNCTION_SELECTOR = b"\xa9\x05\x9c\xbb"
+    transfer_payload = TRANSFER_FUNCTION_SELECTOR + encode(
+        ["address", "uint256"], [sender, amount]
+    )
+    logger.info(f"Issuing voucher to {token}")
+    context.outputs.voucher(token, "0x" + transfer_payload.hex())
+
+
+def handle_cancel_stream(context, sender, timestamp, token, stream_id):
+    StreamableToken(context.connection, token).cancel_stream(
+        stream_id=stream_id,
+        sender=sender,
+        current_timestamp=timestamp,
+    )
+
+
+def handle_add_liquidity(context, sender, timestamp, **args):
+    liquidity = AMM(context.connection).add_liquidity(
+        **args, msg_sender=sender, current_timestamp=timestamp
+    )
+    return (liquidity,)
+
+
+def handle_remove_liquidity(context, sender, timestamp, **args):
+    return AMM(context.connection).remove_liquidity(
+        **args, msg_sender=sender, current_timestamp=timestamp
+    )
+
+
+def handle_swap(context, sender, timestamp, **args):
+    swap_id = AMM(context.connection).swap_exact_tokens_for_tokens(
+        **args, msg_sender=sender, current_timestamp=timestamp
+    )
+    return (swap_id,)
+
+
+METHODS = {
+    "stream": handle_stream,
+    "stream_test": handle_stream_test,  # Just for testing purposes
+    "withdraw": handle_withdraw,
+    "cancel_stream": handle_cancel_stream,
+    "add_liquidity": handle_add_liquidity,
+    "remove_liquidity": handle_remove_liquidity,
+    "swap": handle_swap,
+}
+
+# ABI types of the result the methods return, methods missing here return none.
+# A multicall returns whether each call was accepted and the errors of the
+# rejected ones.
+RESULT_TYPES = {
+    "stream": ("uint256",),  # Stream id
+    "add_liquidity": ("uint256",),  # Liquidity minted
+    "remove_liquidity": ("uint256", "uint256"),  # Amounts of token 0 and 1
+    "swap": ("uint256",),  # Swap id
+    "multicall": ("bool[]", "string[]"),
+}
+SUCCESS_REPORT_STATUS = b"\x00"
+
+# Arguments of the methods in their binary order, with the type they are packed
+# as. uint arguments are decimal strings in JSON inputs. A trailing address[]
+# takes the rest of a binary input. Methods missing here are JSON only and get
+# their arguments as they are.
+METHOD_ARGUMENTS = {
+    "stream": (
+        ("token", "address"),
+        ("receiver", "address"),
+        ("amount", "uint256"),
+        ("duration", "uint64"),
+        ("start", "uint64"),
+    ),
+    "withdraw": (("token", "address"), ("amount", "uint256")),
+    "cancel_stream": (("token", "address"), ("stream_id", "uint64")),
+    "add_liquidity": (
+        ("token_a", "address"),
+        ("token_b", "address"),
+        ("token_a_desired", "uint256"),
+        ("token_b_desired", "uint256"),
+        ("token_a_min", "uint256"),
+        ("token_b_min", "uint256"),
+        ("to", "address"),
+    ),
+    "remove_liquidity": (
+        ("token_a", "address"),
+        ("token_b", "address"),
+        ("liquidity", "uint256"),
+        ("amount_a_min", "uint256"),
+        ("amount_b_min", "uint256"),
+        ("to", "address"),
+    ),
+    "swap": (
+        ("amount_in", "uint256"),
+        ("amount_out_min", "uint256"),
+        ("start", "uint64"),
+        ("duration", "uint64"),
+        ("to", "address"),
+        ("path", "address[]"),
+    ),
+}
+
+# Binary inputs start with the version of their format, which JSON inputs never
+# start with, then the 4 byte selector of the method signature and its packed
+# arguments. A multicall is followed by its calls, each prefixed by its uint32
+# length and made of a selector and packed arguments.
+BINARY_FORMAT_VERSION = b"\x01"
+MULTICALL_SIGNATURE = "multicall(bytes[])"
+CALL_LENGTH_SIZE = 4
+PACKED_ADDRESS_SIZE = 20
+
+
+def get_method_signature(method):
+    types = [type_str for (_, type_str) in METHOD_ARGUMENTS[method]]
+    return f"{method}({','.join(types)})"
+
+
+class BinaryDecoder:
+    """Packed arguments decoder of a method, built once from METHOD_ARGUMENTS."""
+
+    def __init__(self, method):
+        arguments = METHOD_ARGUMENTS[method]
+        self.method = method
+        self.has_path = arguments[-1][1] == "address[]"
+        fixed = arguments[:-1] if self.has_path else arguments
+        self.names = [name for (name, _) in arguments]
+        decoders = [registry_packed.get_decoder(type_str) for (_, type_str) in fixed]
+        self.decoder = TupleDecoder(decoders=decoders)
+        self.size = sum(decoder.data_byte_size for decoder in decoders)
+
+    def decode(self, binary):
+        rest = binary[self.size :]
+        if len(binary) < self.size or (
+            len(rest) % PACKED_ADDRESS_SIZE if self.has_path else rest
+        ):
+            raise Exception(f"Invalid arguments length for {self.method}")
+        values = list(self.decoder(ContextFramesBytesIO(binary[: self.size])))
+        if self.has_path:
+            values.append(
+                [
+                    "0x" + rest[i : i + PACKED_ADDRESS_SIZE].hex()
+                    for i in range(0, len(rest), PACKED_ADDRESS_SIZE)
+                ]
+            )
+        return dict(zip(self.names, values))
+
+
+BINARY_DECODERS = {
+    function_signature_to_4byte_selector(get_method_signature(method)): (
+        BinaryDecoder(method)
+    )
+    for method in METHOD_ARGUMENTS
+}
+MULTICALL_SELECTOR = function_signature_to_4byte_selector(MULTICALL_SIGNATURE)
+
+
+def decode_binary_call(binary):
+    """(method, args) of a binary call. The args of a multicall are its calls."""
+    selector, arguments = binary[:4], binary[4:]
+    if selector == MULTICALL_SELECTOR:
+        calls = []
+        while arguments:
+            length = int.from_bytes(arguments[:CALL_LENGTH_SIZE], "big")
+            call = arguments[CALL_LENGTH_SIZE : CALL_LENGTH_SIZE + length]
+            if len(call) != length or len(arguments) < CALL_LENGTH_SIZE:
+                raise Exception("Invalid multicall length")
+            calls.append(call)
+            arguments = arguments[CALL_LENGTH_SIZE + length :]
+        return ("multicall", {"calls": calls})
+    decoder = BINARY_DECODERS.get(selector)
+    if decoder is None:
+        raise Exception(f"Unknown method selector 0x{selector.hex()}")
+    return (decoder.method, decoder.decode(arguments))
+
+
+def decode_json_call(call):
+    """(method, args) of a JSON call, with its uint arguments parsed."""
+    method, args = call["method"], call["args"]
+    if method in METHOD_ARGUMENTS:
+        args = {
+            name: int(args[name]) if type_str.startswith("uint") else args[name]
+            for (name, type_str) in METHOD_ARGUMENTS[method]
+        }
+    return (method, args)
 
-    return "accept"
+
+def encode_binary_call(method, args):
+    """Binary call of the method, without the format version. The args of a
+    multicall are its calls, already encoded."""
+    if method == "multicall":
+        return MULTICALL_SELECTOR + b"".join(
+            len(call).to_bytes(CALL_LENGTH_SIZE, "big") + call
+            for call in args["calls"]
+        )
+    arguments = METHOD_ARGUMENTS[method]
+    binary = function_signature_to_4byte_selector(get_method_signature(method))
+    if arguments[-1][1] == "address[]":
+        (name, _) = arguments[-1]
+        arguments = arguments[:-1]
+        path = b"".join(bytes.fromhex(address[2:]) for address in args[name])
+    else:
+        path = b""
+    return (
+        binary
+        + encode_packed(
+            [type_str for (_, type_str) in arguments],
+            [
+                bytes.fromhex(args[name][2:]) if type_str == "address" else args[name]
+                for (name, type_str) in arguments
+            ],
+        )
+        + path
+    )
 
 
-def handle_action(data, connection):
+def handle_action(data, context):
+    """Runs the input in the execution context, returns its method and the
+    result of the method, None for deposits and methods without result."""
     if data["metadata"]["msg_sender"].lower() == get_portal_address().lower():
-        return handle_deposit(data, connection)
+        handle_deposit(data, context)
+        return ("deposit", None)
 
-    str_payload = hex_to_str(data["payload"])
-    payload = json.loads(str_payload)
+    payload = bytes.fromhex(data["payload"][2:])
+    if payload[:1] == BINARY_FORMAT_VERSION:
+        decode_call = decode_binary_call
+        call = payload[1:]
+    else:
+        decode_call = decode_json_call
+        call = json.loads(payload.decode("utf-8"))
 
     sender = data["metadata"]["msg_sender"]
-    timestamp = data["metadata"]["timestamp"]
-
-    if payload["method"] == "stream":
-        StreamableToken(connection, payload["args"]["token"]).transfer(
-            receiver=payload["args"]["receiver"],
-            amount=int(payload["args"]["amount"]),
-            duration=int(payload["args"]["duration"]),
-            start_timestamp=int(payload["args"]["start"]),
-            sender=sender,
-            current_timestamp=timestamp,
-        )
-    elif payload["method"] == "stream_test":  # Just for testing purposes
-        stream_test(payload, sender, timestamp, connection)
-    elif payload["method"] == "withdraw":
-        token_address = payload["args"]["token"]
-        token = StreamableToken(connection, payload["args"]["token"])
-        amount = int(payload["args"]["amount"])
-        token.burn(
-            amount=amount,
-            sender=sender,
-            current_timestamp=timestamp,
-        )
-        # Encode a transfer function call that returns the amount back to the depositor
-        TRANSFER_FUNCTION_SELECTOR = b"\xa9\x05\x9c\xbb"
-        transfer_payload = TRANSFER_FUNCTION_SELECTOR + encode(
-            ["address", "uint256"], [sender, amount]
-        )
-        voucher = {
-            "destination": token_address,
-            "payload": "0x" + transfer_payload.hex(),
-        }
-        logger.info(f"Issuing voucher {voucher}")
-        response = requests.post(rollup_server + "/voucher", json=voucher)
-        logger.info(
-            f"Received voucher status {response.status_code} body {response.content}"
-        )
-    elif payload["method"] == "cancel_stream":
-        token = StreamableToken(connection, payload["args"]["token"]).cancel_stream(
-            stream_id=int(payload["args"]["stream_id"]),
-            sender=sender,
-            current_timestamp=timestamp,
-        )
-    elif payload["method"] == "add_liquidity":
-        AMM(connection).add_liquidity(
-            token_a=payload["args"]["token_a"],
-            token_b=payload["args"]["token_b"],
-            token_a_desired=int(payload["args"]["token_a_desired"]),
-            token_b_desired=int(payload["args"]["token_b_desired"]),
-            token_a_min=int(payload["args"]["token_a_min"]),
-            token_b_min=int(payload["args"]["token_b_min"]),
-            to=payload["args"]["to"],
-            msg_sender=data["metadata"]["msg_sender"],
-            current_timestamp=int(data["metadata"]["timestamp"]),
-        )
-    elif payload["method"] == "remove_liquidity":
-        AMM(connection).remove_liquidity(
-            token_a=payload["args"]["token_a"],
-            token_b=payload["args"]["token_b"],
-            liquidity=int(payload["args"]["liquidity"]),
-            amount_a_min=int(payload["args"]["amount_a_min"]),
-            amount_b_min=int(payload["args"]["amount_b_min"]),
-            to=payload["args"]["to"],
-            msg_sender=data["metadata"]["msg_sender"],
-            current_timestamp=int(data["metadata"]["timestamp"]),
-        )
-    elif payload["method"] == "swap":
-        AMM(connection).swap_exact_tokens_for_tokens(
-            amount_in=int(payload["args"]["amount_in"]),
-            amount_out_min=int(payload["args"]["amount_out_min"]),
-            path=payload["args"]["path"],
-            start=int(payload["args"]["start"]),
-            duration=int(payload["args"]["duration"]),
-            to=payload["args"]["to"],
-            msg_sender=data["metadata"]["msg_sender"],
-            current_timestamp=int(data["metadata"]["timestamp"]),
+    timestamp = int(data["metadata"]["timestamp"])
+    (method, args) = decode_call(call)
+    if method == "multicall":
+        result = handle_multicall(
+            args["calls"], decode_call, sender, timestamp, context
         )
     else:
-        raise Exception(f"Unknown method {payload['method']}")
+        result = handle_method(method, args, sender, timestamp, context)
+    return (method, result)
+
+
+def handle_multicall(calls, decode_call, sender, timestamp, context):
+    """
+    Runs the calls in order in the transaction of the input, each in its own
+    savepoint so a failing call is rolled back alone. Returns whether each call
+    was accepted and the errors of the rejected ones, empty for the others.
+    """
+    connection = context.connection
+    # Releasing a savepoint outside of a transaction would commit it
+    if not connection.in_transaction:
+        connection.execute("BEGIN")
+    (accepted, errors) = ([], [])
+    for call in calls:
+        connection.execute("SAVEPOINT multicall")
+        try:
+            (method, args) = decode_call(call)
+            handle_method(method, args, sender, timestamp, context)
+            accepted.append(True)
+            errors.append("")
+        except Exception as e:
+            connection.execute("ROLLBACK TO SAVEPOINT multicall")
+            accepted.append(False)
+            errors.append(str(e))
+        connection.execute("RELEASE SAVEPOINT multicall")
+    return (accepted, errors)
 
-    return "accept"
+
+def handle_method(method, args, sender, timestamp, context):
+    handler = METHODS.get(method)
+    if handler is None:
+        raise Exception(f"Unknown method {method}")
+    return handler(context, sender, timestamp, **args)
 
 
 def handle_advance(data):
     logger.info(f"Received advance request data {data}")
-    connection = get_connection()
+    connection = get_write_connection()
     status = "accept"
     try:
-        status = handle_action(data, connection)
-        report_success("Success", str_to_hex(json.dumps(data)))
+        (method, result) = handle_action(data, ExecutionContext(connection))
+        if verbose_reports:
+            report_success("Success", str_to_hex(json.dumps(data)), result)
+        else:
+            report_accepted(data["metadata"]["input_index"], method, result)
         connection.commit()
-        connection.close()
     except Exception as e:
         connection.rollback()
         status = "reject"
@@ -189,20 +420,24 @@ def handle_inspect(data):
         statement = hex_to_str(data["payload"])
         logger.info(f"Processing statement: '{statement}'")
 
-        connection = get_connection()
-        cursor = connection.cursor()
-
+        result = None
         try:
-            # attempts to execute the statement and fetch any results
-            cursor.execute(statement)
-            result = cursor.fetchall()
+            # attempts to execute the statement and fetch any results, on a read
+            # only connection so inspects can never change the state
+            with read_connection() as connection:
+                result = connection.execute(statement).fetchall()
         except Exception as e:
             msg = f"Error executing statement '{statement}': {e}"
             response = report_error(msg, data["payload"])
 
         if result:
             # if there is a result, converts it to JSON and posts it as a notice or report
-            payloadJson = json.dumps(result)
+            payloadJson = json.dumps(
+                result,
+                default=lambda value: "0x" + value.hex()
+                if isinstance(value, bytes)
+                else str(value),
+            )
             response = report_success(payloadJson, data["payload"])
     except Exception as e:
         response = report_error(str(e), data["payload"])
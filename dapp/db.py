@@ -1,153 +1,918 @@
 import os
 import sqlite3
+import threading
+from collections import OrderedDict
+from contextlib import contextmanager
 from typing import List
-from dapp.stream import Stream
-from dapp.util import int_to_str, str_to_int, to_checksum_address
+from dapp.stream import Stream, stream_events, stream_flow
+from dapp.util import (
+    STREAM_RATE_PRECISION,
+    blob_to_int,
+    int_to_blob,
+    int_to_str,
+    str_to_int,
+    to_checksum_address,
+)
 
 db_file_path = os.getenv("DB_FILE_PATH", "dapp.sqlite")
 
 
-def get_connection():
-    conn = sqlite3.connect(db_file_path)
+# Tables reference accounts, tokens and pairs by the integer id of their address
+# in the account table. Ids of committed accounts never change, so they are kept
+# for the lifetime of the process, as are the ids with a committed token row,
+# least recently used first. Evicted ones are read again from the database.
+account_ids = OrderedDict()
+account_addresses = OrderedDict()
+token_ids = OrderedDict()
+# Bound of each of them, accounts are created by users so their number is not
+ACCOUNT_CACHE_SIZE = 4096
+# The indexer looks accounts up from several threads
+account_cache_lock = threading.Lock()
+
+
+# Connection tuning. The statement cache holds every distinct SQL string the
+# dapp runs, the hot ones are the module constants below, so they are parsed
+# once per connection. The other defaults fit the 128 MiB of RAM of the Cartesi
+# machine, where the write connection and one read connection are open, hosts
+# with more memory, like the indexer's, may raise them through the environment.
+CACHED_STATEMENTS = 256
+MMAP_SIZE = int(os.getenv("DB_MMAP_SIZE", 16 * 1024 * 1024))
+# In KiB when negative
+CACHE_SIZE = int(os.getenv("DB_CACHE_SIZE", -4 * 1024))
+# Idle read only connections kept open for inspects and the indexer. Inspects
+# and advances never run at the same time in the machine, one is enough there.
+READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", 1))
+
+SELECT_ACCOUNT_ID = "SELECT id FROM account WHERE address = ?"
+SELECT_ACCOUNT_ADDRESS = "SELECT address FROM account WHERE id = ?"
+SELECT_BALANCE = """
+    SELECT amount FROM balance
+    WHERE account_id = ? AND token_id = ?
+"""
+SELECT_TOTAL_SUPPLY = "SELECT total_supply FROM token WHERE id = ?"
+SELECT_ACCUMULATOR = """
+    SELECT checkpoint_timestamp, inflow_rate, inflow_offset, outflow_rate, outflow_offset,
+        committed_outflow
+    FROM accumulator
+    WHERE account_id = ? AND token_id = ?
+"""
+SELECT_PAIR_POOL = """
+    SELECT token_0_id, token_1_id, last_timestamp_processed,
+        sell_rate_0, sell_rate_1, earnings_per_rate_0, earnings_per_rate_1,
+        reserve_0, reserve_1, next_event_timestamp
+    FROM pair
+    WHERE id = ?
+"""
+UPSERT_BALANCE = """
+    INSERT INTO balance (account_id, token_id, amount)
+    VALUES (?, ?, ?)
+    ON CONFLICT(account_id, token_id)
+    DO UPDATE SET amount = EXCLUDED.amount
+"""
+UPSERT_TOTAL_SUPPLY = """
+    INSERT INTO token (id, total_supply)
+    VALUES (?, ?)
+    ON CONFLICT(id)
+    DO UPDATE SET total_supply = EXCLUDED.total_supply
+"""
+UPSERT_ACCUMULATOR = """
+    INSERT INTO accumulator (account_id, token_id, checkpoint_timestamp,
+        inflow_rate, inflow_offset, outflow_rate, outflow_offset, committed_outflow)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(account_id, token_id)
+    DO UPDATE SET checkpoint_timestamp = EXCLUDED.checkpoint_timestamp,
+        inflow_rate = EXCLUDED.inflow_rate, inflow_offset = EXCLUDED.inflow_offset,
+        outflow_rate = EXCLUDED.outflow_rate, outflow_offset = EXCLUDED.outflow_offset,
+        committed_outflow = EXCLUDED.committed_outflow
+"""
+UPDATE_PAIR_POOL = """
+    UPDATE pair
+    SET last_timestamp_processed = ?, next_event_timestamp = ?,
+        sell_rate_0 = ?, sell_rate_1 = ?,
+        earnings_per_rate_0 = ?, earnings_per_rate_1 = ?,
+        reserve_0 = ?, reserve_1 = ?
+    WHERE id = ?
+"""
+
+# Estimated bytes a warm connection keeps across commits before starting over
+# cold, a small share of the 128 MiB of the machine next to the SQLite caches
+WARM_STATE_BUDGET = 8 * 1024 * 1024
+# Estimated bytes of an entry of the unit of work, key, value and dict slots,
+# measured with sys.getsizeof on amounts of 18 decimals tokens and scaled rates
+BALANCE_ENTRY_SIZE = 250
+TOTAL_SUPPLY_ENTRY_SIZE = 200
+ACCUMULATOR_ENTRY_SIZE = 600
+PAIR_POOL_ENTRY_SIZE = 1500
+
+
+# Tables of the unit of work, each with its dirty_ dict of the keys to flush
+UNIT_OF_WORK = ("balances", "total_supplies", "accumulators", "pair_pools")
+
+
+class Connection(sqlite3.Connection):
+    """Connection sharing the account ids it learns with the process once its
+    transaction commits, so rolled back inserts never leak into the cache.
+
+    It is also the unit of work of its transaction: balances, total supplies,
+    accumulators and pair pools are read once, updated in memory and written
+    back by flush(), with one executemany per table, when the transaction
+    commits or a savepoint starts. They are discarded on rollback. A rollback
+    to a savepoint only drops the entries written since the savepoint started,
+    as everything changed before was flushed when it started, so they are read
+    again from the database as they were then.
+
+    A warm connection keeps them after a commit, as they then match the
+    database, so the next transaction starts from what the previous ones read.
+    Only the connection handling the inputs may be warm, as it assumes no other
+    connection writes to the database."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.warm = False
+        self.pending_account_ids = {}
+        self.pending_account_addresses = {}
+        self.pending_token_ids = set()
+        # (account_id, token_id) -> amount or accumulator, token_id -> total
+        # supply and pair_id -> pool, the dirty keys are kept in dicts to flush
+        # them in a deterministic order
+        self.balances = {}
+        self.total_supplies = {}
+        self.accumulators = {}
+        self.pair_pools = {}
+        self.dirty_balances = {}
+        self.dirty_total_supplies = {}
+        self.dirty_accumulators = {}
+        self.dirty_pair_pools = {}
+        # [name, keys of each table flushed since it started] of the open
+        # savepoints, innermost last
+        self.savepoints = []
+
+    def commit(self):
+        self.flush()
+        super().commit()
+        self.savepoints.clear()
+        for (address, account_id) in self.pending_account_ids.items():
+            _cache_put(account_ids, address, account_id)
+        for (account_id, address) in self.pending_account_addresses.items():
+            _cache_put(account_addresses, account_id, address)
+        for token_id in self.pending_token_ids:
+            _cache_put(token_ids, token_id, True)
+        self.discard_pending_accounts()
+        if not self.warm or self.get_state_size() > WARM_STATE_BUDGET:
+            self.discard_unit_of_work()
+
+    def rollback(self):
+        super().rollback()
+        self.savepoints.clear()
+        self.discard_pending_accounts()
+        self.discard_unit_of_work()
+
+    def execute(self, sql, *args):
+        if sql.lstrip()[:9].upper().startswith(("ROLLBACK", "SAVEPOINT", "RELEASE")):
+            self.track_savepoints(sql.upper().replace(";", " ").split())
+        return super().execute(sql, *args)
+
+    def track_savepoints(self, words):
+        statement = words[0]
+        if statement == "ROLLBACK":
+            self.discard_pending_accounts()
+            if "TO" in words:
+                self.rollback_to_savepoint(words[-1])
+            else:
+                self.savepoints.clear()
+                self.discard_unit_of_work()
+        elif statement == "SAVEPOINT":
+            self.flush()
+            self.savepoints.append([words[-1], tuple(set() for _ in UNIT_OF_WORK)])
+        elif statement == "RELEASE":
+            index = self.find_savepoint(words[-1])
+            if index is not None:
+                del self.savepoints[index:]
+
+    def find_savepoint(self, name):
+        """Index of the innermost open savepoint named name, None if none is."""
+        for index in range(len(self.savepoints) - 1, -1, -1):
+            if self.savepoints[index][0] == name:
+                return index
+        return None
+
+    def rollback_to_savepoint(self, name):
+        """Drops the entries written since the savepoint started, the savepoint
+        stays open."""
+        index = self.find_savepoint(name)
+        if index is None:
+            self.discard_unit_of_work()
+            return
+        del self.savepoints[index + 1 :]
+        for (table, flushed) in zip(UNIT_OF_WORK, self.savepoints[index][1]):
+            (entries, dirty) = (getattr(self, table), getattr(self, "dirty_" + table))
+            for key in (*dirty, *flushed):
+                entries.pop(key, None)
+            dirty.clear()
+            flushed.clear()
+
+    def flush(self):
+        """Writes the state changed since the last flush."""
+        for (_, flushed) in self.savepoints:
+            for (table, keys) in zip(UNIT_OF_WORK, flushed):
+                keys.update(getattr(self, "dirty_" + table))
+        if self.dirty_balances:
+            super().executemany(
+                UPSERT_BALANCE,
+                [
+                    (account_id, token_id, int_to_blob(self.balances[key]))
+                    for key in self.dirty_balances
+                    for (account_id, token_id) in (key,)
+                ],
+            )
+            self.dirty_balances.clear()
+        if self.dirty_total_supplies:
+            super().executemany(
+                UPSERT_TOTAL_SUPPLY,
+                [
+                    (token_id, int_to_blob(self.total_supplies[token_id]))
+                    for token_id in self.dirty_total_supplies
+                ],
+            )
+            self.dirty_total_supplies.clear()
+        if self.dirty_accumulators:
+            super().executemany(
+                UPSERT_ACCUMULATOR,
+                [
+                    accumulator_row(*key, self.accumulators[key])
+                    for key in self.dirty_accumulators
+                ],
+            )
+            self.dirty_accumulators.clear()
+        if self.dirty_pair_pools:
+            super().executemany(
+                UPDATE_PAIR_POOL,
+                [
+                    pair_pool_row(pair_id, self.pair_pools[pair_id])
+                    for pair_id in self.dirty_pair_pools
+                ],
+            )
+            self.dirty_pair_pools.clear()
+
+    def get_state_size(self):
+        """Estimated bytes held by the unit of work."""
+        return (
+            len(self.balances) * BALANCE_ENTRY_SIZE
+            + len(self.total_supplies) * TOTAL_SUPPLY_ENTRY_SIZE
+            + len(self.accumulators) * ACCUMULATOR_ENTRY_SIZE
+            + len(self.pair_pools) * PAIR_POOL_ENTRY_SIZE
+        )
+
+    def discard_pending_accounts(self):
+        self.pending_account_ids.clear()
+        self.pending_account_addresses.clear()
+        self.pending_token_ids.clear()
+
+    def discard_unit_of_work(self):
+        self.balances.clear()
+        self.total_supplies.clear()
+        self.accumulators.clear()
+        self.pair_pools.clear()
+        self.dirty_balances.clear()
+        self.dirty_total_supplies.clear()
+        self.dirty_accumulators.clear()
+        self.dirty_pair_pools.clear()
+
+
+def accumulator_row(account_id, token_id, accumulator):
+    return (account_id, token_id, accumulator[0]) + tuple(
+        int_to_str(value) for value in accumulator[1:]
+    )
+
+
+def pair_pool_row(pair_id, pool):
+    return (
+        pool["last_timestamp_processed"],
+        pool["next_event_timestamp"],
+        *[
+            int_to_str(value)
+            for key in ("sell_rates", "earnings_per_rate")
+            for value in pool[key]
+        ],
+        *[int_to_blob(value) for value in pool["reserves"]],
+        pair_id,
+    )
+
+
+def copy_pair_pool(pool):
+    return {
+        key: list(value) if isinstance(value, list) else value
+        for key, value in pool.items()
+    }
+
+
+class StreamedSum:
+    """
+    SQLite aggregate streamed_sum(start_timestamp, duration, amount, to_id,
+    account_id, until_timestamp, recipient_until_timestamp) of the net amount
+    the streams moved to the account, as an amount BLOB. Streams to the account
+    count until recipient_until_timestamp and the others until until_timestamp,
+    rounded like get_wallet_streamed_amount.
+    """
+
+    def __init__(self):
+        self.inflow = 0
+        self.outflow = 0
+
+    def step(
+        self,
+        start_timestamp,
+        duration,
+        amount,
+        to_id,
+        account_id,
+        until_timestamp,
+        recipient_until_timestamp,
+    ):
+        if to_id == account_id:
+            self.inflow += stream_flow(
+                start_timestamp,
+                duration,
+                blob_to_int(amount),
+                recipient_until_timestamp,
+            )
+        else:
+            self.outflow += stream_flow(
+                start_timestamp, duration, blob_to_int(amount), until_timestamp
+            )
+
+    def finalize(self):
+        return int_to_blob(
+            self.inflow // STREAM_RATE_PRECISION
+            + (-self.outflow) // STREAM_RATE_PRECISION
+        )
+
+
+def register_functions(connection):
+    connection.create_aggregate("streamed_sum", 7, StreamedSum)
+
+
+def configure_connection(conn):
+    register_functions(conn)
     cursor = conn.cursor()
     cursor.execute("PRAGMA foreign_keys = ON")
-    cursor.execute("PRAGMA journal_mode = WAL")
+    cursor.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+    cursor.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+
+
+def get_connection():
+    conn = sqlite3.connect(
+        db_file_path, factory=Connection, cached_statements=CACHED_STATEMENTS
+    )
+    configure_connection(conn)
+    conn.execute("PRAGMA journal_mode = WAL")
     return conn
 
 
+# Write connection of the process and idle read only connections, opened on
+# first use and kept until close_connections()
+write_connection = None
+read_connections = []
+read_connections_lock = threading.Lock()
+
+
+def get_write_connection():
+    """The connection the inputs are handled on. It is opened once and is warm,
+    see Connection, so it must be the only one writing to the database."""
+    global write_connection
+    if write_connection is None:
+        write_connection = get_connection()
+        write_connection.warm = True
+    return write_connection
+
+
+def open_read_connection():
+    conn = sqlite3.connect(
+        f"file:{db_file_path}?mode=ro",
+        uri=True,
+        factory=Connection,
+        cached_statements=CACHED_STATEMENTS,
+        check_same_thread=False,
+    )
+    configure_connection(conn)
+    conn.execute("PRAGMA query_only = ON")
+    return conn
+
+
+@contextmanager
+def read_connection():
+    """Read only connection from the pool, returned to it on exit. Pooled
+    connections may move between threads, but are used by one at a time."""
+    with read_connections_lock:
+        conn = read_connections.pop() if read_connections else None
+    if conn is None:
+        conn = open_read_connection()
+    try:
+        yield conn
+    finally:
+        # Ends the read transaction so the next use sees the latest commits
+        conn.rollback()
+        with read_connections_lock:
+            if len(read_connections) < READ_POOL_SIZE:
+                read_connections.append(conn)
+                conn = None
+        if conn is not None:
+            conn.close()
+
+
+def close_connections():
+    global write_connection
+    if write_connection is not None:
+        write_connection.close()
+        write_connection = None
+    with read_connections_lock:
+        for conn in read_connections:
+            conn.close()
+        read_connections.clear()
+
+
+def clear_account_cache():
+    with account_cache_lock:
+        account_ids.clear()
+        account_addresses.clear()
+        token_ids.clear()
+
+
+def _cache_get(cache, key):
+    with account_cache_lock:
+        value = cache.get(key)
+        if value is not None:
+            cache.move_to_end(key)
+        return value
+
+
+def _cache_put(cache, key, value):
+    with account_cache_lock:
+        cache[key] = value
+        cache.move_to_end(key)
+        while len(cache) > ACCOUNT_CACHE_SIZE:
+            cache.popitem(last=False)
+
+
+def _remember_account(connection, address, account_id):
+    if isinstance(connection, Connection):
+        connection.pending_account_ids[address] = account_id
+        connection.pending_account_addresses[account_id] = address
+
+
+def get_account_id(connection, address):
+    """Id of the address, None if it has never been seen."""
+    account_id = _cache_get(account_ids, address)
+    if account_id is not None:
+        return account_id
+    if isinstance(connection, Connection):
+        account_id = connection.pending_account_ids.get(address)
+        if account_id is not None:
+            return account_id
+
+    cursor = connection.cursor()
+    cursor.execute(SELECT_ACCOUNT_ID, (address,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    _remember_account(connection, address, row[0])
+    return row[0]
+
+
+def get_account_address(connection, account_id):
+    address = _cache_get(account_addresses, account_id)
+    if address is not None:
+        return address
+    if isinstance(connection, Connection):
+        address = connection.pending_account_addresses.get(account_id)
+        if address is not None:
+            return address
+
+    cursor = connection.cursor()
+    cursor.execute(SELECT_ACCOUNT_ADDRESS, (account_id,))
+    row = cursor.fetchone()
+    if row is None:
+        return None
+    _remember_account(connection, row[0], account_id)
+    return row[0]
+
+
 def create_account_if_not_exists(connection, address):
+    account_id = get_account_id(connection, address)
+    if account_id is not None:
+        return account_id
+
     cursor = connection.cursor()
     cursor.execute(
         """
-        INSERT OR IGNORE INTO account (address) VALUES (?)
+        INSERT INTO account (address) VALUES (?)
         """,
         (address,),
     )
+    _remember_account(connection, address, cursor.lastrowid)
+    return cursor.lastrowid
 
 
 def create_token_if_not_exists(connection, token_address, default_total_supply=0):
-    create_account_if_not_exists(connection, token_address)
+    token_id = create_account_if_not_exists(connection, token_address)
+    is_cached = isinstance(connection, Connection)
+    if _cache_get(token_ids, token_id) or (
+        is_cached and token_id in connection.pending_token_ids
+    ):
+        return token_id
+
     cursor = connection.cursor()
     cursor.execute(
         """
-        INSERT OR IGNORE INTO token (address, total_supply)
+        INSERT OR IGNORE INTO token (id, total_supply)
         VALUES (?, ?)
         """,
-        (token_address, int_to_str(default_total_supply)),
+        (token_id, int_to_blob(default_total_supply)),
     )
+    if is_cached:
+        connection.pending_token_ids.add(token_id)
+    return token_id
 
 
 def create_pair_if_not_exists(
     connection, token_address, token_0_address, token_1_address
 ):
-    create_token_if_not_exists(connection, token_address)
+    pair_id = create_token_if_not_exists(connection, token_address)
     cursor = connection.cursor()
     cursor.execute(
         """
-        INSERT OR IGNORE INTO pair (address, token_0_address, token_1_address)
+        INSERT OR IGNORE INTO pair (id, token_0_id, token_1_id)
         VALUES (?, ?, ?)
         """,
-        (token_address, token_0_address, token_1_address),
+        (
+            pair_id,
+            create_token_if_not_exists(connection, token_0_address),
+            create_token_if_not_exists(connection, token_1_address),
+        ),
     )
-    return cursor.lastrowid
+    return pair_id
 
 
-def create_swap(connection, pair_address, token_0_address, token_1_address):
-    create_pair_if_not_exists(
+def get_pairs(connection):
+    """(pair address, token 0 address, token 1 address) of every pair."""
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        SELECT a.address, a0.address, a1.address
+        FROM pair p
+        JOIN account a ON a.id = p.id
+        JOIN account a0 ON a0.id = p.token_0_id
+        JOIN account a1 ON a1.id = p.token_1_id
+        """
+    )
+    return cursor.fetchall()
+
+
+def create_swap(
+    connection,
+    pair_address,
+    token_0_address,
+    token_1_address,
+    owner_address,
+    start_timestamp,
+    end_timestamp,
+    token_in_address,
+    rate,
+):
+    pair_id = create_pair_if_not_exists(
         connection, pair_address, token_0_address, token_1_address
     )
     cursor = connection.cursor()
     cursor.execute(
         """
-        INSERT INTO swap (pair_address)
-        VALUES (?)
+        INSERT INTO swap (pair_id, owner_id, start_timestamp, end_timestamp, token_in_id, rate)
+        VALUES (?, ?, ?, ?, ?, ?)
         """,
-        (pair_address,),
+        (
+            pair_id,
+            create_account_if_not_exists(connection, owner_address),
+            start_timestamp,
+            end_timestamp,
+            create_token_if_not_exists(connection, token_in_address),
+            int_to_str(rate),
+        ),
     )
     return cursor.lastrowid
 
 
-def stream_from_row(row) -> Stream:
+def set_swap_streams(
+    connection, swap_id, to_pair_stream_id, from_pair_stream_id
+) -> None:
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        UPDATE swap
+        SET to_pair_stream_id = ?, from_pair_stream_id = ?
+        WHERE id = ?
+        """,
+        (to_pair_stream_id, from_pair_stream_id, swap_id),
+    )
+
+
+def set_swap_end_timestamp(connection, swap_id, end_timestamp) -> None:
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        UPDATE swap
+        SET end_timestamp = ?
+        WHERE id = ?
+        """,
+        (end_timestamp, swap_id),
+    )
+
+
+STREAM_COLUMNS = """
+    id, from_id, to_id, start_timestamp, duration, amount, token_id, accrued, swap_id
+"""
+
+# Streams of a wallet as one index search per side instead of an OR over from_id
+# and to_id, takes the parameters (account_id, *where, account_id, *where, account_id).
+# The table is stream for the active ones or stream_history to include the archive.
+WALLET_STREAMS = """
+    SELECT {columns} FROM {table} WHERE from_id = ? AND {where}
+    UNION ALL
+    SELECT {columns} FROM {table} WHERE to_id = ? AND {where} AND from_id != ?
+"""
+ARCHIVED_STREAM_COLUMNS = """
+    id, from_id, to_id, start_timestamp, duration, amount, token_id, swap_id
+"""
+
+
+def stream_from_row(connection, row) -> Stream:
     return Stream(
         stream_id=row[0],
-        from_address=row[1],
-        to_address=row[2],
+        from_address=get_account_address(connection, row[1]),
+        to_address=get_account_address(connection, row[2]),
         start_timestamp=row[3],
         duration=row[4],
-        amount=str_to_int(row[5]),
-        token_address=row[6],
+        amount=blob_to_int(row[5]),
+        token_address=get_account_address(connection, row[6]),
         accrued=True if row[7] == 1 else False,
         swap_id=row[8] if len(row) > 8 else None,
     )
 
 
-def get_wallet_non_accrued_streamed_amts(
-    connection,
-    account_address,
-    token_address,
-    until_timestamp,
-    recipient_until_timestamp=0,
+def get_accumulator(connection, account_address, token_address):
+    """[checkpoint_timestamp, inflow_rate, inflow_offset, outflow_rate,
+    outflow_offset, committed_outflow] of the wallet, a copy the caller may
+    change and pass to set_accumulators."""
+    account_id = get_account_id(connection, account_address)
+    token_id = get_account_id(connection, token_address)
+    if account_id is None or token_id is None:
+        return None
+    key = (account_id, token_id)
+    is_unit_of_work = isinstance(connection, Connection)
+    if is_unit_of_work and key in connection.accumulators:
+        return list(connection.accumulators[key])
+    cursor = connection.cursor()
+    cursor.execute(SELECT_ACCUMULATOR, key)
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+    accumulator = [row[0]] + [str_to_int(value) for value in row[1:]]
+    if is_unit_of_work:
+        connection.accumulators[key] = list(accumulator)
+    return accumulator
+
+
+def set_accumulators(connection, accumulators) -> None:
+    keyed = {
+        (
+            get_account_id(connection, account_address),
+            get_account_id(connection, token_address),
+        ): accumulator
+        for (account_address, token_address), accumulator in accumulators.items()
+    }
+    if isinstance(connection, Connection):
+        for key, accumulator in keyed.items():
+            connection.accumulators[key] = list(accumulator)
+            connection.dirty_accumulators[key] = None
+        return
+    cursor = connection.cursor()
+    cursor.executemany(
+        UPSERT_ACCUMULATOR,
+        [accumulator_row(*key, accumulator) for key, accumulator in keyed.items()],
+    )
+
+
+def get_wallet_stream_events(
+    connection, account_address, token_address, incoming, after_timestamp, until_timestamp
 ):
-    create_account_if_not_exists(connection, account_address)
-    create_token_if_not_exists(connection, token_address)
+    """Yields the (timestamp, rate, offset) events of the non accrued streams of a
+    wallet that happen in the (after_timestamp, until_timestamp] interval."""
+    column = "to_id" if incoming else "from_id"
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT start_timestamp, duration, amount, to_address
+        f"""
+        SELECT start_timestamp, duration, amount, 0
+        FROM stream
+        WHERE {column} = ? AND token_id = ? AND accrued = 0
+        AND start_timestamp > ? AND start_timestamp <= ?
+        UNION ALL
+        SELECT start_timestamp, duration, amount, 1
         FROM stream
-        WHERE (from_address = ? OR to_address = ?) AND token_address = ? AND accrued = 0
-        AND start_timestamp <= ?
+        WHERE {column} = ? AND token_id = ? AND accrued = 0
+        AND end_timestamp > ? AND end_timestamp <= ?
         """,
-        (account_address, account_address, token_address, until_timestamp),
+        (
+            get_account_id(connection, account_address),
+            get_account_id(connection, token_address),
+            after_timestamp,
+            until_timestamp,
+        )
+        * 2,
     )
 
-    for row in cursor:
-        start_timestamp, duration, amount, to_address = row
-        amount = int(amount)
-        is_recipient = to_address == account_address
-        effective_until = recipient_until_timestamp if is_recipient else until_timestamp
+    for start_timestamp, duration, amount, is_end in cursor:
+        yield stream_events(start_timestamp, duration, blob_to_int(amount))[is_end]
+
+
+def _fold_events(accumulator, events, incoming, sign, until_timestamp):
+    index = 1 if incoming else 3
+    for timestamp, rate, offset in events:
+        if timestamp <= until_timestamp:
+            accumulator[index] += sign * rate
+            accumulator[index + 1] += sign * (offset - rate * timestamp)
+
+
+def update_stream_accumulators(connection, signed_streams) -> None:
+    """Adds (sign 1) or removes (sign -1) the streams from the accumulators of
+    their sender and receiver. Only the events up to each accumulator checkpoint
+    are folded, later ones are picked up from the stream table when needed. The
+    whole amount is committed on the sender side right away."""
+    accumulators = {}
+    for stream, sign in signed_streams:
+        events = stream.events()
+        for account_address, incoming in (
+            (stream.to_address, True),
+            (stream.from_address, False),
+        ):
+            key = (account_address, stream.token_address)
+            if key not in accumulators:
+                accumulators[key] = get_accumulator(connection, *key) or [
+                    stream.start_timestamp,
+                    0,
+                    0,
+                    0,
+                    0,
+                    0,
+                ]
+            accumulator = accumulators[key]
+            _fold_events(accumulator, events, incoming, sign, accumulator[0])
+            if not incoming:
+                accumulator[5] += sign * int(stream.amount)
+
+    set_accumulators(connection, accumulators)
+
+
+def advance_accumulator(connection, account_address, token_address, timestamp):
+    """Moves the checkpoint of an accumulator, folding (or unfolding) the events
+    in between so that later reads around the timestamp are constant time."""
+    accumulator = get_accumulator(connection, account_address, token_address)
+    if accumulator is None or accumulator[0] == timestamp:
+        return
+
+    checkpoint = accumulator[0]
+    sign = 1 if timestamp > checkpoint else -1
+    (after_timestamp, until_timestamp) = sorted((checkpoint, timestamp))
+    for incoming in (True, False):
+        events = list(
+            get_wallet_stream_events(
+                connection,
+                account_address,
+                token_address,
+                incoming,
+                after_timestamp,
+                until_timestamp,
+            )
+        )
+        _fold_events(accumulator, events, incoming, sign, until_timestamp)
+    accumulator[0] = timestamp
+
+    set_accumulators(connection, {(account_address, token_address): accumulator})
+
+
+def _flow_at(connection, account_address, token_address, incoming, accumulator, timestamp):
+    index = 1 if incoming else 3
+    checkpoint = accumulator[0]
+    flow = accumulator[index] * timestamp + accumulator[index + 1]
+    if timestamp == checkpoint:
+        return flow
+
+    sign = 1 if timestamp > checkpoint else -1
+    (after_timestamp, until_timestamp) = sorted((checkpoint, timestamp))
+    for event_timestamp, rate, offset in get_wallet_stream_events(
+        connection,
+        account_address,
+        token_address,
+        incoming,
+        after_timestamp,
+        until_timestamp,
+    ):
+        flow += sign * (rate * (timestamp - event_timestamp) + offset)
+    return flow
+
+
+def get_wallet_streamed_amount(
+    connection,
+    account_address,
+    token_address,
+    until_timestamp,
+    recipient_until_timestamp=0,
+) -> int:
+    """Net amount streamed to the wallet by its non accrued streams. Received
+    amounts are rounded down and sent amounts up, so the sum over all wallets
+    never exceeds what the senders have streamed."""
+    accumulator = get_accumulator(connection, account_address, token_address)
+    if accumulator is None:
+        return 0
+
+    inflow = _flow_at(
+        connection,
+        account_address,
+        token_address,
+        True,
+        accumulator,
+        int(recipient_until_timestamp),
+    )
+    outflow = _flow_at(
+        connection,
+        account_address,
+        token_address,
+        False,
+        accumulator,
+        int(until_timestamp),
+    )
 
-        if effective_until < start_timestamp:
-            streamed_amount = 0
-        elif effective_until >= start_timestamp + duration:
-            streamed_amount = amount
-        else:
-            elapsed = effective_until - start_timestamp
-            streamed_amount = (amount * elapsed) // duration
+    return inflow // STREAM_RATE_PRECISION + (-outflow) // STREAM_RATE_PRECISION
+
+
+def get_wallet_uncommitted_amount(
+    connection, account_address, token_address, recipient_until_timestamp
+) -> int:
+    """Amount received by the wallet's non accrued streams until the timestamp
+    minus everything its non accrued streams will ever send."""
+    accumulator = get_accumulator(connection, account_address, token_address)
+    if accumulator is None:
+        return 0
+
+    inflow = _flow_at(
+        connection,
+        account_address,
+        token_address,
+        True,
+        accumulator,
+        int(recipient_until_timestamp),
+    )
 
-        yield (streamed_amount if is_recipient else -streamed_amount)
+    return inflow // STREAM_RATE_PRECISION - accumulator[5]
 
 
 def get_wallet_streams(connection, account_address, token_address) -> List[Stream]:
-    create_account_if_not_exists(connection, account_address)
-    create_token_if_not_exists(connection, token_address)
+    account_id = get_account_id(connection, account_address)
+    token_id = get_account_id(connection, token_address)
+    if account_id is None or token_id is None:
+        return []
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT * FROM stream
-        WHERE (from_address = ? OR to_address = ?) AND token_address = ?
-        """,
-        (account_address, account_address, token_address),
+        WALLET_STREAMS.format(
+            table="stream_history", columns=STREAM_COLUMNS, where="token_id = ?"
+        ),
+        (account_id, token_id, account_id, token_id, account_id),
     )
     rows = cursor.fetchall()
 
     streams = []
     for row in rows:
-        streams.append(stream_from_row(row))
+        streams.append(stream_from_row(connection, row))
 
     return streams
 
 
 def get_max_end_timestamp_for_wallet(connection, account_address):
-    create_account_if_not_exists(connection, account_address)
+    account_id = get_account_id(connection, account_address)
+    if account_id is None:
+        return 0
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT MAX(start_timestamp + duration)
-        FROM stream
-        WHERE (from_address = ? OR to_address = ?)
+        SELECT MAX(end_timestamp) FROM (
+            SELECT MAX(end_timestamp) AS end_timestamp FROM stream WHERE from_id = ?
+            UNION ALL
+            SELECT MAX(end_timestamp) AS end_timestamp FROM stream WHERE to_id = ?
+            UNION ALL
+            SELECT MAX(end_timestamp) FROM stream_archive WHERE from_id = ?
+            UNION ALL
+            SELECT MAX(end_timestamp) FROM stream_archive WHERE to_id = ?
+        )
         """,
-        (account_address, account_address),
+        (account_id,) * 4,
     )
 
     result = cursor.fetchone()
@@ -158,21 +923,25 @@ def get_max_end_timestamp_for_wallet(connection, account_address):
 def get_wallet_endend_streams(
     connection, account_address, token_address, current_timestamp
 ) -> List[Stream]:
-    create_account_if_not_exists(connection, account_address)
-    create_token_if_not_exists(connection, token_address)
+    account_id = get_account_id(connection, account_address)
+    token_id = get_account_id(connection, token_address)
+    if account_id is None or token_id is None:
+        return []
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT * FROM stream
-        WHERE (from_address = ? OR to_address = ?) AND token_address = ? AND start_timestamp + duration <= ? AND accrued = 0 AND swap_id IS NULL
-        """,
-        (account_address, account_address, token_address, current_timestamp),
+        WALLET_STREAMS.format(
+            table="stream",
+            columns=STREAM_COLUMNS,
+            where="token_id = ? AND end_timestamp <= ? AND accrued = 0 AND swap_id IS NULL",
+        ),
+        (account_id, token_id, current_timestamp)
+        + (account_id, token_id, current_timestamp, account_id),
     )
     rows = cursor.fetchall()
 
     streams = []
     for row in rows:
-        streams.append(stream_from_row(row))
+        streams.append(stream_from_row(connection, row))
 
     return streams
 
@@ -180,8 +949,8 @@ def get_wallet_endend_streams(
 def get_stream_by_id(connection, stream_id) -> Stream:
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT * FROM stream
+        f"""
+        SELECT {STREAM_COLUMNS} FROM stream_history
         WHERE id = ?
         """,
         (stream_id,),
@@ -189,70 +958,151 @@ def get_stream_by_id(connection, stream_id) -> Stream:
     row = cursor.fetchone()
 
     if row is not None:
-        return stream_from_row(row)
+        return stream_from_row(connection, row)
     else:
         return None
 
 
-def get_balance(connection, account_address, token_address) -> int:
-    create_account_if_not_exists(connection, account_address)
-    create_token_if_not_exists(connection, token_address)
+def get_streams_by_ids(connection, stream_ids) -> dict:
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT amount FROM balance
-        WHERE account_address = ? AND token_address = ?
+        f"""
+        SELECT {STREAM_COLUMNS} FROM stream
+        WHERE id IN ({",".join("?" * len(stream_ids))})
         """,
-        (account_address, token_address),
+        tuple(stream_ids),
     )
+
+    return {row[0]: stream_from_row(connection, row) for row in cursor.fetchall()}
+
+
+def get_balance(connection, account_address, token_address) -> int:
+    account_id = get_account_id(connection, account_address)
+    token_id = get_account_id(connection, token_address)
+    if account_id is None or token_id is None:
+        return 0
+    key = (account_id, token_id)
+    is_unit_of_work = isinstance(connection, Connection)
+    if is_unit_of_work and key in connection.balances:
+        return connection.balances[key]
+    cursor = connection.cursor()
+    cursor.execute(SELECT_BALANCE, key)
     row = cursor.fetchone()
 
-    return str_to_int(row[0]) if row else 0
+    amount = blob_to_int(row[0]) if row else 0
+    if is_unit_of_work:
+        connection.balances[key] = amount
+    return amount
 
 
 def set_balance(connection, account_address, token_address, amount) -> None:
-    create_account_if_not_exists(connection, account_address)
-    create_token_if_not_exists(connection, token_address)
+    account_id = create_account_if_not_exists(connection, account_address)
+    token_id = create_token_if_not_exists(connection, token_address)
+    key = (account_id, token_id)
+    if isinstance(connection, Connection):
+        connection.balances[key] = amount
+        connection.dirty_balances[key] = None
+        return
     cursor = connection.cursor()
-    cursor.execute(
-        """
-        INSERT INTO balance (account_address, token_address, amount)
-        VALUES (?, ?, ?)
-        ON CONFLICT(account_address, token_address)
-        DO UPDATE SET amount = EXCLUDED.amount
-        """,
-        (account_address, token_address, int_to_str(amount)),
+    cursor.execute(UPSERT_BALANCE, (*key, int_to_blob(amount)))
+
+
+def add_to_balances(connection, token_address, deltas) -> None:
+    """Adds the amounts of deltas, keyed by account address, to the balances of
+    the token. Balances missing from the unit of work are read with one SELECT
+    and all of them are written with one bulk upsert."""
+    token_id = create_token_if_not_exists(connection, token_address)
+    deltas = {
+        (create_account_if_not_exists(connection, address), token_id): delta
+        for address, delta in deltas.items()
+    }
+    is_unit_of_work = isinstance(connection, Connection)
+    balances = {
+        key: connection.balances[key]
+        for key in deltas
+        if is_unit_of_work and key in connection.balances
+    }
+    missing = [account_id for (account_id, _) in deltas.keys() - balances.keys()]
+    if missing:
+        cursor = connection.cursor()
+        cursor.execute(
+            f"""
+            SELECT account_id, amount FROM balance
+            WHERE token_id = ? AND account_id IN ({",".join("?" * len(missing))})
+            """,
+            (token_id, *missing),
+        )
+        stored = dict(cursor.fetchall())
+        for account_id in missing:
+            amount = stored.get(account_id)
+            balances[(account_id, token_id)] = blob_to_int(amount) if amount else 0
+
+    if is_unit_of_work:
+        for key, delta in deltas.items():
+            connection.balances[key] = balances[key] + delta
+            connection.dirty_balances[key] = None
+        return
+    cursor = connection.cursor()
+    cursor.executemany(
+        UPSERT_BALANCE,
+        [(*key, int_to_blob(balances[key] + delta)) for key, delta in deltas.items()],
     )
 
 
 def add_stream(connection, stream) -> int:
-    create_account_if_not_exists(connection, stream.from_address)
-    create_account_if_not_exists(connection, stream.to_address)
-    create_token_if_not_exists(connection, stream.token_address)
     # if stream.pair_address is not None:
     #     create_token_if_not_exists(connection, stream.pair_address)
     cursor = connection.cursor()
     cursor.execute(
         """
-        INSERT INTO stream (from_address, to_address, start_timestamp, duration, amount, token_address, accrued, swap_id)
+        INSERT INTO stream (from_id, to_id, start_timestamp, duration, amount, token_id, accrued, swap_id)
         VALUES (?, ?, ?, ?, ?, ?, ?, ?)
         """,
         (
-            stream.from_address,
-            stream.to_address,
+            create_account_if_not_exists(connection, stream.from_address),
+            create_account_if_not_exists(connection, stream.to_address),
             stream.start_timestamp,
             stream.duration,
-            int_to_str(stream.amount),
-            stream.token_address,
+            int_to_blob(stream.amount),
+            create_token_if_not_exists(connection, stream.token_address),
             1 if stream.accrued else 0,
             stream.swap_id,
         ),
     )
+    if not stream.accrued:
+        update_stream_accumulators(connection, [(stream, 1)])
 
     return cursor.lastrowid
 
 
+def _get_updated_streams(connection, stream_durations_amounts_ids):
+    old_streams = get_streams_by_ids(
+        connection, [stream_id for _, _, stream_id in stream_durations_amounts_ids]
+    )
+    signed_streams = []
+    for duration, amount, stream_id in stream_durations_amounts_ids:
+        old_stream = old_streams.get(stream_id)
+        if old_stream is None or old_stream.accrued:
+            continue
+        new_stream = Stream(
+            stream_id=stream_id,
+            from_address=old_stream.from_address,
+            to_address=old_stream.to_address,
+            start_timestamp=old_stream.start_timestamp,
+            duration=duration,
+            amount=amount,
+            token_address=old_stream.token_address,
+            accrued=False,
+            swap_id=old_stream.swap_id,
+        )
+        signed_streams += [(old_stream, -1), (new_stream, 1)]
+    return signed_streams
+
+
 def update_stream_amount_duration(connection, stream_id, duration, amount):
+    update_stream_accumulators(
+        connection, _get_updated_streams(connection, [(duration, amount, stream_id)])
+    )
     cursor = connection.cursor()
     cursor.execute(
         """
@@ -260,11 +1110,14 @@ def update_stream_amount_duration(connection, stream_id, duration, amount):
         SET duration = ?, amount = ?
         WHERE id = ?
         """,
-        (duration, int_to_str(amount), stream_id),
+        (duration, int_to_blob(amount), stream_id),
     )
 
 
 def update_stream_amount_duration_batch(connection, stream_durations_amounts_ids):
+    update_stream_accumulators(
+        connection, _get_updated_streams(connection, stream_durations_amounts_ids)
+    )
     cursor = connection.cursor()
     cursor.executemany(
         """
@@ -272,12 +1125,18 @@ def update_stream_amount_duration_batch(connection, stream_durations_amounts_ids
         SET duration = ?, amount = ?
         WHERE id = ?
         """,
-        stream_durations_amounts_ids,
+        [
+            (duration, int_to_blob(amount), stream_id)
+            for duration, amount, stream_id in stream_durations_amounts_ids
+        ],
     )
     return cursor.lastrowid
 
 
 def update_stream_accrued(connection, stream_id, accrued):
+    stream = get_stream_by_id(connection, stream_id)
+    if stream is not None and stream.accrued != accrued:
+        update_stream_accumulators(connection, [(stream, -1 if accrued else 1)])
     cursor = connection.cursor()
     cursor.execute(
         """
@@ -289,61 +1148,91 @@ def update_stream_accrued(connection, stream_id, accrued):
     )
 
 
-def delete_stream_by_id(connection, stream_id):
+def set_streams_accrued(connection, streams) -> None:
+    """Takes the non accrued streams out of the accumulators and marks them
+    accrued with one UPDATE."""
+    streams = [stream for stream in streams if not stream.accrued]
+    if not streams:
+        return
+    update_stream_accumulators(connection, [(stream, -1) for stream in streams])
     cursor = connection.cursor()
     cursor.execute(
-        """
-        DELETE FROM stream
-        WHERE id = ?
+        f"""
+        UPDATE stream
+        SET accrued = 1
+        WHERE id IN ({",".join("?" * len(streams))})
         """,
-        (stream_id,),
+        tuple(stream.id for stream in streams),
     )
 
 
-def get_total_supply(connection, token_address) -> int:
-    create_token_if_not_exists(connection, token_address)
+def archive_streams(connection, stream_ids=None):
+    """Moves the accrued streams, all of them or those in stream_ids, from stream
+    to stream_archive so the stream table and its indexes only hold the active
+    and pending streams."""
+    where = "accrued = 1"
+    params = ()
+    if stream_ids is not None:
+        if not stream_ids:
+            return
+        where += f" AND id IN ({','.join('?' * len(stream_ids))})"
+        params = tuple(stream_ids)
     cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT total_supply FROM token
-        WHERE address = ?
+        f"""
+        INSERT INTO stream_archive ({ARCHIVED_STREAM_COLUMNS})
+        SELECT {ARCHIVED_STREAM_COLUMNS} FROM stream
+        WHERE {where}
         """,
-        (token_address,),
+        params,
     )
-    row = cursor.fetchone()
-
-    return str_to_int(row[0]) if row else 0
+    cursor.execute(f"DELETE FROM stream WHERE {where}", params)
 
 
-def set_total_supply(connection, token_address: str, total_supply: int):
-    create_token_if_not_exists(connection, token_address)
+def delete_stream_by_id(connection, stream_id):
+    stream = get_stream_by_id(connection, stream_id)
+    if stream is not None and not stream.accrued:
+        update_stream_accumulators(connection, [(stream, -1)])
     cursor = connection.cursor()
+    # The swap of a cancelled order keeps its row but no longer references the stream
+    for column in ("to_pair_stream_id", "from_pair_stream_id"):
+        cursor.execute(
+            f"UPDATE swap SET {column} = NULL WHERE {column} = ?", (stream_id,)
+        )
     cursor.execute(
         """
-        INSERT INTO token (address, total_supply)
-        VALUES (?, ?)
-        ON CONFLICT(address)
-        DO UPDATE SET total_supply = ?
+        DELETE FROM stream
+        WHERE id = ?
         """,
-        (token_address, int_to_str(total_supply), int_to_str(total_supply)),
+        (stream_id,),
     )
 
 
-def set_last_timestamp_processed(
-    connection, pair_address: str, last_timestamp_processed: int
-):
+def get_total_supply(connection, token_address) -> int:
+    token_id = get_account_id(connection, token_address)
+    if token_id is None:
+        return 0
+    is_unit_of_work = isinstance(connection, Connection)
+    if is_unit_of_work and token_id in connection.total_supplies:
+        return connection.total_supplies[token_id]
     cursor = connection.cursor()
-    cursor.execute(
-        """
-        UPDATE pair
-        SET last_timestamp_processed = ?
-        WHERE address = ?
-        """,
-        (
-            last_timestamp_processed,
-            pair_address,
-        ),
-    )
+    cursor.execute(SELECT_TOTAL_SUPPLY, (token_id,))
+    row = cursor.fetchone()
+
+    total_supply = blob_to_int(row[0]) if row else 0
+    if is_unit_of_work:
+        connection.total_supplies[token_id] = total_supply
+    return total_supply
+
+
+def set_total_supply(connection, token_address: str, total_supply: int):
+    token_id = create_token_if_not_exists(connection, token_address)
+    if isinstance(connection, Connection):
+        connection.total_supplies[token_id] = total_supply
+        connection.dirty_total_supplies[token_id] = None
+        return
+    cursor = connection.cursor()
+    cursor.execute(UPSERT_TOTAL_SUPPLY, (token_id, int_to_blob(total_supply)))
 
 
 # Test only
@@ -355,21 +1244,21 @@ def stream_test(payload, sender, start_timestamp, connection):
     receiver_checksum = to_checksum_address(payload["args"]["receiver"])
     token_checksum = to_checksum_address(payload["args"]["token"])
 
-    create_account_if_not_exists(connection, sender_checksum)
-    create_account_if_not_exists(connection, receiver_checksum)
-    create_token_if_not_exists(connection, token_checksum)
+    sender_id = create_account_if_not_exists(connection, sender_checksum)
+    receiver_id = create_account_if_not_exists(connection, receiver_checksum)
+    token_id = create_token_if_not_exists(connection, token_checksum)
     stream_data = []
-    amt = str(int(split_amount))
+    amt = int_to_blob(split_amount)
     duration = int(payload["args"]["duration"])
     for number in range(split_number):
         stream_data.append(
             (
-                sender_checksum,
-                receiver_checksum,
+                sender_id,
+                receiver_id,
                 start_timestamp,
                 duration + number,
                 amt,
-                token_checksum,
+                token_id,
                 0,
                 None,
             )
@@ -378,87 +1267,268 @@ def stream_test(payload, sender, start_timestamp, connection):
     cursor = connection.cursor()
     cursor.executemany(
         """
-                INSERT INTO stream (from_address, to_address, start_timestamp, duration, amount, token_address, accrued, swap_id)
+                INSERT INTO stream (from_id, to_id, start_timestamp, duration, amount, token_id, accrued, swap_id)
                 VALUES (?, ?, ?, ?, ?, ?, ?, ?)
                 """,
         stream_data,
     )
+    update_stream_accumulators(
+        connection,
+        [
+            (
+                Stream(
+                    stream_id=None,
+                    from_address=sender_checksum,
+                    to_address=receiver_checksum,
+                    start_timestamp=start,
+                    duration=stream_duration,
+                    amount=blob_to_int(stream_amount),
+                    token_address=token_checksum,
+                    accrued=False,
+                ),
+                1,
+            )
+            for (
+                _,
+                _,
+                start,
+                stream_duration,
+                stream_amount,
+                _,
+                _,
+                _,
+            ) in stream_data
+        ],
+    )
+
 
+def get_last_timestamp_processed(connection, pair_id, stored_timestamp):
+    """last_timestamp_processed of the pair as changed in the unit of work, or
+    the stored one. Pairs only move forward, so it is never before the stored
+    one and queries filtering on the stored one return a superset."""
+    if isinstance(connection, Connection) and pair_id in connection.pair_pools:
+        return connection.pair_pools[pair_id]["last_timestamp_processed"]
+    return stored_timestamp
 
-def get_updatable_pairs(connection, wallet_address, token_address, start_timestamp):
+
+def get_wallet_pairs(connection, wallet_address):
+    """Pairs where the wallet has orders that have not been fully settled."""
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT DISTINCT s.pair_address, p.token_0_address, p.token_1_address, p.last_timestamp_processed
+        SELECT s.pair_id, MAX(s.end_timestamp), p.last_timestamp_processed
         FROM swap s
-        JOIN stream st ON s.id = st.swap_id
-        JOIN pair p ON s.pair_address = p.address
-        WHERE st.to_address = ? AND st.accrued = 0 
-        AND p.token_0_address == ? OR p.token_1_address == ?
-        AND st.start_timestamp <= ?
+        JOIN pair p ON s.pair_id = p.id
+        WHERE s.owner_id = ? AND s.end_timestamp > p.last_timestamp_processed
+        GROUP BY s.pair_id
         """,
-        (
-            wallet_address,
-            token_address,
-            token_address,
-            start_timestamp,
-        ),
+        (get_account_id(connection, wallet_address),),
     )
-    return cursor.fetchall()
+    return [
+        get_account_address(connection, pair_id)
+        for (pair_id, end_timestamp, last_timestamp_processed) in cursor.fetchall()
+        if end_timestamp
+        > get_last_timestamp_processed(connection, pair_id, last_timestamp_processed)
+    ]
+
+
+def get_pair_next_event_timestamp(connection, pair_address, after_timestamp):
+    cursor = connection.cursor()
+    cursor.execute(
+        """
+        SELECT MIN(timestamp) FROM (
+            SELECT MIN(start_timestamp) AS timestamp
+            FROM swap
+            WHERE pair_id = ? AND start_timestamp > ?
+            AND end_timestamp > start_timestamp
+            UNION ALL
+            SELECT MIN(end_timestamp) AS timestamp
+            FROM swap
+            WHERE pair_id = ? AND end_timestamp > ?
+        )
+        """,
+        (get_account_id(connection, pair_address), after_timestamp) * 2,
+    )
+    return cursor.fetchone()[0]
 
 
 def get_wallet_token_streamed(connection, wallet_address):
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT DISTINCT token_address
-        FROM stream
-        WHERE from_address = ? OR to_address = ?
+        SELECT token_id FROM stream_history WHERE from_id = ?
+        UNION
+        SELECT token_id FROM stream_history WHERE to_id = ?
         """,
-        (
-            wallet_address,
-            wallet_address,
-        ),
+        (get_account_id(connection, wallet_address),) * 2,
     )
-    return cursor.fetchall()
+    return [(get_account_address(connection, row[0]),) for row in cursor.fetchall()]
+
+
+def get_pair_pool(connection, pair_address: str):
+    """Order pool of the pair, a copy the caller may change and pass to
+    set_pair_pool."""
+    pair_id = get_account_id(connection, pair_address)
+    is_unit_of_work = isinstance(connection, Connection)
+    if is_unit_of_work and pair_id in connection.pair_pools:
+        return copy_pair_pool(connection.pair_pools[pair_id])
+    cursor = connection.cursor()
+    cursor.execute(SELECT_PAIR_POOL, (pair_id,))
+    row = cursor.fetchone()
 
+    if row is None:
+        return None
+    pool = {
+        "token_addresses": [
+            get_account_address(connection, row[0]),
+            get_account_address(connection, row[1]),
+        ],
+        "last_timestamp_processed": row[2],
+        "sell_rates": [str_to_int(row[3]), str_to_int(row[4])],
+        "earnings_per_rate": [str_to_int(row[5]), str_to_int(row[6])],
+        "reserves": [blob_to_int(row[7]), blob_to_int(row[8])],
+        "next_event_timestamp": row[9],
+    }
+    if is_unit_of_work:
+        connection.pair_pools[pair_id] = copy_pair_pool(pool)
+    return pool
+
+
+def set_pair_pool(connection, pair_address: str, pool) -> None:
+    pair_id = get_account_id(connection, pair_address)
+    if isinstance(connection, Connection):
+        connection.pair_pools[pair_id] = copy_pair_pool(pool)
+        connection.dirty_pair_pools[pair_id] = None
+        return
+    cursor = connection.cursor()
+    cursor.execute(UPDATE_PAIR_POOL, pair_pool_row(pair_id, pool))
+
+
+ORDER_COLUMNS = """
+    s.id,
+    s.pair_id,
+    s.start_timestamp,
+    s.end_timestamp,
+    s.rate,
+    s.token_in_id,
+    s.from_pair_stream_id,
+    s.owner_id,
+    st_from_pair.amount,
+    s.earnings_checkpoint
+"""
+
+ORDER_JOINS = """
+    swap s
+    JOIN stream st_from_pair ON st_from_pair.id = s.from_pair_stream_id
+"""
+
+
+def order_from_row(connection, row) -> dict:
+    (
+        swap_id,
+        pair_id,
+        start_timestamp,
+        end_timestamp,
+        rate,
+        token_in_id,
+        payout_stream_id,
+        payout_id,
+        payout_amount,
+        earnings_checkpoint,
+    ) = row
+    return {
+        "id": swap_id,
+        "pair_address": get_account_address(connection, pair_id),
+        "start": start_timestamp,
+        "end": end_timestamp,
+        "rate": str_to_int(rate),
+        "token_in_address": get_account_address(connection, token_in_id),
+        "payout_stream_id": payout_stream_id,
+        "payout_address": get_account_address(connection, payout_id),
+        "payout_amount": blob_to_int(payout_amount),
+        "earnings_checkpoint": None
+        if earnings_checkpoint is None
+        else str_to_int(earnings_checkpoint),
+    }
+
+
+def get_order(connection, swap_id: int):
+    cursor = connection.cursor()
+    cursor.execute(
+        f"""
+        SELECT {ORDER_COLUMNS}
+        FROM {ORDER_JOINS}
+        WHERE s.id = ? AND s.end_timestamp > s.start_timestamp
+        """,
+        (swap_id,),
+    )
+    row = cursor.fetchone()
+
+    return order_from_row(connection, row) if row else None
 
-def get_swaps_for_pair_address(connection, pair_address: str, to_timestamp: int):
+
+def get_pair_orders_between(
+    connection, pair_address: str, after_timestamp: int, until_timestamp: int
+):
+    """Orders of the pair that start or end in the (after_timestamp, until_timestamp] interval."""
     cursor = connection.cursor()
+    cursor.execute(
+        f"""
+        SELECT {ORDER_COLUMNS}
+        FROM {ORDER_JOINS}
+        WHERE s.pair_id = ? AND s.start_timestamp > ? AND s.start_timestamp <= ?
+        AND s.end_timestamp > s.start_timestamp
+        UNION
+        SELECT {ORDER_COLUMNS}
+        FROM {ORDER_JOINS}
+        WHERE s.pair_id = ? AND s.end_timestamp > ? AND s.end_timestamp <= ?
+        AND s.end_timestamp > s.start_timestamp
+        """,
+        (get_account_id(connection, pair_address), after_timestamp, until_timestamp)
+        * 2,
+    )
+
+    return [order_from_row(connection, row) for row in cursor.fetchall()]
+
 
+def get_wallet_open_orders(connection, wallet_address: str):
+    """Orders paying out to the wallet that are in their pool at the time the
+    pair was last processed."""
+    # Orders starting after the stored timestamp may have entered their pool in
+    # the unit of work, so the start is compared with its timestamp below
+    cursor = connection.cursor()
     cursor.execute(
-        """
-        SELECT 
-            st_from_pair.id AS from_pair_id,
-            st_from_pair.amount AS from_pair_amount,
-            st_from_pair.duration AS from_pair_duration,
-            st_to_pair.amount AS to_pair_amount, 
-            st_to_pair.start_timestamp AS to_pair_start_timestamp,
-            st_to_pair.duration AS to_pair_duration,
-            st_to_pair.token_address AS to_pair_token_address
-        FROM 
-            swap s
-        JOIN 
-            stream st_to_pair ON s.id = st_to_pair.swap_id
-        JOIN 
-            stream st_from_pair ON s.id = st_from_pair.swap_id
-        WHERE 
-            s.pair_address = ?
-        AND 
-            to_pair_start_timestamp <= ? -- Have started
-        AND 
-            from_pair_duration != to_pair_duration -- Have not been completly processed
-        AND 
-            st_to_pair.to_address = ? AND st_from_pair.from_address = ? -- Match pair address
-        AND
-            to_pair_duration > 0 -- Are not classic swaps
+        f"""
+        SELECT {ORDER_COLUMNS}, p.last_timestamp_processed
+        FROM {ORDER_JOINS}
+        JOIN pair p ON s.pair_id = p.id
+        WHERE s.owner_id = ? AND s.earnings_checkpoint IS NOT NULL
+        AND s.end_timestamp > p.last_timestamp_processed
         """,
-        (
-            pair_address,
-            to_timestamp,
-            pair_address,
-            pair_address,
-        ),
+        (get_account_id(connection, wallet_address),),
     )
 
-    return cursor.fetchall()
+    orders = []
+    for row in cursor.fetchall():
+        order = order_from_row(connection, row[:-1])
+        last_timestamp_processed = get_last_timestamp_processed(
+            connection, row[1], row[-1]
+        )
+        if order["start"] <= last_timestamp_processed < order["end"]:
+            orders.append(order)
+    return orders
+
+
+def set_swap_earnings_checkpoints(connection, checkpoints_ids) -> None:
+    cursor = connection.cursor()
+    cursor.executemany(
+        """
+        UPDATE swap
+        SET earnings_checkpoint = ?
+        WHERE id = ?
+        """,
+        [
+            (int_to_str(checkpoint), swap_id)
+            for checkpoint, swap_id in checkpoints_ids
+        ],
+    )
@@ -1,130 +1,262 @@
 from dapp.db import (
-    get_swaps_for_pair_address,
-    get_updatable_pairs,
-    set_last_timestamp_processed,
+    get_order,
+    get_pair_next_event_timestamp,
+    get_pair_orders_between,
+    get_pair_pool,
+    get_wallet_open_orders,
+    get_wallet_pairs,
+    set_pair_pool,
+    set_swap_earnings_checkpoints,
+    set_swap_end_timestamp,
     update_stream_amount_duration_batch,
 )
-from dapp.util import get_amount_out, int_to_str, str_to_int, with_checksum_address
+from dapp.util import (
+    EARNINGS_PRECISION,
+    get_amount_out,
+    with_checksum_address,
+)
 
+# Order pool events, orders enter the pool when they start and leave it when they end
+ENTER = 0
+LEAVE = 1
+
+
+def execute_pool(pool, increment):
+    """
+    Swaps what both directions of the pool sell during the increment against the
+    reserves and adds the amounts out to the earnings per unit of sell rate of
+    each direction. The earnings are rounded down, so each execution pays the
+    orders of a direction less than rate / EARNINGS_PRECISION wei below their
+    exact share of the amount out, and never more than the amount out.
+    """
+    (token_0_in_sum, token_1_in_sum) = [
+        increment * sell_rate for sell_rate in pool["sell_rates"]
+    ]
+    reserves = pool["reserves"]
+    (reserve_in, reserve_out) = reserves
+
+    amount_out_token_1 = (
+        get_amount_out(token_0_in_sum, reserve_in, reserve_out)
+        if token_0_in_sum != 0
+        else 0
+    )
+    amount_out_token_0 = (
+        get_amount_out(token_1_in_sum, reserve_out, reserve_in)
+        if token_1_in_sum != 0
+        else 0
+    )
+
+    # Check k
+    k_before = reserve_in * reserve_out
+    k_after = (reserve_in + token_0_in_sum - amount_out_token_0) * (
+        reserve_out + token_1_in_sum - amount_out_token_1
+    )
+    assert k_after >= k_before, "AMM: K"
+
+    # Direction 0 is paid in token 1 and direction 1 in token 0
+    for direction, amount_out in enumerate((amount_out_token_1, amount_out_token_0)):
+        sell_rate = pool["sell_rates"][direction]
+        if sell_rate > 0:
+            pool["earnings_per_rate"][direction] += (
+                amount_out * EARNINGS_PRECISION // sell_rate
+            )
+
+    reserves[0] += token_0_in_sum - amount_out_token_0
+    reserves[1] += token_1_in_sum - amount_out_token_1
 
-@with_checksum_address
-def hook(connection, token_address, wallet, to_timestamp):
-    from dapp.streamabletoken import StreamableToken
 
-    updatable_pairs = get_updatable_pairs(
-        connection, wallet, token_address, to_timestamp
+def settle_order(pool, order, timestamp, payout_updates, checkpoints):
+    """Adds what the order has earned since its checkpoint to its payout stream.
+
+    The payout is rounded down, less than 1 wei per settlement. Together with the
+    rounding of execute_pool, an order is paid at most its exact share of the
+    amounts out, and less than settlements + executions * rate / EARNINGS_PRECISION
+    wei below it, under 1 wei per settlement and per execution for rates below
+    EARNINGS_PRECISION. The payouts of a pool never exceed its amounts out."""
+    direction = order["direction"]
+    earnings_per_rate = pool["earnings_per_rate"][direction]
+    payout = (
+        order["rate"]
+        * (earnings_per_rate - order["earnings_checkpoint"])
+        // EARNINGS_PRECISION
     )
-    for (
-        pair_address,
-        token_0_address,
-        token_1_address,
-        last_timestamp_processed,
-    ) in updatable_pairs:
-        (reserve_in, reserve_out) = (
-            StreamableToken(connection, token_0_address).balance_of(
-                pair_address, last_timestamp_processed
-            ),
-            StreamableToken(connection, token_1_address).balance_of(
-                pair_address, last_timestamp_processed
-            ),
+    order["payout_amount"] += payout
+    order["earnings_checkpoint"] = earnings_per_rate
+
+    payout_updates[order["payout_stream_id"]] = [
+        timestamp - order["start"],
+        order["payout_amount"],
+        order["payout_stream_id"],
+    ]
+    checkpoints[order["id"]] = earnings_per_rate
+
+
+def save_pool(connection, pair_address, pool, payout_updates, checkpoints):
+    set_pair_pool(connection, pair_address, pool)
+    if checkpoints:
+        set_swap_earnings_checkpoints(
+            connection,
+            [(checkpoint, swap_id) for swap_id, checkpoint in checkpoints.items()],
         )
+    if payout_updates:
+        update_stream_amount_duration_batch(connection, list(payout_updates.values()))
+
+
+def set_order_direction(pool, order):
+    order["direction"] = (
+        0 if order["token_in_address"] == pool["token_addresses"][0] else 1
+    )
+    return order
+
+
+def advance_pair(connection, pair_address, to_timestamp):
+    """
+    Moves the order pool of the pair to to_timestamp. Only the orders starting
+    or ending in between are touched, running orders keep earning through the
+    earnings per unit of sell rate and are settled when they end or are read.
+    Pairs already at to_timestamp are skipped and pairs without order events
+    before to_timestamp only run their current sell rates.
+    """
+    pool = get_pair_pool(connection, pair_address)
+    if pool is None or to_timestamp <= pool["last_timestamp_processed"]:
+        return pool
+
+    last_timestamp_processed = pool["last_timestamp_processed"]
+    next_event_timestamp = pool["next_event_timestamp"]
+    if next_event_timestamp is None or next_event_timestamp > to_timestamp:
+        if any(pool["sell_rates"]):
+            execute_pool(pool, to_timestamp - last_timestamp_processed)
+        pool["last_timestamp_processed"] = to_timestamp
+        set_pair_pool(connection, pair_address, pool)
+        return pool
+
+    events = []
+    for order in get_pair_orders_between(
+        connection, pair_address, last_timestamp_processed, to_timestamp
+    ):
+        set_order_direction(pool, order)
+        if order["start"] > last_timestamp_processed:
+            events.append((order["start"], ENTER, order))
+        if order["end"] <= to_timestamp:
+            events.append((order["end"], LEAVE, order))
+
+    payout_updates = {}
+    checkpoints = {}
+    if events or any(pool["sell_rates"]):
+        prev_timestamp = last_timestamp_processed
+        for timestamp, kind, order in sorted(events, key=lambda event: event[:2]):
+            if timestamp > prev_timestamp:
+                execute_pool(pool, timestamp - prev_timestamp)
+                prev_timestamp = timestamp
+
+            direction = order["direction"]
+            if kind == ENTER:
+                order["earnings_checkpoint"] = pool["earnings_per_rate"][direction]
+                checkpoints[order["id"]] = order["earnings_checkpoint"]
+                pool["sell_rates"][direction] += order["rate"]
+            elif order["earnings_checkpoint"] is not None:
+                settle_order(pool, order, timestamp, payout_updates, checkpoints)
+                pool["sell_rates"][direction] -= order["rate"]
+
+        if to_timestamp > prev_timestamp:
+            execute_pool(pool, to_timestamp - prev_timestamp)
+
+    pool["last_timestamp_processed"] = to_timestamp
+    pool["next_event_timestamp"] = get_pair_next_event_timestamp(
+        connection, pair_address, to_timestamp
+    )
+    save_pool(connection, pair_address, pool, payout_updates, checkpoints)
+
+    return pool
+
+
+def schedule_event(pool, timestamp):
+    if pool["next_event_timestamp"] is None or timestamp < pool["next_event_timestamp"]:
+        pool["next_event_timestamp"] = timestamp
+
+
+def open_order(connection, swap_id):
+    """Enters a new order in its pool if it starts at the pair's current timestamp,
+    later starts are picked up when the pair is advanced past them."""
+    order = get_order(connection, swap_id)
+    if order is None:
+        return
+    pool = get_pair_pool(connection, order["pair_address"])
+    if order["start"] > pool["last_timestamp_processed"]:
+        schedule_event(pool, order["start"])
+        set_pair_pool(connection, order["pair_address"], pool)
+        return
+
+    set_order_direction(pool, order)
+    pool["sell_rates"][order["direction"]] += order["rate"]
+    schedule_event(pool, order["end"])
+    save_pool(
+        connection,
+        order["pair_address"],
+        pool,
+        {},
+        {swap_id: pool["earnings_per_rate"][order["direction"]]},
+    )
+
+
+def close_order(connection, swap_id, timestamp):
+    """Settles a running order and takes it out of its pool, used when its
+    stream to the pair is cancelled."""
+    order = get_order(connection, swap_id)
+    if order is None:
+        return
+    pool = advance_pair(connection, order["pair_address"], timestamp)
+    order = get_order(connection, swap_id)
+    set_swap_end_timestamp(connection, swap_id, min(order["end"], timestamp))
+    if (
+        order["earnings_checkpoint"] is None
+        or order["start"] > pool["last_timestamp_processed"]
+        or order["end"] <= pool["last_timestamp_processed"]
+    ):
+        return
+
+    set_order_direction(pool, order)
+    payout_updates = {}
+    checkpoints = {}
+    settle_order(
+        pool, order, pool["last_timestamp_processed"], payout_updates, checkpoints
+    )
+    pool["sell_rates"][order["direction"]] -= order["rate"]
+    save_pool(connection, order["pair_address"], pool, payout_updates, checkpoints)
+
+
+def settle_wallet_orders(connection, wallet):
+    """Writes what the running orders of the wallet have earned until their pair
+    was last processed to their payout streams."""
+    orders_by_pair = {}
+    for order in get_wallet_open_orders(connection, wallet):
+        orders_by_pair.setdefault(order["pair_address"], []).append(order)
+
+    for pair_address, orders in orders_by_pair.items():
+        pool = get_pair_pool(connection, pair_address)
+        payout_updates = {}
+        checkpoints = {}
+        for order in orders:
+            set_order_direction(pool, order)
+            settle_order(
+                pool,
+                order,
+                pool["last_timestamp_processed"],
+                payout_updates,
+                checkpoints,
+            )
+        save_pool(connection, pair_address, pool, payout_updates, checkpoints)
+
+
+@with_checksum_address
+def hook(connection, token_address, wallet, to_timestamp):
+    """Brings the pairs where the wallet has open orders to to_timestamp and
+    settles the wallet's orders, wallets without orders only pay one lookup."""
+    wallet_pairs = get_wallet_pairs(connection, wallet)
+    if not wallet_pairs:
+        return
+
+    for pair_address in wallet_pairs:
+        advance_pair(connection, pair_address, to_timestamp)
 
-        swaps = get_swaps_for_pair_address(connection, pair_address, to_timestamp)
-
-        # Add swap rate to swaps
-        swaps = [
-            swap + ((str_to_int(swap[3]) // swap[5],) if swap[5] > 0 else (0,))
-            for swap in swaps
-        ]
-
-        if swaps:
-            streams_to_update = {
-                swap[0]: {"amount": str_to_int(swap[1]), "duration": swap[2]}
-                for swap in swaps
-            }
-
-            points = set()
-            for swap in swaps:
-                if swap[4] + swap[2] <= to_timestamp:
-                    points.add(
-                        swap[4] + swap[2]
-                    )  # payout stream processed until this point
-                if swap[4] + swap[5] <= to_timestamp:
-                    points.add(swap[4] + swap[5])  # swap lasts until this point
-            points.add(to_timestamp)  # last point to process
-
-            timestamps = sorted(list(points))
-            increments = [
-                timestamps[i + 1] - timestamps[i] for i in range(len(timestamps) - 1)
-            ]
-
-            prev_timestamp = timestamps[0]
-            for increment in increments:
-                prev = prev_timestamp
-                prev_timestamp = prev_timestamp + increment
-                timestamp = prev_timestamp
-
-                def is_in_range(swap):
-                    return (
-                        swap[4] <= prev  # has started
-                        and swap[4] + swap[5]
-                        >= timestamp  # has not ended or ends in this increment
-                    )
-
-                def sum_swaps_token(token_address):
-                    return sum(
-                        [
-                            increment * swap[7]
-                            for swap in swaps
-                            if swap[6] == token_address and is_in_range(swap)
-                        ]
-                    )
-
-                token_0_in_sum = sum_swaps_token(token_0_address)
-                token_1_in_sum = sum_swaps_token(token_1_address)
-
-                amount_out_token_1 = (
-                    get_amount_out(token_0_in_sum, reserve_in, reserve_out)
-                    if token_0_in_sum != 0
-                    else 0
-                )
-                amount_out_token_0 = (
-                    get_amount_out(token_1_in_sum, reserve_out, reserve_in)
-                    if token_1_in_sum != 0
-                    else 0
-                )
-
-                # Check k
-                k_before = reserve_in * reserve_out
-                k_after = (reserve_in + token_0_in_sum - amount_out_token_0) * (
-                    reserve_out + token_1_in_sum - amount_out_token_1
-                )
-                assert k_after >= k_before, "AMM: K"
-
-                # then update swaps
-                for swap in [swap for swap in swaps if is_in_range(swap)]:
-                    if swap[6] == token_0_address:  # sending token 0 to pair
-                        # payout is in token 1
-                        streams_to_update[swap[0]]["amount"] += (
-                            increment * swap[7] * amount_out_token_1 // token_0_in_sum
-                        )
-                    else:  # sending token 1 to pair
-                        # payout is in token 0
-                        streams_to_update[swap[0]]["amount"] += (
-                            increment * swap[7] * amount_out_token_0 // token_1_in_sum
-                        )
-                    streams_to_update[swap[0]]["duration"] += increment
-
-                reserve_in += token_0_in_sum - amount_out_token_0
-                reserve_out += token_1_in_sum - amount_out_token_1
-
-            if increments:
-                update_stream_amount_duration_batch(
-                    connection,
-                    [
-                        [value["duration"], int_to_str(value["amount"]), key]
-                        for key, value in streams_to_update.items()
-                    ],
-                )
-
-        set_last_timestamp_processed(connection, pair_address, to_timestamp)
+    settle_wallet_orders(connection, wallet)
@@ -1,19 +1,18 @@
-import requests
-
-from dapp.util import (
-    logger,
-    rollup_server,
-)
+from dapp.util import logger
 from dapp.core import handle
+from dapp.db import get_write_connection
+from dapp.pair import load_pair_registry
+from dapp.rollup import rollup_client
+
+load_pair_registry(get_write_connection())
 
-finish = {"status": "accept"}
+status = "accept"
 
 while True:
-    logger.info("Sending finish")
-    response = requests.post(rollup_server + "/finish", json=finish)
-    logger.info(f"Received finish status {response.status_code}")
+    logger.debug("Sending finish")
+    response = rollup_client.finish(status)
     if response.status_code == 202:
         logger.info("No pending rollup request, trying again")
     else:
         rollup_request = response.json()
-        finish["status"] = handle(rollup_request)
+        status = handle(rollup_request)
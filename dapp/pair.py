@@ -1,27 +1,61 @@
+from collections import OrderedDict
+
+from dapp.db import get_pair_pool, get_pairs, set_pair_pool
+from dapp.hook import advance_pair
 from dapp.streamabletoken import StreamableToken
 from dapp.util import apply, get_pair_address, sort_tokens, with_checksum_address
 
+# (pair address, token 0 address, token 1 address) keyed by the unordered pair of
+# checksummed token addresses, least recently used first. They only depend on the
+# token addresses, so entries stay valid whether or not the pair was created or
+# rolled back, and evicted ones are computed again.
+pair_registry = OrderedDict()
+# Bound of the registry, pairs are created by users so their number is not
+PAIR_REGISTRY_SIZE = 4096
+
+
+def register_pair(key, metadata):
+    pair_registry[key] = metadata
+    pair_registry.move_to_end(key)
+    while len(pair_registry) > PAIR_REGISTRY_SIZE:
+        pair_registry.popitem(last=False)
+
+
+def get_pair_metadata(token_a: str, token_b: str):
+    key = frozenset((token_a, token_b))
+    metadata = pair_registry.get(key)
+    if metadata is None:
+        metadata = (get_pair_address(token_a, token_b), *sort_tokens(token_a, token_b))
+    register_pair(key, metadata)
+    return metadata
+
+
+def load_pair_registry(connection):
+    """Registers the pairs of the pair table, called once at startup."""
+    for (pair_address, token_0_address, token_1_address) in get_pairs(connection):
+        register_pair(
+            frozenset((token_0_address, token_1_address)),
+            (pair_address, token_0_address, token_1_address),
+        )
+
 
 @apply(with_checksum_address)
 class Pair(StreamableToken):
     def __init__(self, connection, _token0: str, _token1: str):
-        super().__init__(
-            connection,
-            get_pair_address(_token0, _token1),
-        )
-        (token0, token1) = sort_tokens(_token0, _token1)
-        self.token0 = StreamableToken(
-            connection, _token0 if token0 == _token0 else _token1
-        )
-        self.token1 = StreamableToken(
-            connection, _token1 if token1 == _token1 else _token0
-        )
+        (pair_address, token0, token1) = get_pair_metadata(_token0, _token1)
+        super().__init__(connection, pair_address)
+        self.token0 = StreamableToken(connection, token0)
+        self.token1 = StreamableToken(connection, token1)
 
     def get_reserves(self, at_timestamp):
-        return (
-            self.token0.balance_of(super().get_address(), at_timestamp),
-            self.token1.balance_of(super().get_address(), at_timestamp),
-        )
+        pool = advance_pair(self._connection, self.get_address(), at_timestamp)
+        return tuple(pool["reserves"]) if pool else (0, 0)
+
+    def update_reserves(self, amount_0_in: int, amount_1_in: int):
+        pool = get_pair_pool(self._connection, self.get_address())
+        pool["reserves"][0] += amount_0_in
+        pool["reserves"][1] += amount_1_in
+        set_pair_pool(self._connection, self.get_address(), pool)
 
     def get_tokens(self):
         return (self.token0, self.token1)
@@ -0,0 +1,89 @@
+import json
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from dapp.util import logger, rollup_server
+
+# Headers of every request, the bodies are serialized by the client
+HEADERS = {
+    "Content-Type": "application/json",
+    "Accept": "application/json",
+    "Connection": "keep-alive",
+}
+
+
+class RollupClient:
+    """
+    Client of the rollup server HTTP API. Requests go through one session
+    holding a single keep-alive connection, so /finish, /report and /voucher
+    calls are sent back to back over it instead of opening a TCP connection
+    each.
+    """
+
+    def __init__(self, url):
+        self.session = requests.Session()
+        self.session.headers.clear()
+        self.session.headers.update(HEADERS)
+        self.session.mount(url, HTTPAdapter(pool_connections=1, pool_maxsize=1))
+        self.urls = {
+            endpoint: url + endpoint
+            for endpoint in ("/finish", "/report", "/notice", "/voucher")
+        }
+
+    def post(self, endpoint, body):
+        url = self.urls[endpoint]
+        response = self.session.post(url, data=json.dumps(body).encode())
+        if response.status_code not in (200, 202):
+            logger.error(
+                f"Failed POST request to {url}. Status: {response.status_code}. Response: {response.text}"
+            )
+        else:
+            logger.debug("POST request to %s status %s", url, response.status_code)
+        return response
+
+    def finish(self, status):
+        return self.post("/finish", {"status": status})
+
+    def report(self, payload):
+        return self.post("/report", {"payload": payload})
+
+    def notice(self, payload):
+        return self.post("/notice", {"payload": payload})
+
+    def voucher(self, destination, payload):
+        return self.post("/voucher", {"destination": destination, "payload": payload})
+
+
+class NullSink:
+    """Outputs sink dropping everything, for replays of already processed inputs."""
+
+    def report(self, payload):
+        pass
+
+    def notice(self, payload):
+        pass
+
+    def voucher(self, destination, payload):
+        pass
+
+
+class RecordingSink:
+    """Outputs sink keeping the outputs in memory, in the order they were sent."""
+
+    def __init__(self):
+        self.reports = []
+        self.notices = []
+        self.vouchers = []
+
+    def report(self, payload):
+        self.reports.append({"payload": payload})
+
+    def notice(self, payload):
+        self.notices.append({"payload": payload})
+
+    def voucher(self, destination, payload):
+        self.vouchers.append({"destination": destination, "payload": payload})
+
+
+rollup_client = RollupClient(rollup_server)
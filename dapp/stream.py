@@ -1,5 +1,33 @@
 from typing import Optional
 
+from dapp.util import STREAM_RATE_PRECISION
+
+
+def stream_events(start_timestamp: int, duration: int, amount: int):
+    """
+    Returns the start and end events of a stream as (timestamp, rate, offset)
+    tuples scaled by STREAM_RATE_PRECISION. The scaled streamed amount at any
+    timestamp t is the sum of rate * (t - timestamp) + offset over the events
+    with timestamp <= t, which is exactly the amount once the stream has ended.
+    """
+    scaled_amount = int(amount) * STREAM_RATE_PRECISION
+    rate = scaled_amount // duration if duration > 0 else 0
+    return (
+        (start_timestamp, rate, 0),
+        (start_timestamp + duration, -rate, scaled_amount - rate * duration),
+    )
+
+
+def stream_flow(start_timestamp: int, duration: int, amount: int, timestamp: int):
+    """Amount streamed until timestamp scaled by STREAM_RATE_PRECISION, the sum
+    of the stream_events up to timestamp evaluated at timestamp."""
+    if timestamp < start_timestamp:
+        return 0
+    if timestamp >= start_timestamp + duration:
+        return int(amount) * STREAM_RATE_PRECISION
+    rate = int(amount) * STREAM_RATE_PRECISION // duration
+    return rate * (timestamp - start_timestamp)
+
 
 class Stream:
     def __init__(
@@ -41,3 +69,6 @@ class Stream:
 
         elapsed = until_timestamp - self.start_timestamp
         return (self.amount * elapsed) // self.duration
+
+    def events(self):
+        return stream_events(self.start_timestamp, self.duration, self.amount)
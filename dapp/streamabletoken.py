@@ -2,6 +2,9 @@ from typing import List, Optional
 
 from dapp.db import (
     add_stream,
+    add_to_balances,
+    advance_accumulator,
+    archive_streams,
     delete_stream_by_id,
     get_balance,
     get_max_end_timestamp_for_wallet,
@@ -10,12 +13,14 @@ from dapp.db import (
     get_wallet_endend_streams,
     get_wallet_streams,
     set_balance,
+    set_streams_accrued,
     set_total_supply,
     update_stream_accrued,
     update_stream_amount_duration,
-    get_wallet_non_accrued_streamed_amts,
+    get_wallet_streamed_amount,
+    get_wallet_uncommitted_amount,
 )
-from dapp.hook import hook
+from dapp.hook import close_order, hook
 from dapp.stream import Stream
 from dapp.util import (
     address_or_raise,
@@ -63,28 +68,27 @@ class StreamableToken:
         return set_total_supply(self._connection, self._address, amount)
 
     def process_streams(self, account_address: str, current_timestamp: int):
+        advance_accumulator(
+            self._connection, account_address, self._address, current_timestamp
+        )
         ended_streams = self.get_wallet_endend_streams(
             account_address, current_timestamp
         )
+        set_streams_accrued(self._connection, ended_streams)
 
-        balance = self.get_stored_balance(account_address)
+        # Net amount each wallet gets from the settled streams, the wallet itself
+        # always gets a stored balance
+        deltas = {account_address: 0}
         for stream in ended_streams:
-            self.set_stream_accrued(stream.id)
             streamed_amount = stream.streamed_amt(current_timestamp)
-            if stream.from_address == account_address:
-                balance -= streamed_amount
-                balance_to = (
-                    self.get_stored_balance(stream.to_address) + streamed_amount
-                )
-                self.set_stored_balance(stream.to_address, balance_to)
-            if stream.to_address == account_address:
-                balance += streamed_amount
-                balance_from = (
-                    self.get_stored_balance(stream.from_address) - streamed_amount
-                )
-                self.set_stored_balance(stream.from_address, balance_from)
-
-        self.set_stored_balance(account_address, balance)
+            deltas[stream.from_address] = (
+                deltas.get(stream.from_address, 0) - streamed_amount
+            )
+            deltas[stream.to_address] = (
+                deltas.get(stream.to_address, 0) + streamed_amount
+            )
+        add_to_balances(self._connection, self._address, deltas)
+        archive_streams(self._connection, [stream.id for stream in ended_streams])
 
         hook(self._connection, self._address, account_address, current_timestamp)
 
@@ -119,7 +123,7 @@ class StreamableToken:
         address_or_raise(account_address)
         balance = self.get_stored_balance(account_address)
 
-        streamed_amounts = get_wallet_non_accrued_streamed_amts(
+        balance += get_wallet_streamed_amount(
             self._connection,
             account_address,
             self._address,
@@ -129,10 +133,18 @@ class StreamableToken:
             else recipient_until_timestamp,
         )
 
-        balance += sum(streamed for streamed in streamed_amounts)
-
         return balance
 
+    def uncommitted_balance_of(self, account_address: str, current_timestamp: int):
+        """
+        Balance left once every outgoing stream has ended, counting incoming
+        streams only up to current_timestamp.
+        """
+        address_or_raise(account_address)
+        return self.get_stored_balance(account_address) + get_wallet_uncommitted_amount(
+            self._connection, account_address, self._address, current_timestamp
+        )
+
     # Only used in the indexer and never during dapp execution
     def future_balance_of(self, account_address: str, future_timestamp=None):
         address_or_raise(account_address)
@@ -193,15 +205,9 @@ class StreamableToken:
         assert sender != receiver, "Sender and receiver must be different."
         assert amount >= 0, "Amount must be positive."
 
-        max_timestamp = max(
-            start_timestamp + duration,
-            get_max_end_timestamp_for_wallet(self._connection, sender),
-        )
-
-        future_balance_after_send = self.balance_of(
-            sender, max_timestamp, False, current_timestamp
-        )
-        assert future_balance_after_send >= amount, "Not enough funds for the transfer."
+        assert (
+            self.uncommitted_balance_of(sender, current_timestamp) >= amount
+        ), "Not enough funds for the transfer."
 
         return self.add_stream(
             Stream(
@@ -226,6 +232,9 @@ class StreamableToken:
             stream.start_timestamp + stream.duration >= current_timestamp
         ), "Stream is already completed."
 
+        if stream.swap_id is not None:
+            close_order(self._connection, stream.swap_id, current_timestamp)
+
         if stream.start_timestamp > current_timestamp:
             delete_stream_by_id(self._connection, stream_id)
         else:
@@ -1,13 +1,15 @@
 import json
 import logging
 import hashlib
+from functools import lru_cache
 from os import environ
 
 # External libraries
 from eth_abi.codec import ABICodec
+from eth_abi.base import parse_type_str
 from eth_abi.decoding import AddressDecoder, BooleanDecoder, UnsignedIntegerDecoder
 from eth_abi.registry import BaseEquals, registry_packed
-from eth_utils import is_hex_address, to_checksum_address, is_checksum_address
+from eth_utils import is_hex_address, to_checksum_address
 
 # Constants
 ZERO_ADDRESS = "0x0000000000000000000000000000000000000000"
@@ -15,6 +17,16 @@ MINIMUM_LIQUIDITY = 100000
 MAX_INT64 = 2**63 - 1
 MAX_UINT256 = 2**256 - 1
 USER_FEES = 30  # 0.3%
+# Fixed point scale for stream rates, divisible by the usual stream durations
+# (seconds, minutes, hours, days, weeks, powers of ten) so their rates are exact
+STREAM_RATE_PRECISION = 2**64 * 3**32 * 5**32 * 7**16
+# Fixed point scale for the earnings per unit of sell rate of the pair order pools
+EARNINGS_PRECISION = 2**128
+# Amounts are stored as fixed width big endian BLOBs, see int_to_blob
+AMOUNT_BLOB_SIZE = 32
+AMOUNT_BLOB_OFFSET = 2**255
+# Bound of the memoized address checksums, far more than the addresses of an input
+ADDRESS_CACHE_SIZE = 4096
 
 
 # Custom Decoder Classes
@@ -26,13 +38,19 @@ class PackedAddressDecoder(AddressDecoder):
     data_byte_size = 20
 
 
+class PackedUnsignedIntegerDecoder(UnsignedIntegerDecoder):
+    @parse_type_str("uint")
+    def from_type_str(cls, abi_type, registry):
+        return cls(value_bit_size=abi_type.sub, data_byte_size=abi_type.sub // 8)
+
+
 # Registering Custom Decoders
 registry_packed.register_decoder(BaseEquals("bool"), PackedBooleanDecoder, label="bool")
 registry_packed.register_decoder(
     BaseEquals("address"), PackedAddressDecoder, label="address"
 )
 registry_packed.register_decoder(
-    BaseEquals("uint"), UnsignedIntegerDecoder, label="uint"
+    BaseEquals("uint"), PackedUnsignedIntegerDecoder, label="uint"
 )
 
 # Codec for packed data
@@ -67,14 +85,48 @@ def int_to_str(integer):
         return "0"
 
 
+def int_to_blob(integer):
+    """Encodes an amount as a 32 byte big endian BLOB. The value is offset by
+    AMOUNT_BLOB_OFFSET so stored balances that are transiently negative fit and
+    the bytes sort like the numbers they hold."""
+    return (int(integer) + AMOUNT_BLOB_OFFSET).to_bytes(AMOUNT_BLOB_SIZE, "big")
+
+
+def blob_to_int(blob):
+    """Decodes an amount encoded by int_to_blob. Returns 0 for NULL, decimal
+    strings of databases that have not been migrated yet are still read."""
+    if blob is None:
+        return 0
+    if isinstance(blob, bytes):
+        return int.from_bytes(blob, "big") - AMOUNT_BLOB_OFFSET
+    return str_to_int(blob)
+
+
+def normalize_address(value: str) -> str:
+    """Checksummed form of a hex address, other strings are returned unchanged.
+    Checksums are keccak hashes, so the same addresses coming back on every
+    call are only hashed once, whatever their case."""
+    return _checksum_address(value.lower()) if is_hex_address(value) else value
+
+
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
+def _checksum_address(address: str) -> str:
+    # Keyed by the lower case address, so each address takes one entry
+    return to_checksum_address(address)
+
+
+def _is_checksum_address(value: str) -> bool:
+    return is_hex_address(value) and _checksum_address(value.lower()) == value
+
+
 # Decorators
 def with_checksum_address(func):
     def wrapper(*args, **kwargs):
         new_args = tuple(
-            to_checksum_address(arg) if is_hex_address(arg) else arg for arg in args
+            normalize_address(arg) if isinstance(arg, str) else arg for arg in args
         )
         new_kwargs = {
-            key: to_checksum_address(value) if is_hex_address(value) else value
+            key: normalize_address(value) if isinstance(value, str) else value
             for key, value in kwargs.items()
         }
         return func(*new_args, **new_kwargs)
@@ -127,18 +179,20 @@ logger.addHandler(handler)
 
 # Main code or configuration
 rollup_server = environ.get("ROLLUP_HTTP_SERVER_URL", "http://127.0.0.1:5004")
+# Successful advances echo their input in a JSON report instead of a compact one
+verbose_reports = environ.get("VERBOSE_REPORTS", "").lower() in ("1", "true")
 
 
 # Utilities
 def address_or_raise(address):
-    if not is_checksum_address(address):
+    if not isinstance(address, str) or not _is_checksum_address(address):
         raise ValueError(f"Invalid address {address}")
     return address
 
 
 # Amm
 def addresses_to_hex(address1, address2):
-    address1, address2 = to_checksum_address(address1), to_checksum_address(address2)
+    address1, address2 = normalize_address(address1), normalize_address(address2)
     concatenated_addresses = address1 + address2
     sha256_hash = hashlib.sha256(concatenated_addresses.encode()).digest()
     ethereum_address = "0x" + sha256_hash[-20:].hex()
@@ -146,12 +200,12 @@ def addresses_to_hex(address1, address2):
 
 
 def sort_tokens(token0: str, token1: str):
-    token0, token1 = to_checksum_address(token0), to_checksum_address(token1)
+    token0, token1 = normalize_address(token0), normalize_address(token1)
     return (token0, token1) if token0 < token1 else (token1, token0)
 
 
+@lru_cache(maxsize=ADDRESS_CACHE_SIZE)
 def get_pair_address(token0, token1):
-    token0, token1 = to_checksum_address(token0), to_checksum_address(token1)
     sorted_tokens = sort_tokens(token0, token1)
     return to_checksum_address(addresses_to_hex(sorted_tokens[0], sorted_tokens[1]))
 
@@ -176,9 +230,11 @@ def get_amount_out(amount_in, reserve_in, reserve_out):
 
     return int(amount_out)
 
+# Read once, every input is compared with it
+@lru_cache(maxsize=None)
 def get_portal_address():
     network = environ.get("NETWORK", "localhost")
     ERC20PortalFilePath = environ.get("ERC20_PORTAL_FILE_PATH", f"./deployments/{network}/ERC20Portal.json")
-    ERC20PortalFile = open(ERC20PortalFilePath)
-    erc20Portal = json.load(ERC20PortalFile)
+    with open(ERC20PortalFilePath) as ERC20PortalFile:
+        erc20Portal = json.load(ERC20PortalFile)
     return erc20Portal["address"]
\ No newline at end of file
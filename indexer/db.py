@@ -7,21 +7,52 @@ current_dir = os.path.dirname(os.path.abspath(__file__))
 parent_dir = os.path.dirname(current_dir)
 sys.path.insert(0, parent_dir)
 
-from dapp.db import get_max_end_timestamp_for_wallet, get_wallet_token_streamed
+from dapp.db import (
+    CACHED_STATEMENTS,
+    Connection,
+    configure_connection,
+    get_account_id,
+    get_max_end_timestamp_for_wallet,
+    get_wallet_token_streamed,
+    read_connection,
+)
 from dapp.hook import hook
 
 from utils import with_checksum_address
 
 db_file_path =  os.getenv("DB_FILE_PATH", "dapp.sqlite")
 
+# Ids of the swaps an account is part of, as their owner, their pair or the
+# sender of the stream to the pair, one indexed lookup per column
+ACCOUNT_SWAP_IDS = """
+    SELECT id FROM swap WHERE owner_id = ?
+    UNION ALL
+    SELECT id FROM swap WHERE pair_id = ? AND owner_id != ?
+    UNION ALL
+    SELECT sw.id FROM stream s JOIN swap sw ON sw.to_pair_stream_id = s.id
+    WHERE s.from_id = ? AND sw.owner_id != ? AND sw.pair_id != ?
+"""
+# Ids of the swaps selling or buying a token, the legs are in different tokens
+TOKEN_SWAP_IDS = """
+    SELECT sw.id FROM stream s JOIN swap sw ON sw.to_pair_stream_id = s.id
+    WHERE s.token_id = ?
+    UNION ALL
+    SELECT sw.id FROM stream s JOIN swap sw ON sw.from_pair_stream_id = s.id
+    WHERE s.token_id = ?
+"""
+
 
 def get_connection():
     # Opening the connection in read-write mode
-    conn = sqlite3.connect(f"file:{db_file_path}?mode=rw", uri=True)
-    cursor = conn.cursor()
-    cursor.execute("PRAGMA foreign_keys = ON")
+    conn = sqlite3.connect(
+        f"file:{db_file_path}?mode=rw",
+        uri=True,
+        factory=Connection,
+        cached_statements=CACHED_STATEMENTS,
+    )
+    configure_connection(conn)
 
-    # Disable auto-commit mode
+    # Autocommit, the callers open their own transactions or savepoints
     conn.isolation_level = None
 
     return conn
@@ -51,10 +82,10 @@ def create_last_cursor_table():
 
 
 def get_last_cursor():
-    conn = get_connection()
-    cursor = conn.cursor()
-    cursor.execute("SELECT last_cursor_value FROM last_cursor WHERE id = 1")
-    result = cursor.fetchone()
+    with read_connection() as conn:
+        cursor = conn.cursor()
+        cursor.execute("SELECT last_cursor_value FROM last_cursor WHERE id = 1")
+        result = cursor.fetchone()
     return result[0] if result else None
 
 
@@ -99,15 +130,15 @@ def get_streams(
         params = []
 
         if from_address:
-            where_clause.append("s.from_address = ?")
+            where_clause.append("f.address = ?")
             params.append(from_address)
 
         if to_address:
-            where_clause.append("s.to_address = ?")
+            where_clause.append("t.address = ?")
             params.append(to_address)
 
         if token_address:
-            where_clause.append("s.token_address = ?")
+            where_clause.append("tk.address = ?")
             params.append(token_address)
 
         where_sql = " AND ".join(where_clause) if where_clause else "1=1"
@@ -117,15 +148,18 @@ def get_streams(
             f"""
             SELECT 
                 s.id,
-                s.from_address,
-                s.to_address,
-                s.token_address,
+                f.address,
+                t.address,
+                tk.address,
                 s.amount,
                 s.start_timestamp,
                 s.duration,
                 s.accrued,
                 s.swap_id
-            FROM stream s
+            FROM stream_history s
+            JOIN account f ON f.id = s.from_id
+            JOIN account t ON t.id = s.to_id
+            JOIN account tk ON tk.id = s.token_id
             WHERE {where_sql}
         """,
             params,
@@ -165,66 +199,61 @@ def get_swaps(
                 hook(conn, t[0], account_address, max_timestamp)
 
         where_clause = []
-        outter_where_clause = []
         params = []
-
-        # Build the WHERE clause based on provided addresses
-        if from_address:
-            where_clause.append("s.from_address = ? OR s.to_address = ?")
-            params.append(from_address)
-            params.append(from_address)
-
-        if to_address:
-            where_clause.append("s.to_address = ? OR s.from_address = ?")
-            params.append(to_address)
-            params.append(to_address)
+        # The pair is on the other side of both legs of its swaps. Addresses
+        # never seen have no id, NULL matches no swap.
+        for account_address in (from_address, to_address):
+            if account_address:
+                account_id = get_account_id(conn, account_address)
+                where_clause.append(f"sw.id IN ({ACCOUNT_SWAP_IDS})")
+                params.extend((account_id,) * 6)
 
         if token_address:
-            where_clause.append("s.token_address = ?")
-            params.append(token_address)
+            token_id = get_account_id(conn, token_address)
+            where_clause.append(f"sw.id IN ({TOKEN_SWAP_IDS})")
+            params.extend((token_id,) * 2)
 
         if pair_address:
-            outter_where_sql.append("sw.pair_address = ?")
-            params.append(pair_address)
+            pair_id = get_account_id(conn, pair_address)
+            where_clause.append("sw.pair_id = ?")
+            params.append(pair_id)
 
         where_sql = " AND ".join(where_clause) if where_clause else "1=1"
-        outter_where_sql = (
-            " AND ".join(outter_where_clause) if outter_where_clause else "1=1"
-        )
 
         cursor = conn.cursor()
         cursor.execute(
             f"""
             SELECT
                 sw.id AS swap_id,
-                sw.pair_address,
+                pair.address AS pair_address,
                 s1.id AS s1_id,
-                s1.from_address AS s1_from_address,
-                s1.to_address AS s1_to_address,
-                s1.token_address AS s1_token_address,
+                s1_from.address AS s1_from_address,
+                pair.address AS s1_to_address,
+                s1_token.address AS s1_token_address,
                 s1.amount AS s1_amount,
                 s1.start_timestamp AS s1_start_timestamp,
                 s1.duration AS s1_duration,
                 s1.accrued AS s1_accrued,
                 s1.swap_id AS s1_swap_id,
                 s2.id AS s2_id,
-                s2.from_address AS s2_from_address,
-                s2.to_address AS s2_to_address,
-                s2.token_address AS s2_token_address,
+                pair.address AS s2_from_address,
+                s2_to.address AS s2_to_address,
+                s2_token.address AS s2_token_address,
                 s2.amount AS s2_amount,
                 s2.start_timestamp AS s2_start_timestamp,
                 s2.duration AS s2_duration,
                 s2.accrued AS s2_accrued,
                 s2.swap_id AS s2_swap_id
             FROM swap sw
-            JOIN stream s1 ON sw.id = s1.swap_id AND s1_to_address = sw.pair_address
-            JOIN stream s2 ON sw.id = s2.swap_id AND s2_from_address = sw.pair_address
-            WHERE sw.id IN (
-                SELECT distinct s.swap_id
-                FROM stream s
-                WHERE s.swap_id IS NOT NULL AND {where_sql}
-            )
-            AND {outter_where_sql}
+            -- Streams of swaps are never accrued, so never archived
+            JOIN stream s1 ON s1.id = sw.to_pair_stream_id
+            JOIN stream s2 ON s2.id = sw.from_pair_stream_id
+            JOIN account pair ON pair.id = sw.pair_id
+            JOIN account s1_from ON s1_from.id = s1.from_id
+            JOIN account s1_token ON s1_token.id = s1.token_id
+            JOIN account s2_to ON s2_to.id = s2.to_id
+            JOIN account s2_token ON s2_token.id = s2.token_id
+            WHERE {where_sql}
             """,
             params,
         )
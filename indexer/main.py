@@ -17,13 +17,12 @@ from starlette_graphene3 import GraphQLApp, make_graphiql_handler
 import sys
 
 sys.path.append("../dapp")
-from dapp.core import handle_action
-from dapp.util import hex_to_str
+from dapp.core import ExecutionContext, handle_action, is_success_report
+from dapp.rollup import NullSink
 
 import schedule
 import time
 import threading
-import json
 
 load_dotenv()
 
@@ -74,10 +73,9 @@ def run_query():
 
     for edge in data.get("data", {}).get("reports", {}).get("edges", []):
         node = edge.get("node", {})
+        conn = None
         try:
-            report_payload = hex_to_str(node["payload"])
-            report = json.loads(report_payload)
-            if report["message"] != "Success":
+            if not is_success_report(node["payload"]):
                 continue
             conn = get_connection()
             formatted_data = {
@@ -88,12 +86,19 @@ def run_query():
                     "block_number": int(node["input"]["blockNumber"]),
                 },
             }
-            handle_action(formatted_data, conn)
+            # The connection autocommits, each input is replayed in its own
+            # transaction so a failing one leaves no rows or pending state behind
+            conn.execute("BEGIN")
+            # Replays only rebuild the state, the outputs were sent the first time
+            handle_action(formatted_data, ExecutionContext(conn, NullSink()))
             conn.commit()
-            conn.close()
         except Exception as e:
+            if conn is not None:
+                conn.rollback()
             print(e)
-            pass
+        finally:
+            if conn is not None:
+                conn.close()
 
         set_last_cursor(edge.get("cursor"))
 
@@ -1,9 +1,11 @@
 from typing import Optional
 
 import graphene
-from db import get_streams, get_connection, get_swaps
+from db import get_streams, get_swaps, read_connection
 from graphene_types import Address, Balance, Cursor, Stream, StreamableERC20, Swap
 
+from dapp.util import blob_to_int, int_to_str
+
 
 class Query(graphene.ObjectType):
     all_streams = graphene.List(
@@ -33,7 +35,10 @@ class Query(graphene.ObjectType):
         is_pair=graphene.Boolean(),
     )
     all_balances = graphene.List(
-        Balance, address=graphene.String(), token_address=graphene.String()
+        Balance,
+        address=graphene.String(),
+        token_address=graphene.String(),
+        timestamp=graphene.Int(default_value=None),
     )
 
     def resolve_all_streams(
@@ -61,7 +66,7 @@ class Query(graphene.ObjectType):
                 from_address=row[1],
                 to_address=row[2],
                 token_address=row[3],
-                amount=row[4],
+                amount=int_to_str(blob_to_int(row[4])),
                 start=row[5],
                 duration=row[6],
                 accrued=row[7],
@@ -98,7 +103,7 @@ class Query(graphene.ObjectType):
                     from_address=row[3],
                     to_address=row[4],
                     token_address=row[5],
-                    amount=row[6],
+                    amount=int_to_str(blob_to_int(row[6])),
                     start=row[7],
                     duration=row[8],
                     accrued=row[9],
@@ -109,7 +114,7 @@ class Query(graphene.ObjectType):
                     from_address=row[12],
                     to_address=row[13],
                     token_address=row[14],
-                    amount=row[15],
+                    amount=int_to_str(blob_to_int(row[15])),
                     start=row[16],
                     duration=row[17],
                     accrued=row[18],
@@ -131,48 +136,48 @@ class Query(graphene.ObjectType):
         def build_query():
             query = """
                 SELECT
-                    t.address as token_address,
+                    a.address as token_address,
                     t.total_supply,
-                    p.address as pair_address,
-                    p.token_0_address,
-                    p.token_1_address
+                    CASE WHEN p.id IS NULL THEN NULL ELSE a.address END as pair_address,
+                    a0.address as token_0_address,
+                    a1.address as token_1_address
                 FROM token t
-                LEFT JOIN pair p ON t.address = p.address
+                JOIN account a ON a.id = t.id
+                LEFT JOIN pair p ON t.id = p.id
+                LEFT JOIN account a0 ON a0.id = p.token_0_id
+                LEFT JOIN account a1 ON a1.id = p.token_1_id
                 WHERE 1=1
             """
             arguments = []
 
             if pair_token_0_address:
-                query += " AND p.token_0_address = ?"
+                query += " AND a0.address = ?"
                 arguments.append(pair_token_0_address)
 
             if pair_token_1_address:
-                query += " AND p.token_1_address = ?"
+                query += " AND a1.address = ?"
                 arguments.append(pair_token_1_address)
 
             if token_address:
-                query += " AND t.address = ?"
+                query += " AND a.address = ?"
                 arguments.append(token_address)
 
             if is_pair:  # Explicitly check against None
-                query += " AND pair_address IS NOT NULL"
+                query += " AND p.id IS NOT NULL"
 
             return query, tuple(arguments)
 
         # Get connection and execute query
-        conn = get_connection()
         query, arguments = build_query()
 
-        cursor = conn.cursor()
-        cursor.execute(query, arguments)
-        results = cursor.fetchall()
-        conn.close()
+        with read_connection() as conn:
+            results = conn.execute(query, arguments).fetchall()
 
         # Transform the results into a list of StreamableERC20 objects
         return [
             StreamableERC20(
                 token_address=row[0],
-                total_supply=row[1],
+                total_supply=int_to_str(blob_to_int(row[1])),
                 is_pair=row[2] is not None,
                 pair_token_0_address=row[3],
                 pair_token_1_address=row[4],
@@ -181,36 +186,73 @@ class Query(graphene.ObjectType):
         ]
 
     def resolve_all_balances(
-        self, info, address: Optional[str] = None, token_address: Optional[str] = None
+        self,
+        info,
+        address: Optional[str] = None,
+        token_address: Optional[str] = None,
+        timestamp: Optional[int] = None,
     ):
-        conn = get_connection()
-
         # Begin your SQL query
-        query = """
-            SELECT b.account_address, b.token_address, b.amount
-            FROM balance b
-            WHERE 1=1
-        """
-
-        # A list to keep track of arguments to be passed
-        arguments = []
+        if timestamp is None:
+            query = """
+                SELECT a.address, t.address, b.amount, NULL
+                FROM balance b
+                JOIN account a ON a.id = b.account_id
+                JOIN account t ON t.id = b.token_id
+                WHERE 1=1
+            """
+            arguments = []
+        else:
+            # Stored balances plus what the non accrued streams moved until timestamp
+            query = """
+                WITH wallet AS (
+                    SELECT account_id, token_id FROM balance
+                    UNION
+                    SELECT from_id, token_id FROM stream WHERE accrued = 0
+                    UNION
+                    SELECT to_id, token_id FROM stream WHERE accrued = 0
+                )
+                SELECT a.address, t.address, b.amount, (
+                    SELECT streamed_sum(
+                        s.start_timestamp, s.duration, s.amount, s.to_id, w.account_id, ?, ?
+                    )
+                    FROM (
+                        SELECT start_timestamp, duration, amount, to_id FROM stream
+                        WHERE from_id = w.account_id AND token_id = w.token_id
+                        AND accrued = 0
+                        UNION ALL
+                        SELECT start_timestamp, duration, amount, to_id FROM stream
+                        WHERE to_id = w.account_id AND token_id = w.token_id
+                        AND accrued = 0 AND from_id != w.account_id
+                    ) s
+                )
+                FROM wallet w
+                JOIN account a ON a.id = w.account_id
+                JOIN account t ON t.id = w.token_id
+                LEFT JOIN balance b
+                    ON b.account_id = w.account_id AND b.token_id = w.token_id
+                WHERE 1=1
+            """
+            arguments = [timestamp, timestamp]
 
         # If address is provided, filter by it
         if address:
-            query += " AND b.account_address = ?"
+            query += " AND a.address = ?"
             arguments.append(address)  # Add to our arguments list
 
         # If token_address is provided, filter by it
         if token_address:
-            query += " AND b.token_address = ?"
+            query += " AND t.address = ?"
             arguments.append(token_address)  # Add to our arguments list
 
-        cursor = conn.cursor()
-        cursor.execute(query, tuple(arguments))
-        results = cursor.fetchall()
-        conn.close()
+        with read_connection() as conn:
+            results = conn.execute(query, tuple(arguments)).fetchall()
 
         return [
-            Balance(address=row[0], token_address=row[1], amount=row[2])
+            Balance(
+                address=row[0],
+                token_address=row[1],
+                amount=int_to_str(blob_to_int(row[2]) + blob_to_int(row[3])),
+            )
             for row in results
         ]
@@ -1,109 +1,625 @@
 import os
+import sqlite3
+import sys
 
-from dapp.db import get_connection
+from dapp.db import (
+    STREAM_COLUMNS,
+    UPDATE_PAIR_POOL,
+    archive_streams,
+    clear_account_cache,
+    close_connections,
+    get_account_address,
+    get_balance,
+    get_connection,
+    get_pair_next_event_timestamp,
+    get_wallet_streamed_amount,
+    pair_pool_row,
+    stream_from_row,
+    update_stream_accumulators,
+)
+from dapp.util import int_to_blob, int_to_str, str_to_int
 
 db_file_path = os.getenv("DB_FILE_PATH", "dapp.sqlite")
 
+ZERO_AMOUNT = f"X'{int_to_blob(0).hex()}'"
+# Columns holding amounts encoded by int_to_blob
+AMOUNT_COLUMNS = (
+    ("stream", "amount"),
+    ("balance", "amount"),
+    ("token", "total_supply"),
+    ("pair", "reserve_0"),
+    ("pair", "reserve_1"),
+)
 
-def initialise_db():
-    try:
-        os.remove(db_file_path)
-    except FileNotFoundError:
-        pass
+# Current layout of the tables, in creation order
+TABLES = {
+    "account": """
+        id INTEGER PRIMARY KEY,
+        address TEXT NOT NULL UNIQUE
+    """,
+    "token": """
+        -- Same id as the account of the token address
+        id INTEGER PRIMARY KEY,
+        total_supply BLOB NOT NULL,
+        FOREIGN KEY (id) REFERENCES account(id)
+    """,
+    "pair": f"""
+        id INTEGER PRIMARY KEY,
+        token_0_id INTEGER NOT NULL,
+        token_1_id INTEGER NOT NULL,
+        last_timestamp_processed INTEGER NOT NULL DEFAULT 0,
+        -- Earliest order start or end after last_timestamp_processed, NULL if none
+        next_event_timestamp INTEGER,
+        -- Order pool, direction 0 sells token 0 for token 1 and direction 1 the opposite
+        sell_rate_0 TEXT NOT NULL DEFAULT '0',
+        sell_rate_1 TEXT NOT NULL DEFAULT '0',
+        -- Cumulative amount out earned per unit of sell rate, scaled by EARNINGS_PRECISION
+        earnings_per_rate_0 TEXT NOT NULL DEFAULT '0',
+        earnings_per_rate_1 TEXT NOT NULL DEFAULT '0',
+        -- Token 0 and token 1 owned by the pool, orders inflow at their sell rates
+        reserve_0 BLOB NOT NULL DEFAULT ({ZERO_AMOUNT}),
+        reserve_1 BLOB NOT NULL DEFAULT ({ZERO_AMOUNT}),
+        FOREIGN KEY (id) REFERENCES token(id)
+        FOREIGN KEY (token_0_id) REFERENCES token(id)
+        FOREIGN KEY (token_1_id) REFERENCES token(id)
+    """,
+    "balance": """
+        amount BLOB NOT NULL,
+        account_id INTEGER NOT NULL,
+        token_id INTEGER NOT NULL,
+        FOREIGN KEY (account_id) REFERENCES account(id),
+        FOREIGN KEY (token_id) REFERENCES token(id),
+        PRIMARY KEY (account_id, token_id)
+    """,
+    "swap": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair_id INTEGER NOT NULL,
+        -- Receiver of the payout stream
+        owner_id INTEGER NOT NULL,
+        start_timestamp INTEGER NOT NULL,
+        end_timestamp INTEGER NOT NULL,
+        token_in_id INTEGER NOT NULL,
+        -- Amount sold per second
+        rate TEXT NOT NULL,
+        to_pair_stream_id INTEGER,
+        from_pair_stream_id INTEGER,
+        -- earnings_per_rate of the pool when the order was last settled, NULL until it enters the pool
+        earnings_checkpoint TEXT,
+        FOREIGN KEY (pair_id) REFERENCES token(id),
+        FOREIGN KEY (owner_id) REFERENCES account(id),
+        FOREIGN KEY (token_in_id) REFERENCES token(id),
+        FOREIGN KEY (to_pair_stream_id) REFERENCES stream(id),
+        FOREIGN KEY (from_pair_stream_id) REFERENCES stream(id)
+    """,
+    "stream": """
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_id INTEGER NOT NULL,
+        to_id INTEGER NOT NULL,
+        start_timestamp INTEGER NOT NULL,
+        duration INTEGER NOT NULL,
+        end_timestamp INTEGER GENERATED ALWAYS AS (start_timestamp + duration) STORED,
+        amount BLOB NOT NULL,
+        token_id INTEGER NOT NULL,
+        accrued INTEGER NOT NULL,
+        swap_id INTEGER,
+        FOREIGN KEY (token_id) REFERENCES token(id),
+        FOREIGN KEY (from_id) REFERENCES account(id),
+        FOREIGN KEY (to_id) REFERENCES account(id),
+        FOREIGN KEY (swap_id) REFERENCES swap(id)
+    """,
+    # Accrued streams moved out of stream, no longer part of any balance computation
+    "stream_archive": """
+        id INTEGER PRIMARY KEY,
+        from_id INTEGER NOT NULL,
+        to_id INTEGER NOT NULL,
+        start_timestamp INTEGER NOT NULL,
+        duration INTEGER NOT NULL,
+        end_timestamp INTEGER GENERATED ALWAYS AS (start_timestamp + duration) STORED,
+        amount BLOB NOT NULL,
+        token_id INTEGER NOT NULL,
+        swap_id INTEGER,
+        FOREIGN KEY (token_id) REFERENCES token(id),
+        FOREIGN KEY (from_id) REFERENCES account(id),
+        FOREIGN KEY (to_id) REFERENCES account(id)
+    """,
+    "accumulator": """
+        account_id INTEGER NOT NULL,
+        token_id INTEGER NOT NULL,
+        checkpoint_timestamp INTEGER NOT NULL,
+        inflow_rate TEXT NOT NULL,
+        inflow_offset TEXT NOT NULL,
+        outflow_rate TEXT NOT NULL,
+        outflow_offset TEXT NOT NULL,
+        committed_outflow TEXT NOT NULL DEFAULT '0',
+        FOREIGN KEY (account_id) REFERENCES account(id),
+        FOREIGN KEY (token_id) REFERENCES token(id),
+        PRIMARY KEY (account_id, token_id)
+    """,
+}
 
-    conn = get_connection()
-    cursor = conn.cursor()
+VIEWS = {
+    # Active and archived streams, for the queries that need the whole history
+    "stream_history": """
+        SELECT id, from_id, to_id, start_timestamp, duration, end_timestamp,
+            amount, token_id, accrued, swap_id
+        FROM stream
+        UNION ALL
+        SELECT id, from_id, to_id, start_timestamp, duration, end_timestamp,
+            amount, token_id, 1, swap_id
+        FROM stream_archive
+    """,
+}
 
-    cursor.execute(
-        """
-        CREATE TABLE IF NOT EXISTS account (
-            address TEXT PRIMARY KEY
+# Current indexes by name, indexes named idx_* that are not listed are dropped
+INDEXES = {
+    "idx_stream_token_id": "stream(token_id)",
+    "idx_stream_swap_id": "stream(swap_id)",
+    # Pairs with open orders of a wallet and order events of a pair
+    "idx_swap_owner_id": "swap(owner_id, end_timestamp)",
+    "idx_swap_pair_start": "swap(pair_id, start_timestamp)",
+    "idx_swap_pair_end": "swap(pair_id, end_timestamp)",
+    "idx_swap_to_pair_stream_id": "swap(to_pair_stream_id)",
+    "idx_swap_from_pair_stream_id": "swap(from_pair_stream_id)",
+    "idx_stream_archive_from_id": "stream_archive(from_id, end_timestamp)",
+    "idx_stream_archive_to_id": "stream_archive(to_id, end_timestamp)",
+}
+# Each side of the (from_id = ? OR to_id = ?) wallet queries, which are
+# written as a UNION ALL of one branch per side
+for column in ("from_id", "to_id"):
+    INDEXES[f"idx_stream_{column}_token"] = f"stream({column}, token_id, end_timestamp)"
+    # Covering indexes of the non accrued streams starting or ending between
+    # an accumulator checkpoint and a timestamp
+    INDEXES[
+        f"idx_stream_{column}_open_start"
+    ] = f"stream({column}, token_id, start_timestamp, duration, amount) WHERE accrued = 0"
+    INDEXES[
+        f"idx_stream_{column}_open_end"
+    ] = f"stream({column}, token_id, end_timestamp, start_timestamp, duration, amount) WHERE accrued = 0"
+
+
+def create_tables(connection):
+    for table, columns in TABLES.items():
+        connection.execute(f"CREATE TABLE IF NOT EXISTS {table} ({columns})")
+
+
+def create_views(connection):
+    for view, query in VIEWS.items():
+        connection.execute(f"CREATE VIEW IF NOT EXISTS {view} AS {query}")
+
+
+def drop_views(connection):
+    for view in VIEWS:
+        connection.execute(f"DROP VIEW IF EXISTS {view}")
+
+
+def create_indexes(connection):
+    """Creates the missing indexes and drops the ones no longer listed in INDEXES."""
+    existing = [
+        name
+        for (name,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'index' AND name LIKE 'idx\\_%' ESCAPE '\\'"
         )
-        """
+    ]
+    for name in existing:
+        if name not in INDEXES:
+            connection.execute(f"DROP INDEX {name}")
+    for name, definition in INDEXES.items():
+        connection.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+
+def get_table_names(connection):
+    return [
+        name
+        for (name,) in connection.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table'"
+        )
+    ]
+
+
+def get_columns(connection, table):
+    """Stored columns of the table, generated columns are left out."""
+    return [row[1] for row in connection.execute(f"PRAGMA table_info({table})")]
+
+
+def rebuild_table(connection, table):
+    """
+    Recreates the table with its current layout in TABLES, copying the rows of
+    the columns both layouts have in one statement. Foreign keys must be off,
+    the table is dropped and renamed while other tables reference it.
+    """
+    # Views can not refer to a missing table while it is renamed
+    drop_views(connection)
+    rebuilt = f"{table}_rebuild"
+    connection.execute(f"CREATE TABLE {rebuilt} ({TABLES[table]})")
+    columns = ", ".join(
+        column
+        for column in get_columns(connection, rebuilt)
+        if column in get_columns(connection, table)
+    )
+    connection.execute(
+        f"INSERT INTO {rebuilt} ({columns}) SELECT {columns} FROM {table}"
     )
+    # Keep the AUTOINCREMENT counter so ids of deleted rows are never reused
+    sequence = connection.execute(
+        "SELECT seq FROM sqlite_sequence WHERE name = ?", (table,)
+    ).fetchone()
+    connection.execute(f"DROP TABLE {table}")
+    connection.execute(f"ALTER TABLE {rebuilt} RENAME TO {table}")
+    if sequence is not None:
+        connection.execute(
+            "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?",
+            (sequence[0], table),
+        )
+    create_views(connection)
+    create_indexes(connection)
+
+
+# Tables of the address keyed layout the dapp shipped with, before the schema
+# was versioned, in creation order
+BASELINE_TABLES = ("account", "token", "pair", "balance", "swap", "stream")
 
+
+def is_baseline(connection):
+    return get_columns(connection, "account") == ["address"]
+
+
+def copy_baseline_rows(connection):
+    """Copies the rows of the baseline_* tables to the current tables, replacing
+    addresses by account ids. Amounts are copied as they are, TEXT, for
+    migrate_amounts_to_blob."""
+    cursor = connection.cursor()
+    cursor.execute(
+        "INSERT INTO account (address) SELECT address FROM baseline_account ORDER BY rowid"
+    )
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS token (
-            address TEXT PRIMARY KEY,
-            total_supply TEXT NOT NULL,
-            FOREIGN KEY (address) REFERENCES account(address)
-        )
+        INSERT INTO token (id, total_supply)
+        SELECT a.id, t.total_supply
+        FROM baseline_token t JOIN account a ON a.address = t.address
         """
     )
-
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS pair (
-            address TEXT PRIMARY KEY,
-            token_0_address TEXT NOT NULL,
-            token_1_address TEXT NOT NULL,
-            last_timestamp_processed INTEGER NOT NULL DEFAULT 0,
-            FOREIGN KEY (address) REFERENCES token(address)
-            FOREIGN KEY (token_0_address) REFERENCES token(address)
-            FOREIGN KEY (token_1_address) REFERENCES token(address)
-        )
+        INSERT INTO pair (id, token_0_id, token_1_id, last_timestamp_processed)
+        SELECT a.id, a0.id, a1.id, p.last_timestamp_processed
+        FROM baseline_pair p
+        JOIN account a ON a.address = p.address
+        JOIN account a0 ON a0.address = p.token_0_address
+        JOIN account a1 ON a1.address = p.token_1_address
         """
     )
-
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS balance (
-            amount TEXT NOT NULL,
-            account_address TEXT NOT NULL,
-            token_address TEXT NOT NULL,
-            FOREIGN KEY (account_address) REFERENCES account(address),
-            FOREIGN KEY (token_address) REFERENCES token(address),
-            PRIMARY KEY (account_address, token_address)
-        )
+        INSERT INTO balance (amount, account_id, token_id)
+        SELECT b.amount, a.id, t.id
+        FROM baseline_balance b
+        JOIN account a ON a.address = b.account_address
+        JOIN account t ON t.address = b.token_address
         """
     )
-
     cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS swap (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            pair_address TEXT NOT NULL,
-            FOREIGN KEY (pair_address) REFERENCES token(address)
-        )
+        INSERT INTO stream (id, from_id, to_id, start_timestamp, duration, amount,
+            token_id, accrued, swap_id)
+        SELECT s.id, f.id, t.id, s.start_timestamp, s.duration, s.amount,
+            k.id, s.accrued, CAST(s.swap_id AS INTEGER)
+        FROM baseline_stream s
+        JOIN account f ON f.address = s.from_address
+        JOIN account t ON t.address = s.to_address
+        JOIN account k ON k.address = s.token_address
         """
     )
 
-    cursor.execute(
+
+def rebuild_baseline_swaps(connection):
+    """
+    Fills the order legs of the swaps from their streams. The stream to the pair
+    is the order, its rate is the one the baseline engine used, and the stream
+    from the pair is the payout, settled until the pair was last processed.
+    Orders cancelled before their start lost their stream to the pair and are
+    left empty, ending at their start.
+    """
+    cursor = connection.cursor()
+    swaps = cursor.execute(
         """
-        CREATE TABLE IF NOT EXISTS stream (
-            id INTEGER PRIMARY KEY AUTOINCREMENT,
-            from_address TEXT NOT NULL,
-            to_address TEXT NOT NULL,
-            start_timestamp INTEGER NOT NULL,
-            duration INTEGER NOT NULL,
-            amount TEXT NOT NULL,
-            token_address TEXT NOT NULL,
-            accrued INTEGER NOT NULL,
-            swap_id TEXT,
-            FOREIGN KEY (token_address) REFERENCES token(address),
-            FOREIGN KEY (from_address) REFERENCES account(address),
-            FOREIGN KEY (to_address) REFERENCES account(address),
-            FOREIGN KEY (swap_id) REFERENCES swap(id)
-        )
+        SELECT s.id, p.id, p.token_0_id, p.token_1_id, p.last_timestamp_processed
+        FROM baseline_swap s
+        JOIN account a ON a.address = s.pair_address
+        JOIN pair p ON p.id = a.id
+        ORDER BY s.id
         """
-    )
+    ).fetchall()
+    for (swap_id, pair_id, token_0_id, token_1_id, last_timestamp_processed) in swaps:
+        # stream id, receiver, start, duration, amount and token of each leg
+        legs = {}
+        for (stream_id, to_id, *leg) in cursor.execute(
+            """
+            SELECT id, to_id, start_timestamp, duration, amount, token_id
+            FROM stream WHERE swap_id = ?
+            """,
+            (swap_id,),
+        ).fetchall():
+            legs[to_id == pair_id] = (stream_id, to_id, *leg)
 
-    cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_stream_from_address ON stream(from_address)"
+        (payout_stream_id, owner_id, start_timestamp, _, _, token_out_id) = legs[False]
+        if True in legs:
+            order = legs[True]
+            (to_pair_stream_id, _, start_timestamp, duration, amount, token_in_id) = order
+            end_timestamp = start_timestamp + duration
+            rate = str_to_int(amount) // duration if duration > 0 else 0
+        else:
+            to_pair_stream_id = None
+            end_timestamp = start_timestamp
+            token_in_id = token_0_id if token_out_id == token_1_id else token_1_id
+            rate = 0
+        # Running and ended orders are settled, they enter the pool at zero earnings
+        is_in_pool = (
+            end_timestamp > start_timestamp
+            and start_timestamp <= last_timestamp_processed
+        )
+        cursor.execute(
+            """
+            INSERT INTO swap (id, pair_id, owner_id, start_timestamp, end_timestamp,
+                token_in_id, rate, to_pair_stream_id, from_pair_stream_id,
+                earnings_checkpoint)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                swap_id,
+                pair_id,
+                owner_id,
+                start_timestamp,
+                end_timestamp,
+                token_in_id,
+                int_to_str(rate),
+                to_pair_stream_id,
+                payout_stream_id,
+                int_to_str(0) if is_in_pool else None,
+            ),
+        )
+
+
+def rebuild_baseline_pools(connection):
+    """
+    Order pools of the pairs at the time they were last processed: the sell
+    rates of the running orders and the reserves, the pair's balances then,
+    which is what the baseline engine swapped against.
+    """
+    cursor = connection.cursor()
+    pairs = cursor.execute(
+        "SELECT id, token_0_id, token_1_id, last_timestamp_processed FROM pair"
+    ).fetchall()
+    for (pair_id, token_0_id, token_1_id, last_timestamp_processed) in pairs:
+        pair_address = get_account_address(connection, pair_id)
+        sell_rates = [0, 0]
+        for (token_in_id, rate) in cursor.execute(
+            """
+            SELECT token_in_id, rate FROM swap
+            WHERE pair_id = ? AND earnings_checkpoint IS NOT NULL
+            AND end_timestamp > ?
+            """,
+            (pair_id, last_timestamp_processed),
+        ).fetchall():
+            sell_rates[0 if token_in_id == token_0_id else 1] += str_to_int(rate)
+        token_addresses = [
+            get_account_address(connection, token_id)
+            for token_id in (token_0_id, token_1_id)
+        ]
+        pool = {
+            "last_timestamp_processed": last_timestamp_processed,
+            "next_event_timestamp": get_pair_next_event_timestamp(
+                connection, pair_address, last_timestamp_processed
+            ),
+            "sell_rates": sell_rates,
+            "earnings_per_rate": [0, 0],
+            "reserves": [
+                get_balance(connection, pair_address, token_address)
+                + get_wallet_streamed_amount(
+                    connection,
+                    pair_address,
+                    token_address,
+                    last_timestamp_processed,
+                    last_timestamp_processed,
+                )
+                for token_address in token_addresses
+            ],
+        }
+        cursor.execute(UPDATE_PAIR_POOL, pair_pool_row(pair_id, pool))
+
+
+def upgrade_baseline(connection):
+    """First step: rebuilds a database of the baseline layout and creates the
+    missing tables of the others, which must then have every current column
+    the later steps do not add."""
+    if is_baseline(connection):
+        rebuild_baseline(connection)
+    else:
+        create_tables(connection)
+    missing = get_missing_columns(connection)
+    if missing:
+        raise Exception(
+            f"Database layout is unknown, columns missing: {missing}. "
+            "A reset is required, run `python sqlite.py reset`."
+        )
+
+
+def rebuild_baseline(connection):
+    """
+    Moves a database of the address keyed layout the dapp shipped with to the
+    current tables. Everything they add is derived from the stream and pair
+    rows: account ids, swap order legs, the stream accumulators and the pair
+    pools.
+    """
+    # Account ids are assigned anew
+    clear_account_cache()
+    sequences = (
+        dict(connection.execute("SELECT name, seq FROM sqlite_sequence"))
+        if "sqlite_sequence" in get_table_names(connection)
+        else {}
     )
-    cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_stream_to_address ON stream(to_address)"
+    for table in BASELINE_TABLES:
+        connection.execute(f"ALTER TABLE {table} RENAME TO baseline_{table}")
+    create_tables(connection)
+    create_indexes(connection)
+
+    copy_baseline_rows(connection)
+    update_stream_accumulators(
+        connection,
+        [
+            (stream_from_row(connection, row), 1)
+            for row in connection.execute(
+                f"SELECT {STREAM_COLUMNS} FROM stream WHERE accrued = 0 ORDER BY id"
+            ).fetchall()
+        ],
     )
-    cursor.execute(
-        "CREATE INDEX IF NOT EXISTS idx_stream_token_address ON stream(token_address)"
+    rebuild_baseline_swaps(connection)
+    rebuild_baseline_pools(connection)
+
+    for table in reversed(BASELINE_TABLES):
+        connection.execute(f"DROP TABLE baseline_{table}")
+    # Ids of deleted rows are never reused
+    for table in ("stream", "swap"):
+        if table in sequences:
+            connection.execute(
+                "UPDATE sqlite_sequence SET seq = MAX(seq, ?) WHERE name = ?",
+                (sequences[table], table),
+            )
+
+
+def get_missing_columns(connection):
+    """
+    Columns of the current layout a database does not have, by table. Every
+    table but stream_archive has them once the database was upgraded from the
+    baseline layout.
+    """
+    layout = sqlite3.connect(":memory:")
+    create_tables(layout)
+    missing = {}
+    for table in TABLES:
+        if table == "stream_archive":
+            continue
+        columns = get_columns(connection, table)
+        missing_columns = [
+            column for column in get_columns(layout, table) if column not in columns
+        ]
+        if missing_columns:
+            missing[table] = missing_columns
+    layout.close()
+    return missing
+
+
+def migrate_amounts_to_blob(connection):
+    """Rewrites the decimal TEXT amounts, those rebuild_baseline copied from
+    the baseline layout, as BLOBs."""
+    connection.create_function(
+        "amount_to_blob",
+        1,
+        lambda amount: int_to_blob(str_to_int(amount)),
+        deterministic=True,
     )
-    cursor.execute("CREATE INDEX IF NOT EXISTS idx_stream_accrued ON stream(accrued)")
+    cursor = connection.cursor()
+    for table, column in AMOUNT_COLUMNS:
+        cursor.execute(
+            f"""
+            UPDATE {table} SET {column} = amount_to_blob({column})
+            WHERE typeof({column}) = 'text'
+            """
+        )
 
-    conn.commit()
 
+def add_stream_end_timestamp(connection):
+    # A stored generated column can not be added with ALTER TABLE
+    if "end_timestamp" not in [
+        row[1] for row in connection.execute("PRAGMA table_xinfo(stream)")
+    ]:
+        rebuild_table(connection, "stream")
+
+
+def add_stream_archive(connection):
+    create_tables(connection)
+    create_views(connection)
+    create_indexes(connection)
+    archive_streams(connection)
+
+
+# Ordered migration steps, the schema version of a database is the number of
+# steps applied to it. Steps are only ever appended.
+MIGRATIONS = (
+    upgrade_baseline,
+    migrate_amounts_to_blob,
+    add_stream_end_timestamp,
+    create_indexes,
+    add_stream_archive,
+)
+SCHEMA_VERSION = len(MIGRATIONS)
+
+
+def get_schema_version(connection):
+    return connection.execute("PRAGMA user_version").fetchone()[0]
+
+
+def migrate(connection):
+    """
+    Brings the database to SCHEMA_VERSION in one transaction. An empty database
+    gets the current layout directly, others run the steps they are missing.
+    """
+    version = get_schema_version(connection)
+    if version > SCHEMA_VERSION:
+        raise Exception(
+            f"Database schema version {version} is newer than {SCHEMA_VERSION}"
+        )
+    if version == SCHEMA_VERSION:
+        return
+
+    connection.execute("PRAGMA foreign_keys = OFF")
+    try:
+        connection.execute("BEGIN")
+        is_empty = (
+            connection.execute(
+                "SELECT COUNT(*) FROM sqlite_master WHERE type = 'table'"
+            ).fetchone()[0]
+            == 0
+        )
+        if is_empty:
+            create_tables(connection)
+            create_views(connection)
+            create_indexes(connection)
+        else:
+            for step in MIGRATIONS[version:]:
+                step(connection)
+        violations = connection.execute("PRAGMA foreign_key_check").fetchall()
+        if violations:
+            raise Exception(f"Foreign key violations after migration: {violations}")
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION}")
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.execute("PRAGMA foreign_keys = ON")
+
+
+def initialise_db():
+    """Creates the database or migrates it to the current schema, keeping its data."""
+    conn = get_connection()
+    migrate(conn)
     conn.close()
 
 
-if __name__ == "__main__":
+def reset_db():
+    """Deletes the database and creates an empty one."""
+    close_connections()
+    for path in (db_file_path, f"{db_file_path}-wal", f"{db_file_path}-shm"):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+    clear_account_cache()
     initialise_db()
+
+
+if __name__ == "__main__":
+    if sys.argv[1:] == ["reset"]:
+        reset_db()
+    else:
+        initialise_db()
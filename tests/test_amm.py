@@ -1,21 +1,23 @@
 import os
 import unittest
+from fractions import Fraction
 from unittest.mock import MagicMock, Mock, patch
 
 import requests
 from dapp.amm import AMM
-from dapp.db import get_connection
-from dapp.pair import Pair
+from dapp.db import get_connection, get_pair_pool
+from dapp.hook import execute_pool, settle_order
+from dapp.pair import Pair, get_pair_metadata, load_pair_registry, pair_registry
 from dapp.streamabletoken import StreamableToken, hook
-from dapp.util import get_amount_out
-from sqlite import initialise_db
+from dapp.util import EARNINGS_PRECISION, get_amount_out
+from sqlite import reset_db
 from tests.utils import calculate_total_supply_token
 
 
 class TestAmm(unittest.TestCase):
     def setUp(self):
         os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
-        initialise_db()
+        reset_db()
         self.connection = get_connection()
         self.mock_post = Mock()
         mock_response = Mock()
@@ -244,6 +246,300 @@ class TestAmm(unittest.TestCase):
 
         assert future_balance_token_two_trader_mod > future_balance_token_two_trader
 
+    @patch("requests.post")
+    def test_instant_swap_updates_reserves(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        amount_in = 10**18
+        amount_out = get_amount_out(
+            amount_in, self.initial_balance, self.initial_balance
+        )
+        self.token_two.mint(amount_in, self.trader_address)
+        self.swap(amount_in, 0, 0, self.trader_address, path="l")
+
+        (reserve_one, reserve_two) = self.amm.get_reserves(
+            self.token_one_address, self.token_two_address, self.current_timestamp
+        )
+        self.assertEqual(reserve_one, self.initial_balance - amount_out)
+        self.assertEqual(reserve_two, self.initial_balance + amount_in)
+        self.assertEqual(
+            reserve_two,
+            self.token_two.balance_of(self.pair.get_address(), self.current_timestamp),
+        )
+
+    @patch("requests.post")
+    def test_pair_registry_is_loaded_from_pairs(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+        self.connection.commit()
+
+        pair_registry.clear()
+        load_pair_registry(self.connection)
+        self.assertEqual(
+            pair_registry,
+            {
+                frozenset(
+                    (self.token_one.get_address(), self.token_two.get_address())
+                ): (
+                    self.pair.get_address(),
+                    self.pair.token0.get_address(),
+                    self.pair.token1.get_address(),
+                )
+            },
+        )
+        # Both token orders, checksummed or not, resolve to the same pair
+        self.assertIs(
+            self.amm.get_pair(self.token_two_address, self.token_one_address),
+            self.amm.get_pair(self.token_one_address.lower(), self.token_two_address),
+        )
+
+    @patch("dapp.pair.PAIR_REGISTRY_SIZE", 2)
+    def test_pair_registry_is_bounded(self):
+        tokens = [self.token_one_address, self.token_two_address, self.random_address]
+        pair_registry.clear()
+        get_pair_metadata(tokens[0], tokens[1])
+        get_pair_metadata(tokens[0], tokens[2])
+        # Used again, so the pair of the first and last tokens is evicted instead
+        get_pair_metadata(tokens[1], tokens[0])
+        get_pair_metadata(tokens[1], tokens[2])
+
+        self.assertEqual(
+            list(pair_registry),
+            [frozenset(tokens[:2]), frozenset(tokens[1:])],
+        )
+        # Evicted pairs are computed again
+        self.assertEqual(
+            get_pair_metadata(tokens[2], tokens[0])[0],
+            Pair(self.connection, tokens[0], tokens[2]).get_address(),
+        )
+
+    @patch("requests.post")
+    def test_swap_row_references_streams(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        swap_duration = 1000
+        self.token_one.mint(10**18, self.trader_address)
+        self.swap(10**18, 0, swap_duration, self.trader_address)
+
+        (token_in_address, rate, to_pair_stream_id, from_pair_stream_id) = (
+            self.connection.execute(
+                """
+                SELECT a.address, s.rate, s.to_pair_stream_id, s.from_pair_stream_id
+                FROM swap s
+                JOIN account a ON a.id = s.token_in_id
+                """
+            ).fetchone()
+        )
+        self.assertEqual(token_in_address, self.token_one.get_address())
+        self.assertEqual(int(rate), 10**18 // swap_duration)
+        to_pair_stream = self.token_one.get_stream_by_id(to_pair_stream_id)
+        self.assertEqual(to_pair_stream.to_address, self.pair.get_address())
+        from_pair_stream = self.token_two.get_stream_by_id(from_pair_stream_id)
+        self.assertEqual(from_pair_stream.from_address, self.pair.get_address())
+        self.assertEqual(from_pair_stream.to_address, self.trader_address)
+
+    @patch("requests.post")
+    def test_transfer_without_orders_skips_pairs(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        swap_duration = 1000
+        self.token_one.mint(10**18, self.trader_address)
+        self.swap(10**18, 0, swap_duration, self.trader_address)
+        pool = get_pair_pool(self.connection, self.pair.get_address())
+        self.assertEqual(pool["next_event_timestamp"], swap_duration)
+
+        # A wallet without orders does not move the pair forward
+        self.token_one.transfer(
+            receiver=self.random_address,
+            amount=10,
+            duration=0,
+            start_timestamp=swap_duration // 2,
+            sender=self.lp_address,
+            current_timestamp=swap_duration // 2,
+        )
+        pool = get_pair_pool(self.connection, self.pair.get_address())
+        self.assertEqual(pool["last_timestamp_processed"], 0)
+
+        # The trader's orders bring the pair to the order's end
+        hook(self.connection, self.token_one_address, self.trader_address, swap_duration)
+        pool = get_pair_pool(self.connection, self.pair.get_address())
+        self.assertEqual(pool["last_timestamp_processed"], swap_duration)
+        self.assertEqual(pool["sell_rates"], [0, 0])
+        self.assertIsNone(pool["next_event_timestamp"])
+
+    @patch("requests.post")
+    def test_cancel_swap(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        swap_duration = 1000
+        trader_swap_amt = 10 * 10**18
+        self.token_one.mint(trader_swap_amt, self.trader_address)
+        self.swap(trader_swap_amt, 0, swap_duration, self.trader_address)
+        to_pair_stream = [
+            stream
+            for stream in self.token_one.get_streams(self.trader_address)
+            if stream.to_address == self.pair.get_address()
+        ][0]
+
+        # Cancel the order half way through
+        self.token_one.cancel_stream(
+            stream_id=to_pair_stream.id,
+            sender=self.trader_address,
+            current_timestamp=swap_duration // 2,
+        )
+
+        self.assertEqual(
+            self.token_one.balance_of(self.trader_address, swap_duration),
+            trader_swap_amt // 2,
+        )
+        token_two_out = self.token_two.future_balance_of(
+            self.trader_address, swap_duration * 2
+        )
+        self.assertGreater(token_two_out, 0)
+        # Nothing is earned once the order has left the pool
+        self.assertEqual(
+            get_pair_pool(self.connection, self.pair.get_address())["sell_rates"],
+            [0, 0],
+        )
+        self.assertEqual(
+            self.token_two.future_balance_of(self.trader_address, swap_duration * 4),
+            token_two_out,
+        )
+
+    @patch("requests.post")
+    def test_cancel_swap_before_start(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        swap_start = 500
+        swap_duration = 1000
+        trader_swap_amt = 10 * 10**18
+        self.token_one.mint(trader_swap_amt, self.trader_address)
+        self.swap(trader_swap_amt, swap_start, swap_duration, self.trader_address)
+        to_pair_stream = [
+            stream
+            for stream in self.token_one.get_streams(self.trader_address)
+            if stream.to_address == self.pair.get_address()
+        ][0]
+
+        # Cancel the order before it starts, its stream to the pair is deleted
+        self.token_one.cancel_stream(
+            stream_id=to_pair_stream.id,
+            sender=self.trader_address,
+            current_timestamp=swap_start // 2,
+        )
+
+        self.assertIsNone(self.token_one.get_stream_by_id(to_pair_stream.id))
+        self.assertIsNone(
+            self.connection.execute("SELECT to_pair_stream_id FROM swap").fetchone()[0]
+        )
+        self.assertEqual(
+            self.token_one.balance_of(self.trader_address, swap_start + swap_duration),
+            trader_swap_amt,
+        )
+        self.assertEqual(
+            self.token_two.future_balance_of(
+                self.trader_address, (swap_start + swap_duration) * 2
+            ),
+            0,
+        )
+        self.assertEqual(
+            get_pair_pool(self.connection, self.pair.get_address())["sell_rates"],
+            [0, 0],
+        )
+
+    @patch("requests.post")
+    def test_hook_reads_pending_pools_without_flushing(self, mock_post):
+        self.add_liquidity_lp(self.initial_balance, self.initial_balance)
+
+        swap_duration = 1000
+        self.token_one.mint(10**18, self.trader_address)
+        self.swap(10**18, 0, swap_duration, self.trader_address)
+        self.connection.commit()
+
+        def stored_last_timestamp_processed():
+            return self.connection.execute(
+                "SELECT last_timestamp_processed FROM pair"
+            ).fetchone()[0]
+
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        for timestamp in (swap_duration // 4, swap_duration // 2):
+            hook(self.connection, self.token_two_address, self.trader_address, timestamp)
+        self.connection.set_trace_callback(None)
+
+        # The pool moved in the unit of work only, the hook compared with it
+        self.assertFalse([s for s in statements if "UPDATE pair" in s])
+        self.assertEqual(stored_last_timestamp_processed(), 0)
+        pool = get_pair_pool(self.connection, self.pair.get_address())
+        self.assertEqual(pool["last_timestamp_processed"], swap_duration // 2)
+        self.assertGreater(
+            self.token_two.balance_of(self.trader_address, swap_duration // 2), 0
+        )
+
+        self.connection.commit()
+        self.assertEqual(stored_last_timestamp_processed(), swap_duration // 2)
+
+    def test_order_payouts_stay_within_pool_amounts_out(self):
+        # Odd rates and reserves so every earnings increment and payout is floored
+        pool = {
+            "sell_rates": [0, 0],
+            "earnings_per_rate": [0, 0],
+            "reserves": [10**24 + 1, 3 * 10**24 + 7],
+        }
+        orders = [
+            {
+                "id": order_id,
+                "direction": direction,
+                "rate": rate,
+                "start": 0,
+                "earnings_checkpoint": 0,
+                "payout_amount": 0,
+                "payout_stream_id": order_id,
+            }
+            for order_id, (direction, rate) in enumerate(
+                [(0, 10**15 + 1), (0, 7 * 10**14 + 3), (0, 333), (1, 2 * 10**15 + 9)]
+            )
+        ]
+        for order in orders:
+            pool["sell_rates"][order["direction"]] += order["rate"]
+        sell_rates = list(pool["sell_rates"])
+
+        amounts_out = [0, 0]
+        (executions, settlements, timestamp) = (0, 0, 0)
+        for increments in ([1, 7, 60], [3600, 13, 86400]):
+            for increment in increments:
+                reserves = list(pool["reserves"])
+                execute_pool(pool, increment)
+                # Direction 0 is paid in token 1 and direction 1 in token 0
+                for direction in (0, 1):
+                    reserve = 1 - direction
+                    amounts_out[direction] += (
+                        reserves[reserve]
+                        + increment * sell_rates[reserve]
+                        - pool["reserves"][reserve]
+                    )
+                executions += 1
+                timestamp += increment
+            for order in orders:
+                settle_order(pool, order, timestamp, {}, {})
+            settlements += 1
+
+        for direction in (0, 1):
+            direction_orders = [o for o in orders if o["direction"] == direction]
+            self.assertLessEqual(
+                sum(order["payout_amount"] for order in direction_orders),
+                amounts_out[direction],
+            )
+            for order in direction_orders:
+                exact_payout = Fraction(
+                    order["rate"] * amounts_out[direction], sell_rates[direction]
+                )
+                self.assertLessEqual(order["payout_amount"], exact_payout)
+                self.assertLess(
+                    exact_payout - order["payout_amount"],
+                    settlements
+                    + Fraction(executions * order["rate"], EARNINGS_PRECISION),
+                )
+
 
 if __name__ == "__main__":
     unittest.main()
@@ -0,0 +1,84 @@
+import json
+import os
+import sqlite3
+import unittest
+from unittest.mock import Mock, patch
+
+from dapp.core import handle_inspect
+from dapp.db import (
+    CACHE_SIZE,
+    MMAP_SIZE,
+    READ_POOL_SIZE,
+    get_write_connection,
+    read_connection,
+    read_connections,
+)
+from dapp.rollup import rollup_client
+from dapp.streamabletoken import StreamableToken
+from dapp.util import str_to_hex
+from sqlite import reset_db
+
+
+class TestConnections(unittest.TestCase):
+    def setUp(self):
+        os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
+        reset_db()
+        self.mock_post = Mock(return_value=Mock(status_code=200))
+        patcher = patch.object(rollup_client.session, "post", self.mock_post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.token_address = "0x1234567890AbcdEF1234567890ABCDEF12345673"
+        self.sender_address = "0x1234567890ABCDEF1234567890ABCDEF12345672"
+
+    def tearDown(self):
+        reset_db()
+
+    def test_write_connection_is_reused(self):
+        connection = get_write_connection()
+        self.assertIs(get_write_connection(), connection)
+        self.assertTrue(connection.warm)
+        self.assertEqual(connection.execute("PRAGMA foreign_keys").fetchone()[0], 1)
+
+    def test_read_connections_see_commits_and_are_pooled(self):
+        connection = get_write_connection()
+        StreamableToken(connection, self.token_address).mint(100, self.sender_address)
+        connection.commit()
+
+        with read_connection() as first:
+            token = StreamableToken(first, self.token_address)
+            self.assertEqual(token.get_stored_balance(self.sender_address), 100)
+            with self.assertRaises(sqlite3.OperationalError):
+                first.execute("DELETE FROM balance")
+
+        StreamableToken(connection, self.token_address).mint(10, self.sender_address)
+        connection.commit()
+
+        with read_connection() as second:
+            self.assertIs(second, first)
+            token = StreamableToken(second, self.token_address)
+            self.assertEqual(token.get_stored_balance(self.sender_address), 110)
+        self.assertEqual(read_connections, [first])
+
+    def test_connections_fit_the_machine(self):
+        connection = get_write_connection()
+        self.assertEqual(
+            connection.execute("PRAGMA cache_size").fetchone()[0], CACHE_SIZE
+        )
+        self.assertLessEqual(-CACHE_SIZE * 1024 + MMAP_SIZE, 32 * 1024 * 1024)
+
+        # Concurrent reads are served, but only READ_POOL_SIZE stay open
+        with read_connection() as first, read_connection() as second:
+            self.assertIsNot(first, second)
+        self.assertEqual(READ_POOL_SIZE, 1)
+        self.assertEqual(len(read_connections), READ_POOL_SIZE)
+
+    def test_inspect_can_not_write(self):
+        handle_inspect({"payload": str_to_hex("DELETE FROM account")})
+
+        payload = json.loads(self.mock_post.call_args.kwargs["data"])["payload"]
+        self.assertIn("readonly", bytes.fromhex(payload[2:]).decode())
+
+
+if __name__ == "__main__":
+    unittest.main()
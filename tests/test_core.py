@@ -0,0 +1,262 @@
+import json
+import os
+import unittest
+from unittest.mock import Mock, patch
+
+from dapp.amm import AMM
+from dapp.core import (
+    BINARY_FORMAT_VERSION,
+    SUCCESS_REPORT_STATUS,
+    ExecutionContext,
+    decode_binary_call,
+    encode_binary_call,
+    handle_action,
+    handle_advance,
+    is_success_report,
+)
+from dapp.db import get_write_connection
+from dapp.rollup import RecordingSink, rollup_client
+from dapp.streamabletoken import StreamableToken
+from dapp.util import get_amount_out, hex_to_str, str_to_hex
+from eth_abi.abi import decode
+from sqlite import reset_db
+
+
+class TestCore(unittest.TestCase):
+    def setUp(self):
+        os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
+        reset_db()
+        self.mock_post = Mock(return_value=Mock(status_code=200))
+        patcher = patch.object(rollup_client.session, "post", self.mock_post)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+        self.token_address = "0x1234567890AbcdEF1234567890ABCDEF12345673"
+        self.sender_address = "0x1234567890ABCDEF1234567890ABCDEF12345672"
+        self.receiver_address = "0xabCDEF1234567890ABcDEF1234567890aBCDeF12"
+
+        self.connection = get_write_connection()
+        self.token = StreamableToken(self.connection, self.token_address)
+        self.token.mint(100, self.sender_address)
+        self.connection.commit()
+        self.input_index = 0
+
+    def tearDown(self):
+        reset_db()
+
+    def input(self, payload, timestamp=0):
+        self.input_index += 1
+        if isinstance(payload, bytes):
+            payload = "0x" + (BINARY_FORMAT_VERSION + payload).hex()
+        else:
+            payload = str_to_hex(json.dumps(payload))
+        return {
+            "payload": payload,
+            "metadata": {
+                "msg_sender": self.sender_address,
+                "timestamp": timestamp,
+                "input_index": self.input_index,
+            },
+        }
+
+    def advance(self, payload, timestamp=0):
+        return handle_advance(self.input(payload, timestamp))
+
+    def stream_call(self, amount):
+        return {
+            "method": "stream",
+            "args": {
+                "token": self.token_address,
+                "receiver": self.receiver_address,
+                "amount": str(amount),
+                "duration": "0",
+                "start": "0",
+            },
+        }
+
+    def last_report(self):
+        (url,), kwargs = self.mock_post.call_args
+        self.assertTrue(url.endswith("/report"))
+        return json.loads(kwargs["data"])["payload"]
+
+    def last_result(self, result_types):
+        """Result of the compact report of the last input."""
+        payload = self.last_report()
+        self.assertTrue(is_success_report(payload))
+        report = bytes.fromhex(payload[2:])
+        self.assertEqual(report[:1], SUCCESS_REPORT_STATUS)
+        self.assertEqual(int.from_bytes(report[1:9], "big"), self.input_index)
+        return decode(result_types, report[9:])
+
+    def test_multicall_rolls_back_failing_calls_alone(self):
+        status = self.advance(
+            {
+                "method": "multicall",
+                "args": {
+                    "calls": [
+                        self.stream_call(30),
+                        self.stream_call(1000),
+                        {"method": "multicall", "args": {"calls": []}},
+                        self.stream_call(20),
+                    ]
+                },
+            }
+        )
+
+        self.assertEqual(status, "accept")
+        (accepted, errors) = self.last_result(["bool[]", "string[]"])
+        self.assertEqual(accepted, (True, False, False, True))
+        self.assertEqual(errors[2], "Unknown method multicall")
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.token.balance_of(self.sender_address, 0), 50)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 0), 50)
+        self.assertEqual(len(self.token.get_streams(self.receiver_address)), 2)
+
+    def test_multicall_rolls_back_failing_amm_calls(self):
+        other_token = StreamableToken(self.connection, self.receiver_address)
+        (balance, liquidity, amount_in) = (10**21, 10**20, 10**18)
+        self.token.mint(balance, self.sender_address)
+        other_token.mint(liquidity + amount_in, self.sender_address)
+        self.connection.commit()
+
+        def add_liquidity_call(amount):
+            return {
+                "method": "add_liquidity",
+                "args": {
+                    "token_a": self.token_address,
+                    "token_b": self.receiver_address,
+                    "token_a_desired": str(amount),
+                    "token_b_desired": str(amount),
+                    "token_a_min": "0",
+                    "token_b_min": "0",
+                    "to": self.sender_address,
+                },
+            }
+
+        def swap_call(amount_in):
+            return {
+                "method": "swap",
+                "args": {
+                    "amount_in": str(amount_in),
+                    "amount_out_min": "0",
+                    "start": "0",
+                    "duration": "0",
+                    "to": self.sender_address,
+                    "path": [self.token_address, self.receiver_address],
+                },
+            }
+
+        self.advance(
+            {
+                "method": "multicall",
+                "args": {
+                    "calls": [
+                        add_liquidity_call(liquidity),
+                        swap_call(amount_in),
+                        # More than the sender has left
+                        swap_call(balance),
+                        # Fails on the second token, once the first one moved
+                        add_liquidity_call(liquidity),
+                    ]
+                },
+            }
+        )
+
+        (accepted, _) = self.last_result(["bool[]", "string[]"])
+        self.assertEqual(accepted, (True, True, False, False))
+        amount_out = get_amount_out(amount_in, liquidity, liquidity)
+        self.assertEqual(
+            AMM(self.connection).get_reserves(
+                self.token_address, self.receiver_address, 0
+            ),
+            (liquidity + amount_in, liquidity - amount_out),
+        )
+        self.assertEqual(
+            self.token.balance_of(self.sender_address, 0),
+            100 + balance - liquidity - amount_in,
+        )
+        self.assertEqual(
+            other_token.balance_of(self.sender_address, 0), amount_in + amount_out
+        )
+
+    def test_success_reports(self):
+        self.assertEqual(self.advance(self.stream_call(10)), "accept")
+        self.assertEqual(self.last_result(["uint256"]), (1,))
+        # Status, input index and stream id
+        self.assertEqual(len(bytes.fromhex(self.last_report()[2:])), 41)
+
+        with patch("dapp.core.verbose_reports", True):
+            self.advance(self.stream_call(10))
+        report = json.loads(hex_to_str(self.last_report()))
+        self.assertTrue(is_success_report(self.last_report()))
+        echo = json.loads(hex_to_str(report["payload"]))
+        self.assertEqual(echo["metadata"]["input_index"], 2)
+        self.assertEqual(report["result"], [2])
+
+    def test_binary_inputs(self):
+        def binary_stream_call(amount):
+            args = self.stream_call(amount)["args"]
+            return encode_binary_call(
+                "stream", {**args, "amount": amount, "duration": 0, "start": 0}
+            )
+
+        self.assertEqual(self.advance(binary_stream_call(10)), "accept")
+        status = self.advance(
+            encode_binary_call(
+                "multicall",
+                {"calls": [binary_stream_call(1000), binary_stream_call(20)]},
+            )
+        )
+
+        self.assertEqual(status, "accept")
+        (accepted, _) = self.last_result(["bool[]", "string[]"])
+        self.assertEqual(accepted, (False, True))
+        self.assertEqual(self.token.balance_of(self.sender_address, 0), 70)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 0), 30)
+        # 1 version, 4 selector, 2 * 20 addresses, 32 amount and 2 * 8 timestamps
+        self.assertEqual(len(binary_stream_call(10)) + 1, 93)
+
+    def test_binary_swap_path(self):
+        args = {
+            "amount_in": 10**18,
+            "amount_out_min": 1,
+            "start": 10,
+            "duration": 100,
+            "to": self.receiver_address.lower(),
+            "path": [self.token_address.lower(), self.sender_address.lower()],
+        }
+        self.assertEqual(
+            decode_binary_call(encode_binary_call("swap", args)), ("swap", args)
+        )
+        with self.assertRaises(Exception):
+            decode_binary_call(encode_binary_call("swap", args)[:-1])
+
+    def test_withdraw_voucher(self):
+        withdraw = {
+            "method": "withdraw",
+            "args": {"token": self.token_address, "amount": "10"},
+        }
+        self.advance(withdraw)
+        (url,), kwargs = self.mock_post.call_args_list[0]
+        self.assertTrue(url.endswith("/voucher"))
+        voucher = json.loads(kwargs["data"])
+
+        # A replay records the same voucher without any request
+        self.mock_post.reset_mock()
+        sink = RecordingSink()
+        self.input_index -= 1
+        handle_action(self.input(withdraw), ExecutionContext(self.connection, sink))
+        self.assertEqual(sink.vouchers, [voucher])
+        self.assertTrue(voucher["payload"].startswith("0xa9059cbb"))
+        self.mock_post.assert_not_called()
+        self.assertEqual(self.token.balance_of(self.sender_address, 0), 80)
+
+    def test_failing_input_is_rolled_back(self):
+        self.assertEqual(self.advance({"method": "unknown"}), "reject")
+        self.assertFalse(is_success_report(self.last_report()))
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.token.balance_of(self.sender_address, 0), 100)
+
+
+if __name__ == "__main__":
+    unittest.main()
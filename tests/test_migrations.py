@@ -0,0 +1,303 @@
+import os
+import unittest
+
+from dapp.db import get_connection
+from dapp.streamabletoken import StreamableToken
+from dapp.util import blob_to_int
+from sqlite import (
+    AMOUNT_COLUMNS,
+    SCHEMA_VERSION,
+    get_schema_version,
+    initialise_db,
+    migrate,
+    reset_db,
+)
+from tests.utils import calculate_total_supply_token
+
+# Address keyed schema of the databases created before this series of changes
+BASELINE_SCHEMA = """
+    CREATE TABLE account (
+        address TEXT PRIMARY KEY
+    );
+    CREATE TABLE token (
+        address TEXT PRIMARY KEY,
+        total_supply TEXT NOT NULL,
+        FOREIGN KEY (address) REFERENCES account(address)
+    );
+    CREATE TABLE pair (
+        address TEXT PRIMARY KEY,
+        token_0_address TEXT NOT NULL,
+        token_1_address TEXT NOT NULL,
+        last_timestamp_processed INTEGER NOT NULL DEFAULT 0,
+        FOREIGN KEY (address) REFERENCES token(address)
+        FOREIGN KEY (token_0_address) REFERENCES token(address)
+        FOREIGN KEY (token_1_address) REFERENCES token(address)
+    );
+    CREATE TABLE balance (
+        amount TEXT NOT NULL,
+        account_address TEXT NOT NULL,
+        token_address TEXT NOT NULL,
+        FOREIGN KEY (account_address) REFERENCES account(address),
+        FOREIGN KEY (token_address) REFERENCES token(address),
+        PRIMARY KEY (account_address, token_address)
+    );
+    CREATE TABLE swap (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        pair_address TEXT NOT NULL,
+        FOREIGN KEY (pair_address) REFERENCES token(address)
+    );
+    CREATE TABLE stream (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        from_address TEXT NOT NULL,
+        to_address TEXT NOT NULL,
+        start_timestamp INTEGER NOT NULL,
+        duration INTEGER NOT NULL,
+        amount TEXT NOT NULL,
+        token_address TEXT NOT NULL,
+        accrued INTEGER NOT NULL,
+        swap_id TEXT,
+        FOREIGN KEY (token_address) REFERENCES token(address),
+        FOREIGN KEY (from_address) REFERENCES account(address),
+        FOREIGN KEY (to_address) REFERENCES account(address),
+        FOREIGN KEY (swap_id) REFERENCES swap(id)
+    );
+    CREATE INDEX idx_stream_from_address ON stream(from_address);
+    CREATE INDEX idx_stream_to_address ON stream(to_address);
+    CREATE INDEX idx_stream_token_address ON stream(token_address);
+    CREATE INDEX idx_stream_accrued ON stream(accrued);
+"""
+
+TOKEN_ONE = "0x1234567890AbcdEF1234567890aBcdef12345678"
+TOKEN_TWO = "0x1234567890abcdeF1234567890abcdEf12345679"
+PAIR = "0x74Aec73da91B7477101bA71F0AC91a282aacD143"
+LP = "0x1234567890ABcDeF1234567890AbcDef12345672"
+TRADER = "0xabCDEF1234567890ABcDEF1234567890aBCDeF12"
+RANDOM = "0x1234567890abCDeF1234567890aBcDEF12345670"
+ZERO = "0x0000000000000000000000000000000000000000"
+
+# Rows written by the baseline dapp: liquidity added at 0, two streams from the
+# LP, orders of the trader running from 0 to 1000 and from 100 to 800, one
+# starting at 2000, an instant swap at 10 and a transfer of the trader that
+# processed the pair until 400
+BASELINE_ROWS = {
+    "account": [
+        (address,) for address in (LP, TOKEN_ONE, TOKEN_TWO, PAIR, ZERO, TRADER, RANDOM)
+    ],
+    "token": [
+        (TOKEN_ONE, "110000000000001000000"),
+        (TOKEN_TWO, "110000000000000000000"),
+        (PAIR, "100000000000000000000"),
+    ],
+    "pair": [(PAIR, TOKEN_ONE, TOKEN_TWO, 400)],
+    "balance": [
+        ("1000000", LP, TOKEN_ONE),
+        ("0", LP, TOKEN_TWO),
+        ("100000", ZERO, PAIR),
+        ("99999999999999900000", LP, PAIR),
+        ("10000000000000000000", TRADER, TOKEN_ONE),
+        ("10000000000000000000", TRADER, TOKEN_TWO),
+        ("100000000000000000000", PAIR, TOKEN_ONE),
+        ("100000000000000000000", PAIR, TOKEN_TWO),
+    ],
+    "swap": [(1, PAIR), (2, PAIR), (3, PAIR), (4, PAIR)],
+    "stream": [
+        (1, LP, PAIR, 0, 0, "100000000000000000000", TOKEN_ONE, 1, None),
+        (2, LP, PAIR, 0, 0, "100000000000000000000", TOKEN_TWO, 1, None),
+        (3, LP, RANDOM, 0, 100, "1000", TOKEN_ONE, 0, None),
+        (4, LP, RANDOM, 0, 1000, "600", TOKEN_ONE, 0, None),
+        (5, TRADER, PAIR, 0, 1000, "1000000000000000000", TOKEN_ONE, 0, "1"),
+        (6, PAIR, TRADER, 0, 400, "386565560833309839", TOKEN_TWO, 0, "1"),
+        (7, TRADER, PAIR, 100, 700, "300000000000000000", TOKEN_TWO, 0, "2"),
+        (8, PAIR, TRADER, 100, 300, "124779746699899670", TOKEN_ONE, 0, "2"),
+        (9, TRADER, PAIR, 2000, 500, "500000000000000000", TOKEN_ONE, 0, "3"),
+        (10, PAIR, TRADER, 2000, 0, "0", TOKEN_TWO, 0, "3"),
+        (11, TRADER, PAIR, 10, 0, "10000000000000000", TOKEN_TWO, 0, "4"),
+        (12, PAIR, TRADER, 10, 0, "9700029097177573", TOKEN_ONE, 0, "4"),
+        (13, TRADER, RANDOM, 400, 0, "5", TOKEN_TWO, 0, None),
+    ],
+}
+# balance_of of the baseline dapp by (token, wallet) at 400, and at 3000 once a
+# transfer of the trader processed the pair until then
+BASELINE_BALANCES = {
+    400: {
+        (TOKEN_ONE, RANDOM): 1240,
+        (TOKEN_ONE, LP): 998760,
+        (TOKEN_ONE, PAIR): 100265520224202922757,
+        (TOKEN_ONE, TRADER): 9734479775797077243,
+        (TOKEN_TWO, RANDOM): 5,
+        (TOKEN_TWO, LP): 0,
+        (TOKEN_TWO, PAIR): 99752005867738118732,
+        (TOKEN_TWO, TRADER): 10247994132261881263,
+    },
+    3000: {
+        (TOKEN_ONE, RANDOM): 1605,
+        (TOKEN_ONE, LP): 998400,
+        (TOKEN_ONE, PAIR): 101198656646125994750,
+        (TOKEN_ONE, TRADER): 8801343353874005245,
+        (TOKEN_TWO, RANDOM): 10,
+        (TOKEN_TWO, LP): 0,
+        (TOKEN_TWO, PAIR): 98870935421926517486,
+        (TOKEN_TWO, TRADER): 11129064578073482504,
+    },
+}
+
+
+class TestMigrations(unittest.TestCase):
+    def setUp(self):
+        os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
+        reset_db()
+
+        self.token_address = "0x1234567890AbcdEF1234567890ABCDEF12345673"
+        self.sender_address = "0x1234567890ABCDEF1234567890ABCDEF12345672"
+
+    def create_baseline_db(self):
+        connection = get_connection()
+        connection.execute("PRAGMA foreign_keys = OFF")
+        for kind in ("view", "table"):
+            for (name,) in connection.execute(
+                "SELECT name FROM sqlite_master WHERE type = ? AND name NOT LIKE 'sqlite_%'",
+                (kind,),
+            ).fetchall():
+                connection.execute(f"DROP {kind} {name}")
+        connection.executescript(BASELINE_SCHEMA)
+        for table, rows in BASELINE_ROWS.items():
+            connection.executemany(
+                f"INSERT INTO {table} VALUES ({', '.join('?' * len(rows[0]))})", rows
+            )
+        connection.execute("PRAGMA user_version = 0")
+        connection.commit()
+        connection.close()
+
+    def assertBalances(self, connection, timestamp, delta):
+        for (token_address, wallet), balance in BASELINE_BALANCES[timestamp].items():
+            token = StreamableToken(connection, token_address)
+            self.assertAlmostEqual(
+                token.balance_of(wallet, timestamp),
+                balance,
+                delta=delta,
+                msg=f"{wallet} {token_address}",
+            )
+        for token_address in (TOKEN_ONE, TOKEN_TWO, PAIR):
+            self.assertEqual(
+                calculate_total_supply_token(connection, token_address),
+                StreamableToken(connection, token_address).get_stored_total_supply(),
+            )
+
+    def test_migrates_baseline_db(self):
+        self.create_baseline_db()
+
+        initialise_db()
+
+        connection = get_connection()
+        self.assertEqual(get_schema_version(connection), SCHEMA_VERSION)
+        self.assertEqual(connection.execute("PRAGMA foreign_key_check").fetchall(), [])
+        self.assertEqual(
+            connection.execute(
+                """
+                SELECT s.id, a.address, s.start_timestamp, s.end_timestamp, t.address,
+                    s.rate, s.to_pair_stream_id, s.from_pair_stream_id, s.earnings_checkpoint
+                FROM swap s
+                JOIN account a ON a.id = s.owner_id
+                JOIN account t ON t.id = s.token_in_id
+                """
+            ).fetchall(),
+            [
+                (1, TRADER, 0, 1000, TOKEN_ONE, str(10**15), 5, 6, "0"),
+                (2, TRADER, 100, 800, TOKEN_TWO, str(3 * 10**17 // 700), 7, 8, "0"),
+                (3, TRADER, 2000, 2500, TOKEN_ONE, str(10**15), 9, 10, None),
+                (4, TRADER, 10, 10, TOKEN_TWO, "0", 11, 12, None),
+            ],
+        )
+        for table, column in AMOUNT_COLUMNS:
+            self.assertEqual(
+                connection.execute(
+                    f"SELECT DISTINCT typeof({column}) FROM {table}"
+                ).fetchall(),
+                [("blob",)],
+            )
+        self.assertEqual(
+            [
+                blob_to_int(amount)
+                for (amount,) in connection.execute(
+                    "SELECT amount FROM stream_history ORDER BY id"
+                )
+            ],
+            [int(row[5]) for row in BASELINE_ROWS["stream"]],
+        )
+        token_one = StreamableToken(connection, TOKEN_ONE)
+        self.assertEqual(token_one.get_stored_balance(LP), 10**6)
+        self.assertEqual(token_one.get_stored_total_supply(), 110000000000001000000)
+        # The accrued streams were archived
+        self.assertEqual(
+            connection.execute("SELECT id FROM stream_archive").fetchall(), [(1,), (2,)]
+        )
+        # Streams in progress are rounded like every other stream of the current
+        # dapp, received amounts down and sent amounts up, 1 wei off at most
+        self.assertBalances(connection, 400, 1)
+        connection.close()
+
+    def test_migrated_baseline_db_keeps_running(self):
+        self.create_baseline_db()
+        initialise_db()
+
+        connection = get_connection()
+        pool = connection.execute(
+            "SELECT sell_rate_0, sell_rate_1, next_event_timestamp FROM pair"
+        ).fetchone()
+        self.assertEqual(pool, (str(10**15), str(3 * 10**17 // 700), 800))
+
+        # The orders keep running from where the baseline engine left them
+        for token_address in (TOKEN_TWO, TOKEN_ONE):
+            stream_id = StreamableToken(connection, token_address).transfer(
+                receiver=RANDOM,
+                amount=5,
+                duration=0,
+                start_timestamp=3000,
+                sender=TRADER,
+                current_timestamp=3000,
+            )
+        # New streams continue after the migrated ids
+        self.assertEqual(stream_id, 15)
+        # Payouts are credited per unit of sell rate instead of per order, each
+        # order's payout may be a few wei below the baseline engine's
+        self.assertBalances(connection, 3000, 2)
+        connection.close()
+
+    def test_rejects_unknown_layout(self):
+        connection = get_connection()
+        connection.execute("ALTER TABLE pair DROP COLUMN reserve_1")
+        connection.execute("PRAGMA user_version = 0")
+        connection.commit()
+        connection.close()
+
+        with self.assertRaisesRegex(Exception, "reset is required"):
+            initialise_db()
+
+        connection = get_connection()
+        self.assertEqual(get_schema_version(connection), 0)
+        connection.close()
+
+    def test_initialise_keeps_data(self):
+        connection = get_connection()
+        token = StreamableToken(connection, self.token_address)
+        token.mint(100, self.sender_address)
+        connection.commit()
+        connection.close()
+
+        initialise_db()
+
+        connection = get_connection()
+        token = StreamableToken(connection, self.token_address)
+        self.assertEqual(token.balance_of(self.sender_address, 0), 100)
+        connection.close()
+
+    def test_rejects_newer_schema(self):
+        connection = get_connection()
+        connection.execute(f"PRAGMA user_version = {SCHEMA_VERSION + 1}")
+        with self.assertRaises(Exception):
+            migrate(connection)
+        connection.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
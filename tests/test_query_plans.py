@@ -0,0 +1,129 @@
+import os
+import re
+import unittest
+from unittest.mock import Mock
+
+import requests
+from dapp.amm import AMM
+from dapp.db import get_connection
+from dapp.streamabletoken import StreamableToken
+from sqlite import reset_db
+
+# Tables whose size grows with usage, their rows must always be reached by an index
+GROWING_TABLES = (
+    "account",
+    "balance",
+    "stream",
+    "stream_archive",
+    "swap",
+    "accumulator",
+    "pair",
+    "token",
+)
+TABLE_REFERENCE = re.compile(
+    rf"\b(?:FROM|JOIN|UPDATE)\s+({'|'.join(GROWING_TABLES)})\b(?:\s+(?:AS\s+)?(\w+))?",
+    re.IGNORECASE,
+)
+SQL_KEYWORDS = {"where", "join", "left", "inner", "on", "union", "group", "order", "set"}
+
+
+def scanned_names(query):
+    """Names a full scan of a growing table shows up as in the query plan."""
+    names = set(GROWING_TABLES)
+    for (_, alias) in TABLE_REFERENCE.findall(query):
+        if alias and alias.lower() not in SQL_KEYWORDS:
+            names.add(alias)
+    return names
+
+
+class TestQueryPlans(unittest.TestCase):
+    def setUp(self):
+        os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
+        reset_db()
+        self.connection = get_connection()
+        mock_response = Mock()
+        mock_response.json.return_value = {"key": "value"}  # Mocked response
+        requests.post = Mock(return_value=mock_response)
+
+        self.token_one_address = "0x1234567890ABCDEF1234567890ABCDEF12345678"
+        self.token_two_address = "0x1234567890ABCDEF1234567890ABCDEF12345679"
+        self.lp_address = "0x1234567890ABCDEF1234567890ABCDEF12345672"
+        self.trader_address = "0xabCDEF1234567890ABcDEF1234567890aBCDeF12"
+
+        self.statements = []
+        self.connection.set_trace_callback(self.statements.append)
+
+    def run_scenario(self):
+        token_one = StreamableToken(self.connection, self.token_one_address)
+        token_two = StreamableToken(self.connection, self.token_two_address)
+        amm = AMM(self.connection)
+
+        token_one.mint(10**21, self.lp_address)
+        token_two.mint(10**21, self.lp_address)
+        amm.add_liquidity(
+            self.token_one_address,
+            self.token_two_address,
+            10**20,
+            10**20,
+            0,
+            0,
+            self.lp_address,
+            self.lp_address,
+            0,
+        )
+        stream_id = token_one.transfer(
+            receiver=self.trader_address,
+            amount=10**18,
+            duration=100,
+            start_timestamp=0,
+            sender=self.lp_address,
+            current_timestamp=0,
+        )
+        token_one.cancel_stream(
+            stream_id=stream_id, sender=self.lp_address, current_timestamp=50
+        )
+        for (start, duration) in ((50, 0), (60, 1000)):
+            amm.swap_exact_tokens_for_tokens(
+                amount_in=10**17,
+                amount_out_min=0,
+                path=[self.token_one_address, self.token_two_address],
+                start=start,
+                duration=duration,
+                to=self.trader_address,
+                msg_sender=self.trader_address,
+                current_timestamp=50,
+            )
+        token_two.transfer(
+            receiver=self.lp_address,
+            amount=1,
+            duration=0,
+            start_timestamp=500,
+            sender=self.trader_address,
+            current_timestamp=500,
+        )
+        token_two.balance_of(self.trader_address, 200)
+        token_two.future_balance_of(self.trader_address)
+        token_one.get_streams(self.trader_address)
+
+    def test_no_full_scans(self):
+        self.run_scenario()
+        self.connection.set_trace_callback(None)
+
+        queries = {
+            statement
+            for statement in self.statements
+            if re.match(r"\s*(SELECT|WITH|UPDATE|DELETE)\b", statement, re.IGNORECASE)
+        }
+        self.assertGreater(len(queries), 0)
+        for query in queries:
+            names = scanned_names(query)
+            plan = self.connection.execute(f"EXPLAIN QUERY PLAN {query}").fetchall()
+            for (_, _, _, detail) in plan:
+                self.assertFalse(
+                    detail.startswith("SCAN ") and detail.split()[1] in names,
+                    f"{detail} in plan of:\n{query}",
+                )
+
+
+if __name__ == "__main__":
+    unittest.main()
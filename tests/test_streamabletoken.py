@@ -3,16 +3,28 @@ import unittest
 from unittest.mock import MagicMock, Mock, patch
 
 import requests
-from dapp.db import get_connection
+from dapp.db import (
+    account_addresses,
+    account_ids,
+    clear_account_cache,
+    get_account_id,
+    get_connection,
+    get_max_end_timestamp_for_wallet,
+    token_ids,
+)
 from dapp.streamabletoken import StreamableToken
-from sqlite import initialise_db
-from tests.utils import calculate_total_supply_token
+from dapp.util import _checksum_address, normalize_address, to_checksum_address
+from sqlite import migrate_amounts_to_blob, reset_db
+from tests.utils import (
+    calculate_total_supply_token,
+    get_wallet_non_accrued_streamed_amount,
+)
 
 
 class TestStreamableToken(unittest.TestCase):
     def setUp(self):
         os.environ["DB_FILE_PATH"] = "test-dapp.sqlite"
-        initialise_db()
+        reset_db()
         self.connection = get_connection()
         self.mock_post = Mock()
         mock_response = Mock()
@@ -170,6 +182,82 @@ class TestStreamableToken(unittest.TestCase):
             0,
         )
 
+    def test_balance_of_overlapping_streams(self):
+        self.token.mint(1000, self.sender_address)
+
+        self.token.transfer(
+            receiver=self.receiver_address,
+            amount=100,
+            duration=1000,
+            start_timestamp=0,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+        self.token.transfer(
+            receiver=self.receiver_address,
+            amount=300,
+            duration=100,
+            start_timestamp=50,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+
+        for timestamp, received in ((0, 0), (50, 5), (100, 160), (200, 320)):
+            self.assertEqual(
+                self.token.balance_of(self.receiver_address, timestamp), received
+            )
+            self.assertEqual(
+                self.token.balance_of(self.sender_address, timestamp), 1000 - received
+            )
+
+        # Settling the ended stream keeps the balances unchanged
+        self.token.transfer(
+            receiver=self.random_address,
+            amount=10,
+            duration=0,
+            start_timestamp=200,
+            sender=self.receiver_address,
+            current_timestamp=200,
+        )
+        self.assertEqual(self.token.balance_of(self.receiver_address, 200), 310)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 600), 350)
+        self.assertEqual(self.token.balance_of(self.sender_address, 600), 640)
+        # Reads before the checkpoint unfold the streams that are still open
+        self.assertEqual(self.token.balance_of(self.receiver_address, 100), 310)
+
+    def test_streamed_sum_matches_balance_of(self):
+        self.token.mint(1000, self.sender_address)
+        self.token.mint(1000, self.receiver_address)
+        for amount, duration, start, sender, receiver in (
+            (100, 7, 0, self.sender_address, self.receiver_address),
+            (333, 1000, 3, self.sender_address, self.receiver_address),
+            (50, 0, 20, self.receiver_address, self.random_address),
+            (77, 13, 5, self.receiver_address, self.sender_address),
+        ):
+            self.token.transfer(
+                receiver=receiver,
+                amount=amount,
+                duration=duration,
+                start_timestamp=start,
+                sender=sender,
+                current_timestamp=0,
+            )
+
+        for wallet in (self.sender_address, self.receiver_address, self.random_address):
+            stored = self.token.get_stored_balance(wallet)
+            for timestamp in (0, 4, 10, 20, 333, 2000):
+                self.assertEqual(
+                    stored
+                    + get_wallet_non_accrued_streamed_amount(
+                        self.connection,
+                        to_checksum_address(wallet),
+                        self.token.get_address(),
+                        timestamp,
+                        timestamp,
+                    ),
+                    self.token.balance_of(wallet, timestamp),
+                )
+
     def test_transfer_more_than_balance(self):
         current_timestamp = 0
         start_timestamp = 0
@@ -233,6 +321,309 @@ class TestStreamableToken(unittest.TestCase):
                 self.connection.execute("RELEASE SAVEPOINT before_exception")
                 raise e
 
+    def test_transfer_with_committed_future_streams(self):
+        self.token.mint(100, self.sender_address)
+
+        # Streams that have not started yet are already committed
+        stream_id = self.token.transfer(
+            receiver=self.receiver_address,
+            amount=60,
+            duration=100,
+            start_timestamp=1000,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+        self.assertEqual(self.token.uncommitted_balance_of(self.sender_address, 0), 40)
+        with self.assertRaises(AssertionError):
+            self.token.transfer(
+                receiver=self.random_address,
+                amount=41,
+                duration=10,
+                start_timestamp=0,
+                sender=self.sender_address,
+                current_timestamp=0,
+            )
+
+        # Cancelling the stream releases the committed amount
+        self.token.cancel_stream(
+            stream_id=stream_id, sender=self.sender_address, current_timestamp=10
+        )
+        self.assertEqual(
+            self.token.uncommitted_balance_of(self.sender_address, 10), 100
+        )
+        self.token.transfer(
+            receiver=self.random_address,
+            amount=100,
+            duration=10,
+            start_timestamp=10,
+            sender=self.sender_address,
+            current_timestamp=10,
+        )
+
+    def test_rolled_back_account_ids_are_not_cached(self):
+        self.token.mint(100, self.sender_address)
+        self.connection.commit()
+
+        # The receiver's id is handed out again after the rollback
+        self.connection.execute("SAVEPOINT transfer")
+        self.token.transfer(
+            receiver=self.receiver_address,
+            amount=10,
+            duration=0,
+            start_timestamp=0,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+        self.connection.execute("ROLLBACK TO SAVEPOINT transfer")
+        self.connection.execute("RELEASE SAVEPOINT transfer")
+        self.token.mint(100, self.random_address)
+        self.connection.commit()
+
+        self.assertIsNone(get_account_id(self.connection, self.receiver_address))
+        self.assertEqual(self.token.balance_of(self.random_address, 0), 100)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 0), 0)
+
+    def test_rolled_back_tokens_are_not_cached(self):
+        other_token = StreamableToken(self.connection, self.random_address_2)
+        self.connection.execute("SAVEPOINT mint")
+        other_token.mint(5, self.sender_address)
+        self.connection.execute("ROLLBACK TO SAVEPOINT mint")
+        self.connection.execute("RELEASE SAVEPOINT mint")
+
+        # The token row is inserted again, so the balance row can reference it
+        other_token.mint(5, self.sender_address)
+        self.connection.commit()
+        self.assertEqual(other_token.get_stored_total_supply(), 5)
+
+    @patch("dapp.db.ACCOUNT_CACHE_SIZE", 2)
+    def test_account_cache_is_bounded(self):
+        clear_account_cache()
+        for address in (
+            self.sender_address,
+            self.receiver_address,
+            self.random_address,
+        ):
+            self.token.mint(10, address)
+        self.connection.commit()
+
+        self.assertEqual(len(account_ids), 2)
+        self.assertEqual(len(account_addresses), 2)
+        self.assertEqual(len(token_ids), 1)
+        # Evicted accounts are read again from the database
+        self.assertNotIn(self.token_address, account_ids)
+        self.assertEqual(self.token.balance_of(self.sender_address, 0), 10)
+        self.assertEqual(self.token.get_stored_total_supply(), 30)
+
+    def test_reads_do_not_write(self):
+        self.token.mint(100, self.sender_address)
+        self.connection.commit()
+        changes = self.connection.total_changes
+
+        other_token = StreamableToken(self.connection, self.random_address_2)
+        for token in (self.token, other_token):
+            token.balance_of(self.sender_address, 10)
+            token.balance_of(self.random_address, 10)
+            token.get_streams(self.random_address)
+            token.get_stored_total_supply()
+        get_max_end_timestamp_for_wallet(
+            self.connection, to_checksum_address(self.random_address)
+        )
+
+        self.assertFalse(self.connection.in_transaction)
+        self.assertEqual(self.connection.total_changes, changes)
+        self.assertIsNone(
+            get_account_id(self.connection, to_checksum_address(self.random_address))
+        )
+
+    def test_migrate_text_amounts(self):
+        self.token.mint(100, self.sender_address)
+        self.token.transfer(
+            receiver=self.receiver_address,
+            amount=40,
+            duration=100,
+            start_timestamp=1,
+            sender=self.sender_address,
+            current_timestamp=1,
+        )
+        self.connection.commit()
+        # Amounts as written before they were stored as BLOBs
+        self.connection.execute("UPDATE balance SET amount = '100'")
+        self.connection.execute("UPDATE stream SET amount = '40'")
+        self.connection.execute("UPDATE token SET total_supply = '100'")
+
+        migrate_amounts_to_blob(self.connection)
+        self.connection.commit()
+
+        self.assertEqual(
+            self.connection.execute(
+                """
+                SELECT DISTINCT typeof(amount) FROM balance
+                UNION SELECT DISTINCT typeof(amount) FROM stream
+                UNION SELECT DISTINCT typeof(total_supply) FROM token
+                """
+            ).fetchall(),
+            [("blob",)],
+        )
+        self.assertEqual(self.token.get_stored_total_supply(), 100)
+        self.assertEqual(self.token.balance_of(self.sender_address, 51), 80)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 51), 20)
+
+    def test_accrued_streams_are_archived(self):
+        self.token.mint(100, self.sender_address)
+        stream_id = self.token.transfer(
+            receiver=self.receiver_address,
+            amount=40,
+            duration=100,
+            start_timestamp=0,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+        self.token.transfer(
+            receiver=self.random_address,
+            amount=10,
+            duration=0,
+            start_timestamp=200,
+            sender=self.sender_address,
+            current_timestamp=200,
+        )
+
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT COUNT(*) FROM stream WHERE id = ?", (stream_id,)
+            ).fetchone()[0],
+            0,
+        )
+        self.assertEqual(
+            self.connection.execute(
+                "SELECT COUNT(*) FROM stream_archive WHERE id = ?", (stream_id,)
+            ).fetchone()[0],
+            1,
+        )
+        self.assertEqual(self.token.balance_of(self.sender_address, 200), 50)
+        self.assertEqual(self.token.balance_of(self.receiver_address, 200), 40)
+        # History reads include the archived stream
+        streams = self.token.get_streams(self.receiver_address)
+        self.assertEqual([(s.id, s.accrued) for s in streams], [(stream_id, True)])
+        self.assertTrue(self.token.get_stream_by_id(stream_id).accrued)
+
+    def test_settlement_is_batched(self):
+        self.token.mint(1000, self.sender_address)
+        for i in range(20):
+            self.token.transfer(
+                receiver=(self.receiver_address, self.random_address)[i % 2],
+                amount=10,
+                duration=10,
+                start_timestamp=0,
+                sender=self.sender_address,
+                current_timestamp=0,
+            )
+
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.token.process_streams(self.sender_address, 10)
+        self.connection.set_trace_callback(None)
+
+        self.assertEqual(len([s for s in statements if "UPDATE stream" in s]), 1)
+        self.assertLessEqual(len([s for s in statements if "FROM balance" in s]), 1)
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 800)
+        self.assertEqual(self.token.get_stored_balance(self.receiver_address), 100)
+        self.assertEqual(self.token.get_stored_balance(self.random_address), 100)
+
+    def test_balances_are_flushed_on_commit(self):
+        def stored_balances():
+            return self.connection.execute("SELECT COUNT(*) FROM balance").fetchone()[0]
+
+        self.token.mint(100, self.sender_address)
+        self.token.mint(50, self.sender_address)
+        self.assertEqual(stored_balances(), 0)
+        self.connection.commit()
+        self.assertEqual(stored_balances(), 1)
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 150)
+
+        # Changes before a savepoint survive rolling back to it
+        self.token.mint(10, self.sender_address)
+        self.connection.execute("SAVEPOINT test")
+        self.token.mint(5, self.sender_address)
+        self.connection.execute("ROLLBACK TO SAVEPOINT test")
+        self.connection.execute("RELEASE SAVEPOINT test")
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 160)
+        self.assertEqual(self.token.get_stored_total_supply(), 160)
+
+        self.connection.rollback()
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 150)
+        self.assertEqual(self.token.get_stored_total_supply(), 150)
+
+    def test_rollback_to_savepoint_drops_what_changed_since(self):
+        self.token.mint(100, self.sender_address)
+        self.token.mint(100, self.random_address)
+        self.connection.execute("SAVEPOINT outer")
+        self.token.mint(10, self.receiver_address)
+        # Flushes the receiver's balance within the outer savepoint
+        self.connection.execute("SAVEPOINT inner")
+        self.token.mint(5, self.sender_address)
+        self.connection.execute("ROLLBACK TO SAVEPOINT outer")
+        self.connection.execute("RELEASE SAVEPOINT outer")
+
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.assertEqual(self.token.get_stored_balance(self.random_address), 100)
+        self.connection.set_trace_callback(None)
+        self.assertFalse([s for s in statements if "FROM balance" in s])
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 100)
+        self.assertEqual(self.token.get_stored_balance(self.receiver_address), 0)
+        self.assertEqual(self.token.get_stored_total_supply(), 200)
+
+        self.connection.commit()
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 100)
+        self.assertEqual(self.token.get_stored_balance(self.receiver_address), 0)
+        self.assertEqual(self.token.get_stored_total_supply(), 200)
+
+    def test_warm_connection_keeps_state_until_rollback(self):
+        self.connection.warm = True
+        self.token.mint(100, self.sender_address)
+        self.token.transfer(
+            receiver=self.receiver_address,
+            amount=40,
+            duration=100,
+            start_timestamp=0,
+            sender=self.sender_address,
+            current_timestamp=0,
+        )
+        self.connection.commit()
+
+        statements = []
+        self.connection.set_trace_callback(statements.append)
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 100)
+        self.assertEqual(self.token.get_stored_total_supply(), 100)
+        self.assertEqual(self.token.balance_of(self.sender_address, 50), 80)
+        self.connection.set_trace_callback(None)
+        self.assertFalse(
+            [s for s in statements if "FROM balance" in s or "FROM accumulator" in s]
+        )
+
+        # The committed state is on disk for other connections
+        other = get_connection()
+        other_token = StreamableToken(other, self.token_address)
+        self.assertEqual(other_token.balance_of(self.receiver_address, 50), 20)
+        other.close()
+
+        self.token.mint(10, self.sender_address)
+        self.connection.rollback()
+        self.assertEqual(self.connection.get_state_size(), 0)
+        self.assertEqual(self.token.get_stored_balance(self.sender_address), 100)
+
+    def test_warm_connection_starts_cold_over_budget(self):
+        self.connection.warm = True
+        self.token.mint(100, self.sender_address)
+        self.connection.commit()
+        self.assertGreater(self.connection.get_state_size(), 0)
+
+        with patch("dapp.db.WARM_STATE_BUDGET", self.connection.get_state_size()):
+            self.token.mint(100, self.receiver_address)
+            self.connection.commit()
+        self.assertEqual(self.connection.get_state_size(), 0)
+        self.assertEqual(self.token.get_stored_balance(self.receiver_address), 100)
+
     def test_stream_with_zero_duration(self):
         # Test adding a stream with a duration of zero (should raise an exception)
         self.token.mint(100, self.sender_address)
@@ -264,6 +655,21 @@ class TestStreamableToken(unittest.TestCase):
         )
         self.assertTrue(isinstance(stream_id, int), "Stream ID should be an integer.")
 
+    def test_addresses_are_checksummed_once(self):
+        self.token.mint(100, self.sender_address.lower())
+
+        cache_info = _checksum_address.cache_info()
+        for address in (
+            self.sender_address.lower(),
+            "0x" + self.sender_address[2:].upper(),
+            self.sender_address,
+        ):
+            self.assertEqual(self.token.balance_of(address, 0), 100)
+        self.assertEqual(normalize_address("InvalidAddress"), "InvalidAddress")
+        # Every case of the address shares one entry, other strings take none
+        self.assertEqual(_checksum_address.cache_info().misses, cache_info.misses)
+        self.assertEqual(_checksum_address.cache_info().currsize, cache_info.currsize)
+
     def test_invalid_addresses(self):
         # Test methods with invalid addresses
         with self.assertRaises(ValueError):
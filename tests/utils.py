@@ -1,14 +1,23 @@
+from dapp.db import WALLET_STREAMS, get_account_id
 from dapp.streamabletoken import StreamableToken
-from dapp.util import with_checksum_address
+from dapp.util import blob_to_int, with_checksum_address
 
 
 def get_unique_addresses_for_token(connection, token_address):
+    # Balances changed in the current transaction are only written on flush
+    connection.flush()
     cursor = connection.cursor()
     cursor.execute(
         """
-        SELECT DISTINCT from_address FROM stream WHERE token_address = ?
+        SELECT DISTINCT a.address FROM stream_history s
+        JOIN account a ON a.id = s.from_id
+        JOIN account t ON t.id = s.token_id
+        WHERE t.address = ?
         UNION
-        SELECT DISTINCT to_address FROM stream WHERE token_address = ?
+        SELECT DISTINCT a.address FROM stream_history s
+        JOIN account a ON a.id = s.to_id
+        JOIN account t ON t.id = s.token_id
+        WHERE t.address = ?
         """,
         (token_address, token_address),
     )
@@ -16,7 +25,10 @@ def get_unique_addresses_for_token(connection, token_address):
 
     cursor.execute(
         """
-        SELECT DISTINCT account_address FROM balance WHERE token_address = ?
+        SELECT DISTINCT a.address FROM balance b
+        JOIN account a ON a.id = b.account_id
+        JOIN account t ON t.id = b.token_id
+        WHERE t.address = ?
         """,
         (token_address,),
     )
@@ -39,3 +51,32 @@ def calculate_total_supply_token(connection, token_address):
         assert balance >= 0, "Balance cannot be negative."
         total_supply += balance
     return total_supply
+
+
+def get_wallet_non_accrued_streamed_amount(
+    connection,
+    account_address,
+    token_address,
+    until_timestamp,
+    recipient_until_timestamp=0,
+) -> int:
+    """Net amount streamed to the wallet by its non accrued streams, computed
+    from the stream rows with streamed_sum, to check the accumulators against."""
+    account_id = get_account_id(connection, account_address)
+    token_id = get_account_id(connection, token_address)
+    wallet_streams = WALLET_STREAMS.format(
+        table="stream",
+        columns="start_timestamp, duration, amount, to_id",
+        where="token_id = ? AND accrued = 0",
+    )
+    cursor = connection.cursor()
+    cursor.execute(
+        f"""
+        SELECT streamed_sum(start_timestamp, duration, amount, to_id, ?, ?, ?)
+        FROM ({wallet_streams})
+        """,
+        (account_id, until_timestamp, recipient_until_timestamp)
+        + (account_id, token_id, account_id, token_id, account_id),
+    )
+
+    return blob_to_int(cursor.fetchone()[0])